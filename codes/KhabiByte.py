@@ -1,70 +1,28 @@
-import tkinter as tk
-from tkinter import ttk, messagebox, simpledialog
+from tkinter import messagebox, simpledialog, filedialog
 import customtkinter as ctk
-import serial
-import serial.tools.list_ports
+from serial_link import HANDSHAKE_TIMEOUT, HIGH_SPEED_BAUDRATES
+import card_layout
+from cipher import VigenereCipher
+from timing import PhaseTimer
+from compression import compress
+from scanner import ScanSession, DEFAULT_REPEAT_WINDOW
+from frame_protocol import describe_result
+from status_log import StatusLog, StatusPane, SpillFile, FRAME_INTERVAL_MS
 import threading
-import time
 import re
-import math
+
+# Only what the first frame needs is imported above. asyncio and the client
+# (connect_serial), batch.py (start_batch) and the port enumeration
+# (refresh_ports) and the card archive are imported when first used; see
+# bench_startup.py.
+
+# Per-operation RF statistics printed by the sketch
+RF_PLAN_PATTERN = re.compile(r"RF: (\d+) auth, \d+ read/write commands on (\d+) blocks")
 
 # Set appearance mode and color theme
 ctk.set_appearance_mode("dark")
 ctk.set_default_color_theme("blue")
 
-class VigenereCipher:
-    @staticmethod
-    def encrypt(text, key):
-        """Encrypt text using Vigenère cipher"""
-        if not key:
-            return text
-        
-        result = ""
-        key = key.upper()
-        key_index = 0
-        
-        for char in text:
-            if char.isalpha():
-                # Get the shift value from the key
-                shift = ord(key[key_index % len(key)]) - ord('A')
-                
-                if char.isupper():
-                    result += chr((ord(char) - ord('A') + shift) % 26 + ord('A'))
-                else:
-                    result += chr((ord(char) - ord('a') + shift) % 26 + ord('a'))
-                
-                key_index += 1
-            else:
-                result += char
-        
-        return result
-    
-    @staticmethod
-    def decrypt(text, key):
-        """Decrypt text using Vigenère cipher"""
-        if not key:
-            return text
-        
-        result = ""
-        key = key.upper()
-        key_index = 0
-        
-        for char in text:
-            if char.isalpha():
-                # Get the shift value from the key
-                shift = ord(key[key_index % len(key)]) - ord('A')
-                
-                if char.isupper():
-                    result += chr((ord(char) - ord('A') - shift) % 26 + ord('A'))
-                else:
-                    result += chr((ord(char) - ord('a') - shift) % 26 + ord('a'))
-                
-                key_index += 1
-            else:
-                result += char
-        
-        return result
-
 class RFIDManager:
     def __init__(self):
         self.root = ctk.CTk()
@@ -72,28 +30,64 @@ class RFIDManager:
         self.root.geometry("950x750")
         self.root.resizable(True, True)
         
-        # Serial connection
-        self.serial_connection = None
+        # Serial connection; card operations run as coroutines of self.client on self.loop
+        self.client = None
+        self.serial_link = None
         self.is_connected = False
+        self.loop = None
         
         # Variables
         self.encrypt_var = ctk.BooleanVar()
         self.decrypt_var = ctk.BooleanVar()
+        self.diff_write_var = ctk.BooleanVar(value=False)
+        self.compress_var = ctk.BooleanVar(value=False)
+        self.card_type_var = ctk.StringVar(value=card_layout.DEFAULT_CARD_TYPE)
         self.port_var = ctk.StringVar()
         self.status_var = ctk.StringVar(value="Disconnected")
+        self.reset_on_connect_var = ctk.BooleanVar(value=True)
+        self.binary_protocol_var = ctk.BooleanVar(value=False)
+        self.batch_file_var = ctk.StringVar()
+        self.scan_window_var = ctk.StringVar(value=str(DEFAULT_REPEAT_WINDOW))
+        self.spill_log_var = ctk.BooleanVar(value=False)
         
         # Encryption keys
         self.encryption_key = ""
         self.decryption_key = ""
         
+        # Batch provisioning run in progress
+        self.batch_provisioner = None
+        # Continuous scan in progress
+        self.scan_session = None
+        
+        # Status pane contents: the last lines of each log, shown once per frame
+        self.write_log = StatusLog("write")
+        self.read_log = StatusLog("read")
+        self.batch_log = StatusLog("batch")
+        self.spill_file = None
+        
+        # Every card read and written (card_archive.py), opened on first use
+        self.archive = None
+        
         # RFID Configuration - Using multiple blocks for longer messages
-        self.MAX_MESSAGE_LENGTH = 240  # 15 blocks × 16 bytes = 240 characters
+        self.MAX_MESSAGE_LENGTH = card_layout.capacity(self.card_type_var.get())  # A 1K card's 44 payload blocks, the sketch's buffer on an Uno
         self.BLOCKS_PER_SECTOR = 3  # Using blocks 0, 1, 2 (block 3 is sector trailer)
         self.BYTES_PER_BLOCK = 16
         
+        # Upper bound for the ready handshake after opening the port
+        self.HANDSHAKE_TIMEOUT = HANDSHAKE_TIMEOUT
+        # Rates negotiated with the sketch after connecting (falls back to 9600)
+        self.HIGH_SPEED_BAUDRATES = HIGH_SPEED_BAUDRATES
+        
         self.setup_ui()
         self.refresh_ports()
         
+        self.status_panes = [
+            StatusPane(self.write_log, self.write_status),
+            StatusPane(self.read_log, self.read_status),
+            StatusPane(self.batch_log, self.batch_status),
+        ]
+        self.flush_status()
+        
     def setup_ui(self):
         """Setup the user interface"""
         # Main container with proper padding
@@ -122,12 +116,23 @@ class RFIDManager:
         self.port_combo = ctk.CTkComboBox(port_frame, variable=self.port_var, width=150)
         self.port_combo.pack(side="left", padx=5)
         
-        refresh_btn = ctk.CTkButton(port_frame, text="Refresh", command=self.refresh_ports, width=80)
-        refresh_btn.pack(side="left", padx=5)
+        self.refresh_btn = ctk.CTkButton(port_frame, text="Refresh", command=self.refresh_ports, width=80)
+        self.refresh_btn.pack(side="left", padx=5)
         
         self.connect_btn = ctk.CTkButton(port_frame, text="Connect", command=self.toggle_connection, width=100)
         self.connect_btn.pack(side="left", padx=5)
         
+        self.reset_checkbox = ctk.CTkCheckBox(port_frame, text="Reset board on connect", variable=self.reset_on_connect_var)
+        self.reset_checkbox.pack(side="left", padx=(10, 5))
+        
+        self.binary_checkbox = ctk.CTkCheckBox(port_frame, text="Binary protocol", variable=self.binary_protocol_var)
+        self.binary_checkbox.pack(side="left", padx=5)
+        
+        self.spill_checkbox = ctk.CTkCheckBox(
+            port_frame, text="Save full log", variable=self.spill_log_var, command=self.on_spill_toggle
+        )
+        self.spill_checkbox.pack(side="left", padx=5)
+        
         # Status
         self.status_label = ctk.CTkLabel(conn_frame, textvariable=self.status_var, font=ctk.CTkFont(size=12))
         self.status_label.pack(pady=(0, 10))
@@ -148,6 +153,10 @@ class RFIDManager:
         self.read_tab = self.notebook.add("Read Data")
         self.setup_read_tab()
         
+        # Batch tab
+        self.batch_tab = self.notebook.add("Batch")
+        self.setup_batch_tab()
+        
     def setup_write_tab(self):
         """Setup the write data tab with scrolling"""
         # Create scrollable frame for write tab
@@ -172,23 +181,54 @@ class RFIDManager:
         self.key_label = ctk.CTkLabel(self.key_frame, text="", font=ctk.CTkFont(size=12))
         self.key_label.pack(pady=8)
         
+        # Write mode section
+        mode_frame = ctk.CTkFrame(self.write_scroll)
+        mode_frame.pack(fill="x", padx=10, pady=5)
+        
+        self.diff_write_checkbox = ctk.CTkCheckBox(
+            mode_frame,
+            text="Only rewrite changed blocks",
+            variable=self.diff_write_var,
+            font=ctk.CTkFont(size=14)
+        )
+        self.diff_write_checkbox.pack(side="left", padx=15, pady=15)
+        
+        self.compress_checkbox = ctk.CTkCheckBox(
+            mode_frame,
+            text="Compress (binary protocol)",
+            variable=self.compress_var,
+            font=ctk.CTkFont(size=14)
+        )
+        self.compress_checkbox.pack(side="left", padx=15, pady=15)
+        
+        ctk.CTkLabel(mode_frame, text="Card:").pack(side="left", padx=(15, 5))
+        self.card_type_combo = ctk.CTkComboBox(
+            mode_frame,
+            values=list(card_layout.CARD_DATA_BLOCKS),
+            variable=self.card_type_var,
+            command=self.on_card_type_change,
+            width=140
+        )
+        self.card_type_combo.pack(side="left", padx=5)
+        
         # Message input section
         msg_frame = ctk.CTkFrame(self.write_scroll)
         msg_frame.pack(fill="x", padx=10, pady=5)
         
-        ctk.CTkLabel(
+        self.message_label = ctk.CTkLabel(
             msg_frame, 
-            text=f"Message to Write (Max {self.MAX_MESSAGE_LENGTH} characters):", 
+            text=f"Message to Write (Max {self.MAX_MESSAGE_LENGTH} bytes):", 
             font=ctk.CTkFont(size=14, weight="bold")
-        ).pack(anchor="w", padx=15, pady=(15, 5))
+        )
+        self.message_label.pack(anchor="w", padx=15, pady=(15, 5))
         
         self.message_text = ctk.CTkTextbox(msg_frame, height=200, font=ctk.CTkFont(size=12))
         self.message_text.pack(fill="x", padx=15, pady=(0, 10))
         
-        # Character counter
+        # Character counter; the limit is in UTF-8 bytes, so non-ASCII characters count more than once
         self.char_count_label = ctk.CTkLabel(
             msg_frame, 
-            text=f"Characters: 0/{self.MAX_MESSAGE_LENGTH}", 
+            text=f"Characters: 0, bytes: 0/{self.MAX_MESSAGE_LENGTH}", 
             font=ctk.CTkFont(size=11)
         )
         self.char_count_label.pack(anchor="e", padx=15, pady=(0, 10))
@@ -250,6 +290,23 @@ class RFIDManager:
         )
         self.read_btn.pack(pady=15)
         
+        # Continuous scan section
+        scan_frame = ctk.CTkFrame(self.read_scroll)
+        scan_frame.pack(fill="x", padx=10, pady=5)
+        
+        self.scan_btn = ctk.CTkButton(
+            scan_frame,
+            text="Start Continuous Scan",
+            command=self.toggle_scan,
+            width=180,
+            state="disabled"
+        )
+        self.scan_btn.pack(side="left", padx=15, pady=15)
+        
+        ctk.CTkLabel(scan_frame, text="Ignore repeats of a card for (s):").pack(side="left", padx=(15, 5))
+        self.scan_window_entry = ctk.CTkEntry(scan_frame, textvariable=self.scan_window_var, width=60)
+        self.scan_window_entry.pack(side="left", padx=5)
+        
         # Data display section
         data_frame = ctk.CTkFrame(self.read_scroll)
         data_frame.pack(fill="x", padx=10, pady=5)
@@ -271,6 +328,76 @@ class RFIDManager:
         self.read_status = ctk.CTkTextbox(status_frame, height=120, font=ctk.CTkFont(size=11))
         self.read_status.pack(fill="x", padx=15, pady=(0, 15))
         
+    def setup_batch_tab(self):
+        """Setup the batch provisioning tab"""
+        self.batch_scroll = ctk.CTkScrollableFrame(self.batch_tab)
+        self.batch_scroll.pack(fill="both", expand=True, padx=5, pady=5)
+        
+        # Message file section
+        file_frame = ctk.CTkFrame(self.batch_scroll)
+        file_frame.pack(fill="x", padx=10, pady=(10, 5))
+        
+        ctk.CTkLabel(
+            file_frame,
+            text="Messages (CSV or JSONL, one card per row):",
+            font=ctk.CTkFont(size=14, weight="bold")
+        ).pack(anchor="w", padx=15, pady=(15, 5))
+        
+        path_frame = ctk.CTkFrame(file_frame)
+        path_frame.pack(fill="x", padx=15, pady=(0, 10))
+        
+        self.batch_file_entry = ctk.CTkEntry(path_frame, textvariable=self.batch_file_var)
+        self.batch_file_entry.pack(side="left", fill="x", expand=True, padx=(10, 5), pady=8)
+        
+        browse_btn = ctk.CTkButton(path_frame, text="Browse", command=self.browse_batch_file, width=80)
+        browse_btn.pack(side="left", padx=5)
+        
+        ctk.CTkLabel(
+            file_frame,
+            text="Rows are encrypted when \"Encrypt Message\" is checked on the Write Data tab.",
+            font=ctk.CTkFont(size=11)
+        ).pack(anchor="w", padx=15, pady=(0, 10))
+        
+        # Start / stop buttons
+        button_frame = ctk.CTkFrame(self.batch_scroll)
+        button_frame.pack(pady=15)
+        
+        self.batch_start_btn = ctk.CTkButton(
+            button_frame,
+            text="Start Batch",
+            command=self.start_batch,
+            height=45,
+            font=ctk.CTkFont(size=14, weight="bold"),
+            state="disabled"
+        )
+        self.batch_start_btn.pack(side="left", padx=10)
+        
+        self.batch_stop_btn = ctk.CTkButton(
+            button_frame,
+            text="Stop",
+            command=self.stop_batch,
+            height=45,
+            font=ctk.CTkFont(size=14, weight="bold"),
+            state="disabled"
+        )
+        self.batch_stop_btn.pack(side="left", padx=10)
+        
+        # Live rate
+        self.batch_rate_label = ctk.CTkLabel(
+            self.batch_scroll,
+            text="Cards: 0 | 0.0 cards/min",
+            font=ctk.CTkFont(size=16, weight="bold")
+        )
+        self.batch_rate_label.pack(pady=5)
+        
+        # Per-card results
+        status_frame = ctk.CTkFrame(self.batch_scroll)
+        status_frame.pack(fill="x", padx=10, pady=5)
+        
+        ctk.CTkLabel(status_frame, text="Cards:", font=ctk.CTkFont(size=12, weight="bold")).pack(anchor="w", padx=15, pady=(10, 5))
+        self.batch_status = ctk.CTkTextbox(status_frame, height=240, font=ctk.CTkFont(size=11))
+        self.batch_status.pack(fill="x", padx=15, pady=(0, 15))
+        
     def on_encrypt_toggle(self):
         """Handle encryption checkbox toggle"""
         if self.encrypt_var.get():
@@ -288,6 +415,33 @@ class RFIDManager:
             self.key_frame.pack_forget()
             self.encryption_key = ""
             
+    def on_spill_toggle(self):
+        """Append every status line to a file as well, or stop doing so"""
+        if self.spill_log_var.get():
+            path = filedialog.asksaveasfilename(
+                title="Save full log",
+                defaultextension=".log",
+                initialfile="khabibyte.log",
+                filetypes=[("Log files", "*.log"), ("All files", "*.*")]
+            )
+            if not path:
+                self.spill_log_var.set(False)
+                return
+            try:
+                spill = SpillFile(path)
+            except OSError as e:
+                self.spill_log_var.set(False)
+                messagebox.showerror("Error", f"Cannot open log file: {str(e)}")
+                return
+        else:
+            spill = None
+            
+        previous, self.spill_file = self.spill_file, spill
+        for log in (self.write_log, self.read_log, self.batch_log):
+            log.set_spill(spill)
+        if previous:
+            previous.close()
+            
     def on_decrypt_toggle(self):
         """Handle decryption checkbox toggle"""
         if self.decrypt_var.get():
@@ -305,27 +459,47 @@ class RFIDManager:
             self.decrypt_key_frame.pack_forget()
             self.decryption_key = ""
             
+    def on_card_type_change(self, card_type):
+        """Update the message limit for the selected card type"""
+        self.MAX_MESSAGE_LENGTH = card_layout.capacity(card_type)
+        self.message_label.configure(text=f"Message to Write (Max {self.MAX_MESSAGE_LENGTH} bytes):")
+        self.update_char_count()
+        
     def update_char_count(self, event=None):
         """Update character count display"""
         text = self.message_text.get("1.0", "end-1c")
-        char_count = len(text)
-        self.char_count_label.configure(text=f"Characters: {char_count}/{self.MAX_MESSAGE_LENGTH}")
+        byte_count = len(text.encode())
+        self.char_count_label.configure(text=f"Characters: {len(text)}, bytes: {byte_count}/{self.MAX_MESSAGE_LENGTH}")
         
         # Change color if over limit
-        if char_count > self.MAX_MESSAGE_LENGTH:
+        if byte_count > self.MAX_MESSAGE_LENGTH:
             self.char_count_label.configure(text_color="red")
         else:
             self.char_count_label.configure(text_color=("gray10", "gray90"))
             
     def calculate_blocks_needed(self, message_length):
-        """Calculate how many blocks are needed for the message"""
-        return math.ceil(message_length / self.BYTES_PER_BLOCK)
+        """Calculate how many blocks are needed for the message, header block included"""
+        return card_layout.blocks_needed(message_length)
         
     def refresh_ports(self):
-        """Refresh available serial ports"""
-        ports = [port.device for port in serial.tools.list_ports.comports()]
+        """Refresh available serial ports on a worker thread; the list fills in when it is done"""
+        self.refresh_btn.configure(state="disabled")
+        threading.Thread(target=self._enumerate_ports, daemon=True).start()
+        
+    def _enumerate_ports(self):
+        """Port enumeration in separate thread; probing many USB/Bluetooth devices can take seconds"""
+        import serial.tools.list_ports
+        try:
+            ports = [port.device for port in serial.tools.list_ports.comports()]
+        except Exception:
+            ports = []
+        self.root.after(0, lambda: self._show_ports(ports))
+        
+    def _show_ports(self, ports):
+        self.refresh_btn.configure(state="normal")
         self.port_combo.configure(values=ports)
-        if ports:
+        # Keep a port the user picked or typed while the list was being built
+        if ports and self.port_var.get() not in ports:
             self.port_combo.set(ports[0])
         
     def toggle_connection(self):
@@ -343,25 +517,54 @@ class RFIDManager:
                 messagebox.showerror("Error", "Please select a port")
                 return
                 
-            self.serial_connection = serial.Serial(port, 9600, timeout=2)
-            time.sleep(2)  # Wait for Arduino to initialize
+            from rfid_client import RFIDClient
+            
+            # Wait for the ready banner (or a PONG) instead of a fixed delay, then step up the baud rate
+            self.client = self.run_async(RFIDClient.connect(
+                port,
+                baudrates=self.HIGH_SPEED_BAUDRATES,
+                binary=self.binary_protocol_var.get(),
+                reset_board=self.reset_on_connect_var.get(),
+                handshake_timeout=self.HANDSHAKE_TIMEOUT
+            )).result()
+            # Batch runs and scans still drive the link from their own threads
+            self.serial_link = self.client.link
+            baudrate = self.serial_link.baudrate
             
             self.is_connected = True
-            self.status_var.set(f"Connected to {port}")
+            protocol = "binary" if self.serial_link.binary_mode else "text"
+            self.status_var.set(f"Connected to {port} @ {baudrate} baud ({protocol})")
             self.connect_btn.configure(text="Disconnect")
             
             # Enable buttons
             self.upload_btn.configure(state="normal")
             self.read_btn.configure(state="normal")
+            self.batch_start_btn.configure(state="normal")
+            self.scan_btn.configure(state="normal")
+            if not self.serial_link.binary_mode:
+                # Compressed payloads are binary, which the text protocol can't carry
+                self.compress_var.set(False)
+                self.compress_checkbox.configure(state="disabled")
             
         except Exception as e:
             messagebox.showerror("Connection Error", f"Failed to connect: {str(e)}")
             
     def disconnect_serial(self):
         """Disconnect from serial port"""
-        if self.serial_connection:
-            self.serial_connection.close()
-            self.serial_connection = None
+        if self.batch_provisioner:
+            self.batch_provisioner.stop()
+        if self.scan_session:
+            self.scan_session.stop()
+            
+        if self.client:
+            # The client switches the sketch back to text mode first, so the next connection that
+            # doesn't reset the board gets its PONG; operations still waiting end with SerialLinkClosed
+            try:
+                self.run_async(self.client.close()).result()
+            except Exception:
+                self.serial_link.close()
+            self.serial_link = None
+            self.client = None
             
         self.is_connected = False
         self.status_var.set("Disconnected")
@@ -370,6 +573,10 @@ class RFIDManager:
         # Disable buttons
         self.upload_btn.configure(state="disabled")
         self.read_btn.configure(state="disabled")
+        self.batch_start_btn.configure(state="disabled")
+        self.batch_stop_btn.configure(state="disabled")
+        self.scan_btn.configure(state="disabled", text="Start Continuous Scan")
+        self.compress_checkbox.configure(state="normal")
         
     def write_data(self):
         """Write data to RFID card"""
@@ -382,62 +589,101 @@ class RFIDManager:
             messagebox.showerror("Error", "Please enter a message")
             return
             
-        if len(message) > self.MAX_MESSAGE_LENGTH:
-            messagebox.showerror("Error", f"Message too long (max {self.MAX_MESSAGE_LENGTH} characters)")
-            return
-            
         # Handle encryption
         final_message = message
         if self.encrypt_var.get() and self.encryption_key:
             final_message = VigenereCipher.encrypt(message, self.encryption_key)
             
+        # The checkbox is disabled on a text protocol connection
+        payload = final_message.encode()
+        flags = 0
+        if self.compress_var.get():
+            payload, flags = compress(payload)
+            
+        if len(payload) > self.MAX_MESSAGE_LENGTH:
+            messagebox.showerror("Error", f"Message too long ({len(payload)} bytes, max {self.MAX_MESSAGE_LENGTH} bytes)")
+            return
+            
         # Calculate blocks needed
-        blocks_needed = self.calculate_blocks_needed(len(final_message))
+        blocks_needed = self.calculate_blocks_needed(len(payload))
         
-        # Start write operation in separate thread
-        threading.Thread(target=self._write_thread, args=(final_message, message, blocks_needed), daemon=True).start()
+        # The write runs on the client's event loop
+        self.run_async(self._write(final_message, message, payload, flags, blocks_needed))
         
-    def _write_thread(self, encrypted_message, original_message, blocks_needed):
-        """Write operation in separate thread"""
+    async def _write(self, encrypted_message, original_message, payload, flags, blocks_needed):
+        """Write operation, awaited on the event loop"""
+        import asyncio
+        from rfid_client import RESUME_ATTEMPTS
         try:
-            self.root.after(0, lambda: self.write_status.delete("1.0", "end"))
-            self.root.after(0, lambda: self.write_status.insert("1.0", "Sending write command to Arduino...\n"))
+            self.write_log.clear("Sending write command to Arduino...\n")
             
-            # Send write command with block count
-            self.serial_connection.write(f"WRITE_MULTI:{blocks_needed}\n".encode())
-            time.sleep(0.1)
+            if self.encrypt_var.get():
+                self.write_log.write(f"Original: {original_message}\n")
+                self.write_log.write(f"Encrypted: {encrypted_message}\n")
             
-            # Send message
-            self.serial_connection.write(f"{encrypted_message}\n".encode())
+            if flags:
+                self.write_log.write(f"Compressed {len(encrypted_message.encode())} bytes to {len(payload)}\n")
             
-            if self.encrypt_var.get():
-                self.root.after(0, lambda: self.write_status.insert("end", f"Original: {original_message}\n"))
-                self.root.after(0, lambda: self.write_status.insert("end", f"Encrypted: {encrypted_message}\n"))
-
-            self.root.after(0, lambda: self.write_status.insert("end", "Clearing old data blocks...\n"))
-            self.root.after(0, lambda: self.write_status.insert("end", f"Writing to {blocks_needed} blocks...\n"))
-            self.root.after(0, lambda: self.write_status.insert("end", "Waiting for RFID card... Please place card near reader.\n"))
-            
-            # Wait for response
-            start_time = time.time()
-            while time.time() - start_time < 45:  # 45 second timeout for multi-block
-                if self.serial_connection.in_waiting > 0:
-                    response = self.serial_connection.readline().decode().strip()
-                    self.root.after(0, lambda r=response: self.write_status.insert("end", f"Arduino: {r}\n"))
-                    
-                    if "successful" in response.lower():
-                        self.root.after(0, lambda: messagebox.showinfo("Success", f"Data written successfully to {blocks_needed} blocks!"))
-                        return
-                    elif "failed" in response.lower():
-                        self.root.after(0, lambda: messagebox.showerror("Error", "Write operation failed"))
-                        return
-                        
-                time.sleep(0.1)
-                
-            self.root.after(0, lambda: messagebox.showerror("Timeout", "Operation timed out. Please try again."))
+            differential = self.diff_write_var.get()
+            if self.client.binary_mode:
+                self.write_log.write(f"Writing to {blocks_needed} blocks (binary protocol)...\n")
+            else:
+                if differential:
+                    self.write_log.write("Comparing card contents, only changed blocks are rewritten...\n")
+                else:
+                    self.write_log.write("Clearing old data blocks...\n")
+                self.write_log.write(f"Writing to {blocks_needed} blocks...\n")
+            self.write_log.write("Waiting for RFID card... Please place card near reader.\n")
+            if not differential:
+                self.write_log.write("If the card is lifted too early, put it back to finish the write.\n")
+            
+            def on_line(r):
+                self.write_log.write(f"Arduino: {r}\n")
+                self._show_rf_plan(self.write_log, r)
+            
+            # Client and firmware phase timings of this write (45 second timeout for multi-block)
+            write = await self.client.write_card(
+                payload, timeout=45, differential=differential, flags=flags, timer=PhaseTimer(), on_line=on_line,
+                resume=RESUME_ATTEMPTS
+            )
+            if write.result:
+                self._show_result(self.write_log, write.result)
+            self._archive(
+                self.write_log, "write", write.uid, encrypted_message.encode(),
+                original_message if self.encrypt_var.get() else None, write.blocks, write.timer.total_ms, write.ok
+            )
+            progress = write.progress
+            if progress and write.result:
+                resumed = f", resumed at data block {progress.resumed_at}" if progress.resumed_at else ""
+                self.write_log.write(
+                    f"{progress.verified} of {progress.needed} blocks verified, {progress.written} written{resumed}\n"
+                )
+            self.write_log.write(f"{write.timer.summary()}\n")
             
+            saved_note = ""
+            if write.stats:
+                stats = write.stats
+                if write.result:
+                    self.write_log.write(
+                        f"Differential write: {stats.rewritten} rewritten, {stats.unchanged} unchanged, "
+                        f"{stats.cleared} stale cleared, saved {stats.rf_saved} RF operations\n"
+                    )
+                saved_note = f"\n{stats.rf_saved} RF operations saved."
+            if write.ok:
+                self.root.after(0, lambda: messagebox.showinfo("Success", f"Data written successfully to {write.blocks} blocks!{saved_note}"))
+            elif progress and progress.verified:
+                self.root.after(0, lambda: messagebox.showerror(
+                    "Incomplete",
+                    f"Only {progress.verified} of {progress.needed} blocks were written. "
+                    "Write again and put the same card back to finish where it stopped."
+                ))
+            else:
+                self.root.after(0, lambda: messagebox.showerror("Error", "Write operation failed"))
+            
+        except asyncio.TimeoutError:
+            self.root.after(0, lambda: messagebox.showerror("Timeout", "Operation timed out. Please try again."))
         except Exception as e:
-            self.root.after(0, lambda: messagebox.showerror("Error", f"Write error: {str(e)}"))
+            self.root.after(0, lambda e=e: messagebox.showerror("Error", f"Write error: {str(e)}"))
             
     def read_data(self):
         """Read data from RFID card"""
@@ -445,59 +691,249 @@ class RFIDManager:
             messagebox.showerror("Error", "Please connect to Arduino first")
             return
             
-        # Start read operation in separate thread
-        threading.Thread(target=self._read_thread, daemon=True).start()
+        # The read runs on the client's event loop
+        self.run_async(self._read())
         
-    def _read_thread(self):
-        """Read operation in separate thread"""
+    async def _read(self):
+        """Read operation, awaited on the event loop"""
+        import asyncio
         try:
-            self.root.after(0, lambda: self.read_status.delete("1.0", "end"))
-            self.root.after(0, lambda: self.read_status.insert("1.0", "Sending read command to Arduino...\n"))
-            
-            # Send read command for multiple blocks
-            self.serial_connection.write(b"READ_MULTI\n")
-            
-            self.root.after(0, lambda: self.read_status.insert("end", "Waiting for RFID card... Please place card near reader.\n"))
-            
-            # Wait for response
-            start_time = time.time()
-            while time.time() - start_time < 45:  # 45 second timeout for multi-block
-                if self.serial_connection.in_waiting > 0:
-                    response = self.serial_connection.readline().decode().strip()
-                    self.root.after(0, lambda r=response: self.read_status.insert("end", f"Arduino: {r}\n"))
-                    
-                    if response.startswith("DATA:"):
-                        data = response[5:]  # Remove "DATA:" prefix
-                        
-                        # Handle decryption if checkbox is checked
-                        final_data = data
-                        if self.decrypt_var.get() and self.decryption_key:
-                            decrypted_data = VigenereCipher.decrypt(data, self.decryption_key)
-                            final_data = decrypted_data
-                            self.root.after(0, lambda: self.read_status.insert("end", f"Encrypted data: {data}\n"))
-                            self.root.after(0, lambda: self.read_status.insert("end", f"Decrypted data: {decrypted_data}\n"))
-                        
-                        self.root.after(0, lambda d=final_data: self.read_data_text.delete("1.0", "end"))
-                        self.root.after(0, lambda d=final_data: self.read_data_text.insert("1.0", d))
-                        
-                        # Update character count for read data
-                        char_count = len(final_data)
-                        self.root.after(0, lambda c=char_count: self.read_char_count_label.configure(text=f"Characters: {c}"))
-                        return
-                    elif "failed" in response.lower():
-                        self.root.after(0, lambda: messagebox.showerror("Error", "Read operation failed"))
-                        return
-                        
-                time.sleep(0.1)
-                
+            self.read_log.clear("Sending read command to Arduino...\n")
+            self.read_log.write("Waiting for RFID card... Please place card near reader.\n")
+            
+            def on_line(r):
+                self.read_log.write(f"Arduino: {r}\n")
+                self._show_rf_plan(self.read_log, r)
+            
+            # Client and firmware phase timings of this read (45 second timeout for multi-block)
+            read = await self.client.read_card(timeout=45, timer=PhaseTimer(), on_line=on_line)
+            if read.result:
+                self._show_result(self.read_log, read.result)
+            self.read_log.write(f"{read.timer.summary()}\n")
+            if not read.ok:
+                self._archive(self.read_log, "read", read.uid, b"", None, read.blocks, read.timer.total_ms, False)
+                self.root.after(0, lambda: messagebox.showerror("Error", "Read operation failed"))
+                return
+            data = read.text
+            
+            # Handle decryption if checkbox is checked
+            final_data = data
+            decrypted_data = None
+            if self.decrypt_var.get() and self.decryption_key:
+                decrypted_data = VigenereCipher.decrypt(data, self.decryption_key)
+                final_data = decrypted_data
+                self.read_log.write(f"Encrypted data: {data}\n")
+                self.read_log.write(f"Decrypted data: {decrypted_data}\n")
+            self._archive(self.read_log, "read", read.uid, read.data, decrypted_data, read.blocks, read.timer.total_ms, True)
+            
+            self.root.after(0, lambda d=final_data: self.read_data_text.delete("1.0", "end"))
+            self.root.after(0, lambda d=final_data: self.read_data_text.insert("1.0", d))
+            
+            # Update character count for read data
+            char_count = len(final_data)
+            self.root.after(0, lambda c=char_count: self.read_char_count_label.configure(text=f"Characters: {c}"))
+            
+        except asyncio.TimeoutError:
             self.root.after(0, lambda: messagebox.showerror("Timeout", "Operation timed out. Please try again."))
+        except Exception as e:
+            self.root.after(0, lambda e=e: messagebox.showerror("Error", f"Read error: {str(e)}"))
+            
+    def toggle_scan(self):
+        """Start or stop continuous scanning"""
+        if self.scan_session:
+            self.scan_session.stop()
+            self.scan_btn.configure(state="disabled")
+            return
+            
+        try:
+            window = float(self.scan_window_var.get())
+        except ValueError:
+            messagebox.showerror("Error", "Please enter the repeat window in seconds")
+            return
+            
+        self.scan_session = ScanSession(self.serial_link, window)
+        
+        # The link belongs to the scan until it is stopped
+        self.scan_btn.configure(text="Stop Scan")
+        self.read_btn.configure(state="disabled")
+        self.upload_btn.configure(state="disabled")
+        self.batch_start_btn.configure(state="disabled")
+        self.read_log.clear("Scanning... every new card is read as it enters the field.\n")
+        
+        threading.Thread(target=self._scan_thread, args=(self.scan_session,), daemon=True).start()
+        
+    def _scan_thread(self, session):
+        """Continuous scan in separate thread"""
+        def on_card(event):
+            if event.data is None:
+                self.read_log.write(f"Card {event.uid}: {event.status}\n")
+                self._archive(self.read_log, "read", event.uid, b"", None, event.blocks, event.latency_ms, False)
+                return
+            
+            data = event.data
+            decrypted = None
+            if self.decrypt_var.get() and self.decryption_key:
+                data = decrypted = VigenereCipher.decrypt(data, self.decryption_key)
+            self._archive(self.read_log, "read", event.uid, event.data.encode(), decrypted, event.blocks, event.latency_ms, True)
+            self.read_log.write(f"Card {event.uid}: {len(data)} characters\n")
+            self.root.after(0, lambda: self.read_data_text.delete("1.0", "end"))
+            self.root.after(0, lambda: self.read_data_text.insert("1.0", data))
+            self.root.after(0, lambda: self.read_char_count_label.configure(text=f"Characters: {len(data)}"))
+        
+        try:
+            session.run(on_card)
+        except Exception as e:
+            self.root.after(0, lambda e=e: messagebox.showerror("Error", f"Scan error: {str(e)}"))
+        finally:
+            self.root.after(0, self._scan_finished)
+            
+    def _scan_finished(self):
+        """Hand the link back to the single card operations"""
+        suppressed = self.scan_session.suppressed if self.scan_session else 0
+        self.scan_session = None
+        if self.is_connected:
+            self.read_log.write(f"Scan stopped ({suppressed} repeated reads ignored)\n")
+            self.scan_btn.configure(state="normal", text="Start Continuous Scan")
+            self.read_btn.configure(state="normal")
+            self.upload_btn.configure(state="normal")
+            self.batch_start_btn.configure(state="normal")
+        
+    def browse_batch_file(self):
+        """Pick the message file for a batch run"""
+        path = filedialog.askopenfilename(
+            title="Select message file",
+            filetypes=[("CSV or JSONL", "*.csv *.jsonl *.ndjson"), ("All files", "*.*")]
+        )
+        if path:
+            self.batch_file_var.set(path)
+            
+    def start_batch(self):
+        """Start writing one message per card from the selected file"""
+        if not self.is_connected:
+            messagebox.showerror("Error", "Please connect to Arduino first")
+            return
+            
+        path = self.batch_file_var.get()
+        if not path:
+            messagebox.showerror("Error", "Please select a message file")
+            return
+            
+        from batch import BatchProvisioner, read_messages, default_log_path
+        
+        key = self.encryption_key if self.encrypt_var.get() else ""
+        self.batch_provisioner = BatchProvisioner(
+            self.serial_link, key, self.card_type_var.get(), default_log_path(path), compress=self.compress_var.get()
+        )
+        
+        # The link belongs to the batch until it finishes
+        self.batch_start_btn.configure(state="disabled")
+        self.batch_stop_btn.configure(state="normal")
+        self.upload_btn.configure(state="disabled")
+        self.read_btn.configure(state="disabled")
+        self.scan_btn.configure(state="disabled")
+        self.batch_log.clear("Batch armed. Place cards on the reader one after another...\n")
+        self.batch_rate_label.configure(text="Cards: 0 | 0.0 cards/min")
+        
+        threading.Thread(target=self._batch_thread, args=(self.batch_provisioner, read_messages(path)), daemon=True).start()
+        
+    def stop_batch(self):
+        """Stop the batch after the card in progress"""
+        if self.batch_provisioner:
+            self.batch_provisioner.stop()
+            self.batch_stop_btn.configure(state="disabled")
             
+    def _batch_thread(self, provisioner, messages):
+        """Batch run in separate thread"""
+        cards = []
+        
+        def on_card(result, rate):
+            if result.uid:
+                cards.append(result)
+            line = (
+                f"Row {result.row}: {result.uid or '-'} {result.status}, "
+                f"{result.blocks} blocks, {result.latency_ms} ms\n"
+            )
+            count = len(cards)
+            self.batch_log.write(line)
+            self.root.after(0, lambda: self.batch_rate_label.configure(text=f"Cards: {count} | {rate:.1f} cards/min"))
+        
+        try:
+            summary = provisioner.run(messages, on_card=on_card)
+            self.root.after(0, lambda: messagebox.showinfo(
+                "Batch Finished",
+                f"{summary.written} written, {summary.failed} failed, {summary.skipped} skipped.\n"
+                f"Results saved to {provisioner.log_path}"
+            ))
         except Exception as e:
-            self.root.after(0, lambda: messagebox.showerror("Error", f"Read error: {str(e)}"))
+            self.root.after(0, lambda e=e: messagebox.showerror("Error", f"Batch error: {str(e)}"))
+        finally:
+            self.root.after(0, self._batch_finished)
+            
+    def _batch_finished(self):
+        """Hand the link back to the single card operations"""
+        self.batch_provisioner = None
+        self.batch_stop_btn.configure(state="disabled")
+        if self.is_connected:
+            self.batch_start_btn.configure(state="normal")
+            self.upload_btn.configure(state="normal")
+            self.read_btn.configure(state="normal")
+            self.scan_btn.configure(state="normal")
+        
+    def flush_status(self):
+        """Show the lines logged since the last frame, one widget update per pane"""
+        for pane in self.status_panes:
+            pane.flush()
+        if self.spill_file:
+            self.spill_file.flush()
+        self.root.after(FRAME_INTERVAL_MS, self.flush_status)
+        
+    def run_async(self, coroutine):
+        """Schedule coroutine on the client's event loop, started on first use; returns a concurrent Future"""
+        import asyncio
+        if self.loop is None:
+            self.loop = asyncio.new_event_loop()
+            threading.Thread(target=self.loop.run_forever, daemon=True).start()
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+        
+    def _show_result(self, log, result):
+        """Per-block summary and RF statistics of a binary protocol result"""
+        log.write(f"Arduino: {describe_result(result)}\n")
+        log.write(self._rf_plan_note(result.auth_ops, result.blocks_touched))
+        
+    def _rf_plan_note(self, auth_ops, blocks_touched):
+        """Describe what per-sector authentication saved against one authentication per block"""
+        saved = max(blocks_touched - auth_ops, 0)
+        return f"Sector auth reuse: {auth_ops} authentications for {blocks_touched} blocks ({saved} saved)\n"
+        
+    def _show_rf_plan(self, log, line):
+        """Add the savings note when the sketch reports its RF statistics"""
+        match = RF_PLAN_PATTERN.search(line)
+        if match:
+            log.write(self._rf_plan_note(int(match.group(1)), int(match.group(2))))
+        
+    def _archive(self, log, kind, uid, raw, text, blocks, latency_ms, ok):
+        """Add one operation to the card archive and note when the card was last seen"""
+        if uid is None:
+            return  # Sketches before the UID report
+        from datetime import datetime
+        from card_archive import CardArchive, ArchiveError
+        try:
+            if self.archive is None:
+                self.archive = CardArchive()
+            previous = self.archive.last(uid)
+            self.archive.append(kind, uid, raw, text, blocks, latency_ms, ok)
+            self.archive.flush()
+        except (OSError, ValueError, ArchiveError) as e:
+            log.write(f"Card archive unavailable: {e}\n")
+            return
+        seen = f"last seen {datetime.fromtimestamp(previous.timestamp):%Y-%m-%d %H:%M:%S}" if previous else "not seen before"
+        log.write(f"Card {uid}: {seen}\n")
         
     def run(self):
         """Start the application"""
         self.root.mainloop()
+        if self.archive:
+            self.archive.close()
 
 if __name__ == "__main__":
     app = RFIDManager()
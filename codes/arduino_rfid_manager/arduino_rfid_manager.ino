@@ -7,36 +7,257 @@
 MFRC522 mfrc522(SS_PIN, RST_PIN);
 
 String command = "";
-String dataToWrite = "";
 bool waitingForCard = false;
 String currentOperation = "";
 int blocksToWrite = 1;
-int blocksToRead = 15; // Maximum blocks to read
+int blocksToRead = 15; // Maximum blocks to read from cards without a header, READ_MULTI:<n> stops after n blocks
 
-// Block configuration - using multiple sectors
+// Batch provisioning - the reader stays armed and every new card gets the next message
+bool batchMode = false;
+byte lastBatchUid[10];
+byte lastBatchUidSize = 0;
+
+// Block configuration - every data block of the card, sector 0 and trailers excluded
 const int BLOCKS_PER_SECTOR = 4;
 const int DATA_BLOCKS_PER_SECTOR = 3; // Blocks 0, 1, 2 (block 3 is sector trailer)
-const int MAX_SECTORS = 5; // Using first 5 sectors for data
 const int BYTES_PER_BLOCK = 16;
+// MIFARE Classic 4K: sectors 32-39 start at block 128 and have 15 data blocks + trailer
+const int SMALL_SECTOR_COUNT = 32;
+const int LARGE_SECTOR_FIRST_BLOCK = 128;
+const int BLOCKS_PER_LARGE_SECTOR = 16;
+const int DATA_BLOCKS_PER_LARGE_SECTOR = 15;
+const int MINI_DATA_BLOCKS = 4 * DATA_BLOCKS_PER_SECTOR;
+const int CLASSIC_1K_DATA_BLOCKS = 15 * DATA_BLOCKS_PER_SECTOR;
+const int CLASSIC_4K_DATA_BLOCKS = 31 * DATA_BLOCKS_PER_SECTOR + 8 * DATA_BLOCKS_PER_LARGE_SECTOR;
+const int LEGACY_DATA_BLOCKS = 12; // Messages without a header used sectors 1-4
+
+// The message buffer holds a full 1K card on boards with less than 4 KB of RAM and a full 4K card elsewhere
+#if defined(RAMEND) && RAMEND < 0x1000
+const int MAX_DATA_BLOCKS = CLASSIC_1K_DATA_BLOCKS;
+#else
+const int MAX_DATA_BLOCKS = CLASSIC_4K_DATA_BLOCKS;
+#endif
+const int MAX_PAYLOAD = (MAX_DATA_BLOCKS - 1) * BYTES_PER_BLOCK; // The first data block holds the header
+
+// Card header, stored in the first data block (mirrored in card_layout.py):
+// 'K' 'B' | version | flags | length (2, LE) | payload CRC (2, LE) | header CRC (2, LE) | reserved (6)
+const byte LAYOUT_VERSION = 1;
+const int HEADER_CRC_OFFSET = 8;
+int cardDataBlocks = 0; // Usable data blocks of the card in the field
+byte payloadFlags = 0;
+// Header flags for the next write, set by OP_SET_FLAGS (e.g. a compressed payload); the sketch only stores them
+byte nextPayloadFlags = 0;
+
+// Message to write / data read, shared by the text and binary protocols
+byte payload[MAX_PAYLOAD];
+int payloadLength = 0;
+
+// Text commands are short; longer lines are messages and go straight into payload
+const int COMMAND_BUFFER_SIZE = 32;
+char lineBuffer[COMMAND_BUFFER_SIZE + 1];
+
+// Per-block outcome of the last card operation (MFRC522::StatusCode values)
+byte resultBlocks[MAX_DATA_BLOCKS];
+byte resultStatus[MAX_DATA_BLOCKS];
+byte resultCount = 0;
+
+// Per-block code for a message block that was written but read back different
+const byte BLOCK_VERIFY_MISMATCH = 0xFE;
+
+// Write journal: where an interrupted WRITE_MULTI stopped, per card UID, so the
+// same card presented again with the same message resumes at its first
+// unverified block. Entries are reused round robin; a finished write frees its own.
+const byte JOURNAL_ENTRIES = 4;
+struct JournalEntry {
+  byte uid[10];
+  byte uidSize; // 0 for a free entry
+  int payloadLength;
+  uint16_t payloadCrc;
+  byte flags;
+  int lastBlock; // Data blocks the write covers, clearing included (the old header is gone once rewritten)
+  int nextIndex; // First data block not yet written and verified
+};
+JournalEntry journal[JOURNAL_ENTRIES];
+byte nextJournalEntry = 0;
+
+// RF commands issued by the current operation, reported to the client
+MFRC522::MIFARE_Key cardKey;
+int authCount = 0;
+int transferCount = 0;
+int authenticatedSector = -1;
+// Data blocks the operation moved to, each one an authentication for a plan without sector reuse
+int blocksTouched = 0;
+int lastTouchedBlock = -1;
+
+// Serial speed - every session starts at DEFAULT_BAUD and may be raised with BAUD:<rate>
+const long DEFAULT_BAUD = 9600;
+const long SUPPORTED_BAUDS[] = {19200, 38400, 57600, 115200, 230400, 250000, 500000, 1000000};
+const unsigned long BAUD_VERIFY_TIMEOUT = 1000; // ms to wait for the ECHO check at the new rate
+
+// Binary framed protocol (mirrored in frame_protocol.py)
+// SYNC | opcode | length (2, LE) | payload | CRC-16/CCITT-FALSE (2, LE)
+const byte FRAME_SYNC = 0xA5;
+const byte OP_PING = 0x01;
+const byte OP_READ_MULTI = 0x02;
+const byte OP_WRITE_MULTI = 0x03;
+const byte OP_WRITE_DIFF = 0x04;
+const byte OP_BATCH_WRITE = 0x05;
+const byte OP_BATCH_END = 0x06;
+const byte OP_SCAN = 0x07;
+const byte OP_SCAN_END = 0x08;
+const byte OP_SET_FLAGS = 0x09;
+const byte OP_TIMING = 0x0A;
+const byte OP_TEXT_MODE = 0x0F;
+const byte OP_PONG = 0x81;
+const byte OP_READ_RESULT = 0x82;
+const byte OP_WRITE_RESULT = 0x83;
+const byte OP_ARMED = 0x84;
+const byte OP_BATCH_CARD = 0x85;
+const byte OP_BATCH_DONE = 0x86;
+const byte OP_SCAN_CARD = 0x87;
+const byte OP_SCAN_DONE = 0x88;
+const byte OP_PHASE = 0x89;
+const byte OP_QUEUED = 0x8A;
+const byte OP_TEXT_MODE_OK = 0x8F;
+const byte OP_ERROR = 0xFF;
+
+const byte STATUS_OK = 0x00;
+const byte STATUS_PARTIAL = 0x01;
+const byte STATUS_FAILED = 0x02;
+const byte STATUS_NO_DATA = 0x03;
+const byte STATUS_BAD_CRC = 0x04;
+const byte STATUS_TOO_LONG = 0x05;
+const byte STATUS_UNKNOWN_OPCODE = 0x06;
+const byte STATUS_BAD_CHECKSUM = 0x07;
+const byte STATUS_UNSUPPORTED_CARD = 0x08;
+const byte STATUS_QUEUE_FULL = 0x09;
+
+const int MAX_FRAME_ARGS = 16;
+const unsigned long FRAME_TIMEOUT = 200; // ms of silence that discards a partial frame
+
+bool binaryMode = false;
+byte frameHeader[4];
+byte frameArgs[MAX_FRAME_ARGS];
+byte* frameBody = frameArgs;
+unsigned int frameBodyLength = 0;
+unsigned int framePosition = 0;
+uint16_t rxCrc = 0xFFFF;
+uint16_t txCrc = 0xFFFF;
+unsigned long lastFrameByte = 0;
+
+// Job queue (binary protocol): READ_MULTI, WRITE_MULTI and WRITE_DIFF frames that
+// arrive while another of them waits for a card are answered with OP_QUEUED and
+// armed in order as soon as it is done, so the next card needs no round trip.
+// Their data waits in jobBuffer; a job that doesn't fit gets STATUS_QUEUE_FULL.
+#if defined(RAMEND) && RAMEND < 0x1000
+const int JOB_BUFFER_SIZE = 128;
+#else
+const int JOB_BUFFER_SIZE = 1024;
+#endif
+const byte MAX_QUEUED_JOBS = 4;
+// A queued job arrives while the armed one polls for a card, and each poll keeps the sketch away
+// from Serial for up to 25 ms (the RC522 timeout): longer than the RX buffer lasts at 115200 baud.
+// Only write data that fits the RX buffer with its framing and an OP_SET_FLAGS frame (13 bytes) is queued.
+#ifdef SERIAL_RX_BUFFER_SIZE
+const int MAX_QUEUED_DATA = SERIAL_RX_BUFFER_SIZE - 13;
+#else
+const int MAX_QUEUED_DATA = 64 - 13;
+#endif
+byte jobOpcode[MAX_QUEUED_JOBS];
+byte jobArg[MAX_QUEUED_JOBS]; // Blocks to read, or the header flags of a write
+unsigned int jobLength[MAX_QUEUED_JOBS];
+byte queuedJobs = 0;
+byte jobBuffer[JOB_BUFFER_SIZE];
+unsigned int jobBufferUsed = 0;
+
+// Per-phase timing, off until TIMING:1 / OP_TIMING: every phase of an operation
+// is reported when it ends, as T:<phase>:<millis> or an OP_PHASE frame
+bool timingEnabled = false;
+
+// Human readable chatter goes to Serial in text mode and nowhere in binary mode
+class NullPrint : public Print {
+public:
+  size_t write(uint8_t) { return 1; }
+};
+NullPrint nullOut;
+
+Print& out() {
+  if (binaryMode) return nullOut;
+  return Serial;
+}
 
 void setup() {
-  Serial.begin(9600);
+  Serial.begin(DEFAULT_BAUD);
   SPI.begin();
   mfrc522.PCD_Init();
+  for (byte i = 0; i < 6; i++) cardKey.keyByte[i] = 0xFF;
   Serial.println("RFID Manager Ready - Multi-Block Support with Auto-Clear");
   Serial.println("Waiting for commands...");
 }
 
 void loop() {
   // Check for serial commands
-  if (Serial.available() > 0) {
-    String input = Serial.readStringUntil('\n');
+  if (binaryMode) {
+    receiveFrameBytes();
+  }
+  else if (Serial.available() > 0) {
+    int lineLength = Serial.readBytesUntil('\n', lineBuffer, COMMAND_BUFFER_SIZE);
+    lineBuffer[lineLength] = 0;
+    bool expectingMessage = (currentOperation == "WRITE_MULTI" || currentOperation == "WRITE_DIFF" || currentOperation == "WRITE" || currentOperation == "BATCH") && !waitingForCard;
+    String input = lineLength < COMMAND_BUFFER_SIZE ? String(lineBuffer) : String("");
     input.trim();
     
-    if (input == "READ_MULTI") {
+    if (lineLength == COMMAND_BUFFER_SIZE) {
+      // Too long for a command
+      if (expectingMessage) acceptMessage(lineLength);
+      else discardLine();
+    }
+    else if (input == "BATCH_END") {
+      endBatch();
+      Serial.println("BATCH_DONE");
+    }
+    else if (batchMode && expectingMessage) {
+      // Every line is the message for the next card, even one that looks like a command
+      acceptMessage(lineLength);
+    }
+    else if (input == "PING") {
+      // Handshake used by the client instead of a fixed delay after connecting
+      Serial.println("PONG");
+    }
+    else if (input.startsWith("BAUD:")) {
+      negotiateBaud(input.substring(5).toInt());
+    }
+    else if (input.startsWith("TIMING:")) {
+      timingEnabled = input.substring(7).toInt() != 0;
+      Serial.println("TIMING_OK");
+    }
+    else if (input == "BINARY") {
+      // Switch to length-prefixed frames until an OP_TEXT_MODE frame arrives
+      Serial.println("BINARY_OK");
+      Serial.flush();
+      binaryMode = true;
+      framePosition = 0;
+    }
+    else if (input == "BATCH") {
+      // Stay armed: each message line is written to the next new card, no command per card
+      beginBatch();
+      Serial.println("BATCH_OK");
+    }
+    else if (input == "SCAN") {
+      // Continuous reads: every card that enters the field is reported until SCAN_END or another command
+      beginScan();
+      Serial.println("SCAN_OK");
+    }
+    else if (input == "SCAN_END") {
+      endScan();
+      Serial.println("SCAN_DONE");
+    }
+    else if (input == "READ_MULTI" || input.startsWith("READ_MULTI:")) {
       currentOperation = "READ_MULTI";
+      blocksToRead = input.length() > 11 ? input.substring(11).toInt() : LEGACY_DATA_BLOCKS;
       waitingForCard = true;
       Serial.println("Ready to read multiple blocks. Please place card near reader...");
+      markPhase("armed");
     }
     else if (input.startsWith("WRITE_MULTI:")) {
       currentOperation = "WRITE_MULTI";
@@ -45,6 +266,14 @@ void loop() {
       Serial.print(blocksToWrite);
       Serial.println(" blocks. Send message to write...");
     }
+    else if (input.startsWith("WRITE_DIFF:")) {
+      // Like WRITE_MULTI but only rewrites blocks whose content changed
+      currentOperation = "WRITE_DIFF";
+      blocksToWrite = input.substring(11).toInt();
+      Serial.print("Ready to write ");
+      Serial.print(blocksToWrite);
+      Serial.println(" blocks (differential). Send message to write...");
+    }
     else if (input == "READ") {
       // Legacy single block read
       currentOperation = "READ";
@@ -57,17 +286,37 @@ void loop() {
       blocksToWrite = 1;
       Serial.println("Ready to receive data. Send message to write...");
     }
-    else if ((currentOperation == "WRITE_MULTI" || currentOperation == "WRITE") && !waitingForCard) {
-      dataToWrite = input;
-      waitingForCard = true;
-      Serial.print("Ready to write. Message length: ");
-      Serial.print(dataToWrite.length());
-      Serial.println(" characters. Please place card near reader...");
+    else if (expectingMessage) {
+      acceptMessage(lineLength);
     }
   }
   
   // Handle card operations
   if (waitingForCard && mfrc522.PICC_IsNewCardPresent() && mfrc522.PICC_ReadCardSerial()) {
+    markPhase("card");
+    
+    if (currentOperation == "BATCH") {
+      // The card that was just provisioned may be lifted and put back; leave it alone
+      if (!isLastBatchCard()) {
+        writeBatchCard();
+        waitingForCard = false;
+      }
+      mfrc522.PICC_HaltA();
+      mfrc522.PCD_StopCrypto1();
+      return;
+    }
+    
+    // Every other result is preceded by the card's UID, so the client knows which card it came from
+    reportCardUid();
+    
+    if (currentOperation == "SCAN") {
+      // Stays armed for the next card
+      readMultipleBlocks();
+      mfrc522.PICC_HaltA();
+      mfrc522.PCD_StopCrypto1();
+      return;
+    }
+    
     if (currentOperation == "READ" || currentOperation == "READ_MULTI") {
       if (currentOperation == "READ_MULTI") {
         readMultipleBlocks();
@@ -75,88 +324,505 @@ void loop() {
         readSingleBlock();
       }
     }
-    else if (currentOperation == "WRITE" || currentOperation == "WRITE_MULTI") {
+    else if (currentOperation == "WRITE" || currentOperation == "WRITE_MULTI" || currentOperation == "WRITE_DIFF") {
       if (currentOperation == "WRITE_MULTI") {
         writeMultipleBlocks();
+      } else if (currentOperation == "WRITE_DIFF") {
+        writeChangedBlocks();
       } else {
         writeSingleBlock();
       }
     }
     
     waitingForCard = false;
-    currentOperation = "";
+    currentOperation = batchMode ? "BATCH" : "";
+    startNextJob();
     mfrc522.PICC_HaltA();
     mfrc522.PCD_StopCrypto1();
   }
 }
 
-void clearAllDataBlocks() {
-  Serial.println("Clearing all data blocks...");
+// lineBuffer holds the first bytes of the message; the rest of a long line is still in the serial buffer
+void acceptMessage(int prefixLength) {
+  memcpy(payload, lineBuffer, prefixLength);
+  payloadLength = prefixLength;
+  if (prefixLength == COMMAND_BUFFER_SIZE) {
+    payloadLength += Serial.readBytesUntil('\n', (char*)payload + prefixLength, MAX_PAYLOAD - prefixLength);
+    // A full buffer leaves the rest of the line unread; refuse the message rather than write a truncated one
+    if (payloadLength == MAX_PAYLOAD && discardLine() > 0) {
+      payloadLength = 0;
+      if (!batchMode) currentOperation = "";
+      Serial.println("Write failed: Message too long");
+      return;
+    }
+  }
   
-  MFRC522::MIFARE_Key key;
-  for (byte i = 0; i < 6; i++) key.keyByte[i] = 0xFF;
+  // Same whitespace handling as String::trim()
+  int start = 0;
+  while (start < payloadLength && isspace(payload[start])) start++;
+  while (payloadLength > start && isspace(payload[payloadLength - 1])) payloadLength--;
+  payloadLength -= start;
+  memmove(payload, payload + start, payloadLength);
   
-  byte emptyBlock[16];
-  for (byte i = 0; i < 16; i++) emptyBlock[i] = 0; // Fill with zeros
+  payloadFlags = 0;
+  waitingForCard = true;
+  if (!batchMode) {
+    // In batch mode the client streams the next message right after each card
+    Serial.print("Ready to write. Message length: ");
+    Serial.print(payloadLength);
+    Serial.println(" characters. Please place card near reader...");
+  }
+  markPhase("armed");
+}
+
+// Returns how many characters other than whitespace were dropped
+int discardLine() {
+  char c;
+  int dropped = 0;
+  while (Serial.readBytes(&c, 1) == 1 && c != '\n') {
+    if (!isspace(c)) dropped++;
+  }
+  return dropped;
+}
+
+bool isSupportedBaud(long rate) {
+  for (byte i = 0; i < sizeof(SUPPORTED_BAUDS) / sizeof(SUPPORTED_BAUDS[0]); i++) {
+    if (SUPPORTED_BAUDS[i] == rate) return true;
+  }
+  return false;
+}
+
+void negotiateBaud(long rate) {
+  if (!isSupportedBaud(rate)) {
+    Serial.print("BAUD failed: unsupported rate ");
+    Serial.println(rate);
+    return;
+  }
   
-  int blocksCleared = 0;
+  Serial.print("BAUD_OK:");
+  Serial.println(rate);
+  Serial.flush(); // Let the acknowledgement leave at the old rate
+  Serial.end();
+  Serial.begin(rate);
   
-  // Clear all data blocks in all sectors
-  for (int sector = 1; sector < MAX_SECTORS; sector++) {
-    for (int blockInSector = 0; blockInSector < DATA_BLOCKS_PER_SECTOR; blockInSector++) {
-      byte block = sector * BLOCKS_PER_SECTOR + blockInSector;
-      
-      // Authenticate for this sector
-      MFRC522::StatusCode status = mfrc522.PCD_Authenticate(
-        MFRC522::PICC_CMD_MF_AUTH_KEY_A, block, &key, &(mfrc522.uid)
-      );
-      
-      if (status != MFRC522::STATUS_OK) {
-        Serial.print("Clear auth failed for block ");
-        Serial.print(block);
-        Serial.print(": ");
-        Serial.println(mfrc522.GetStatusCodeName(status));
-        continue;
+  // The client must echo a line back at the new rate, otherwise we drop back
+  unsigned long start = millis();
+  while (millis() - start < BAUD_VERIFY_TIMEOUT) {
+    if (Serial.available() > 0) {
+      String line = Serial.readStringUntil('\n');
+      line.trim();
+      if (line.startsWith("ECHO:")) {
+        Serial.println(line);
+        return;
       }
-      
-      status = mfrc522.MIFARE_Write(block, emptyBlock, 16);
-      
-      if (status == MFRC522::STATUS_OK) {
-        blocksCleared++;
+    }
+  }
+  
+  Serial.end();
+  Serial.begin(DEFAULT_BAUD);
+  Serial.print("BAUD_FALLBACK:");
+  Serial.println(DEFAULT_BAUD);
+}
+
+uint16_t crc16Update(uint16_t crc, byte b) {
+  crc ^= (uint16_t)b << 8;
+  for (byte i = 0; i < 8; i++) {
+    crc = (crc & 0x8000) ? (crc << 1) ^ 0x1021 : crc << 1;
+  }
+  return crc;
+}
+
+void beginFrame(byte opcode, unsigned int length) {
+  Serial.write(FRAME_SYNC);
+  txCrc = 0xFFFF;
+  frameByte(opcode);
+  frameByte(length & 0xFF);
+  frameByte(length >> 8);
+}
+
+void frameByte(byte b) {
+  Serial.write(b);
+  txCrc = crc16Update(txCrc, b);
+}
+
+void endFrame() {
+  Serial.write(txCrc & 0xFF);
+  Serial.write(txCrc >> 8);
+}
+
+void sendStatusFrame(byte opcode, byte status) {
+  beginFrame(opcode, 1);
+  frameByte(status);
+  endFrame();
+}
+
+void markPhase(const char* phase) {
+  if (!timingEnabled) return;
+  unsigned long now = millis();
+  if (binaryMode) {
+    // millis (4, LE) | phase name
+    byte length = strlen(phase);
+    beginFrame(OP_PHASE, 4 + length);
+    for (byte i = 0; i < 4; i++) frameByte((now >> (8 * i)) & 0xFF);
+    for (byte i = 0; i < length; i++) frameByte(phase[i]);
+    endFrame();
+    return;
+  }
+  Serial.print("T:");
+  Serial.print(phase);
+  Serial.print(':');
+  Serial.println(now);
+}
+
+// status | auth count (2) | read/write count (2) | block count | (block, status) pairs | data
+void sendResultFrame(byte opcode, byte status, const byte* data, unsigned int dataLength) {
+  beginResultFrame(opcode, status, dataLength);
+  for (unsigned int i = 0; i < dataLength; i++) frameByte(data[i]);
+  endFrame();
+}
+
+// Everything up to the data; the caller sends dataLength bytes and ends the frame
+void beginResultFrame(byte opcode, byte status, unsigned int dataLength) {
+  beginFrame(opcode, 8 + 2 * resultCount + dataLength);
+  frameByte(status);
+  frameByte(authCount & 0xFF);
+  frameByte(authCount >> 8);
+  frameByte(transferCount & 0xFF);
+  frameByte(transferCount >> 8);
+  frameByte(blocksTouched & 0xFF);
+  frameByte(blocksTouched >> 8);
+  frameByte(resultCount);
+  for (byte i = 0; i < resultCount; i++) {
+    frameByte(resultBlocks[i]);
+    frameByte(resultStatus[i]);
+  }
+}
+
+void recordBlockResult(byte block, MFRC522::StatusCode status) {
+  if (resultCount < MAX_DATA_BLOCKS) {
+    resultBlocks[resultCount] = block;
+    resultStatus[resultCount] = status;
+    resultCount++;
+  }
+}
+
+byte operationStatus(int blocksDone) {
+  if (blocksDone == 0) return STATUS_FAILED;
+  if (blocksDone < resultCount) return STATUS_PARTIAL;
+  return STATUS_OK;
+}
+
+void receiveFrameBytes() {
+  // Drop a partial frame if the sender went quiet in the middle of it
+  if (framePosition > 0 && millis() - lastFrameByte > FRAME_TIMEOUT) {
+    framePosition = 0;
+  }
+  
+  while (Serial.available() > 0) {
+    byte b = Serial.read();
+    lastFrameByte = millis();
+    
+    if (framePosition == 0) {
+      if (b == FRAME_SYNC) framePosition = 1; // Anything else is noise, resync on SYNC
+      continue;
+    }
+    
+    if (framePosition < 4) {
+      frameHeader[framePosition++] = b;
+      rxCrc = crc16Update(framePosition == 2 ? 0xFFFF : rxCrc, b);
+      if (framePosition == 4) {
+        frameBodyLength = frameHeader[2] | (frameHeader[3] << 8);
+        // Message data is received straight into the payload buffer, or behind
+        // the queued jobs' while another job is armed (nowhere if it won't fit)
+        bool carriesData = frameHeader[1] == OP_WRITE_MULTI || frameHeader[1] == OP_WRITE_DIFF || frameHeader[1] == OP_BATCH_WRITE;
+        bool queued = carriesData && frameHeader[1] != OP_BATCH_WRITE && jobArmed();
+        frameBody = carriesData ? payload : frameArgs;
+        if (queued) {
+          bool fits = queuedJobs < MAX_QUEUED_JOBS && frameBodyLength <= JOB_BUFFER_SIZE - jobBufferUsed;
+          frameBody = fits ? jobBuffer + jobBufferUsed : NULL;
+        }
+        if (frameBodyLength > (carriesData ? MAX_PAYLOAD : MAX_FRAME_ARGS)) {
+          sendStatusFrame(OP_ERROR, STATUS_TOO_LONG);
+          framePosition = 0;
+        }
+        else if (queued && frameBodyLength > MAX_QUEUED_DATA) {
+          // Part of it may already be lost; the client sends it again once the reader is idle
+          sendStatusFrame(OP_ERROR, STATUS_QUEUE_FULL);
+          framePosition = 0;
+        }
+      }
+      continue;
+    }
+    
+    unsigned int bodyIndex = framePosition - 4;
+    framePosition++;
+    if (bodyIndex < frameBodyLength) {
+      if (frameBody != NULL) frameBody[bodyIndex] = b;
+      rxCrc = crc16Update(rxCrc, b);
+    }
+    else if (bodyIndex == frameBodyLength) {
+      rxCrc ^= b; // Low byte of the received CRC
+    }
+    else {
+      rxCrc ^= (uint16_t)b << 8;
+      framePosition = 0;
+      if (rxCrc == 0) {
+        handleFrame(frameHeader[1]);
       } else {
-        Serial.print("Clear failed for block ");
-        Serial.print(block);
-        Serial.print(": ");
-        Serial.println(mfrc522.GetStatusCodeName(status));
+        if (frameBody == payload) {
+          // The armed write buffer was overwritten by a corrupt frame
+          waitingForCard = false;
+          currentOperation = "";
+        }
+        sendStatusFrame(OP_ERROR, STATUS_BAD_CRC);
       }
     }
   }
+}
+
+void handleFrame(byte opcode) {
+  if (opcode == OP_PING) {
+    beginFrame(OP_PONG, 0);
+    endFrame();
+  }
+  else if (opcode == OP_READ_MULTI || opcode == OP_WRITE_MULTI || opcode == OP_WRITE_DIFF) {
+    // Reads take an optional argument: the number of blocks the client expects
+    byte arg = nextPayloadFlags;
+    unsigned int length = frameBodyLength;
+    if (opcode == OP_READ_MULTI) {
+      arg = frameBodyLength > 0 ? frameArgs[0] : LEGACY_DATA_BLOCKS;
+      length = 0;
+    }
+    else {
+      nextPayloadFlags = 0;
+    }
+    
+    // A write goes where its data was received
+    bool queue = opcode == OP_READ_MULTI ? jobArmed() : frameBody != payload;
+    if (!queue) {
+      armJob(opcode, arg, length);
+      sendStatusFrame(OP_ARMED, STATUS_OK);
+      markPhase("armed");
+    }
+    else if (frameBody == NULL || queuedJobs == MAX_QUEUED_JOBS) {
+      sendStatusFrame(OP_ERROR, STATUS_QUEUE_FULL);
+    }
+    else {
+      // The data is already in place behind the other queued jobs'
+      jobOpcode[queuedJobs] = opcode;
+      jobArg[queuedJobs] = arg;
+      jobLength[queuedJobs] = length;
+      jobBufferUsed += length;
+      queuedJobs++;
+      sendStatusFrame(OP_QUEUED, queuedJobs);
+      // The armed job may have finished while this frame was coming in
+      if (!jobArmed()) startNextJob();
+    }
+  }
+  else if (opcode == OP_BATCH_WRITE) {
+    // Message for the next new card; the reader stays in batch mode until OP_BATCH_END
+    if (!batchMode) beginBatch();
+    currentOperation = "BATCH";
+    payloadLength = frameBodyLength;
+    payloadFlags = nextPayloadFlags;
+    nextPayloadFlags = 0;
+    blocksToWrite = blocksForLength(payloadLength);
+    waitingForCard = true;
+    sendStatusFrame(OP_ARMED, STATUS_OK);
+    markPhase("armed");
+  }
+  else if (opcode == OP_BATCH_END) {
+    endBatch();
+    beginFrame(OP_BATCH_DONE, 0);
+    endFrame();
+  }
+  else if (opcode == OP_SCAN) {
+    beginScan();
+    sendStatusFrame(OP_ARMED, STATUS_OK);
+  }
+  else if (opcode == OP_SCAN_END) {
+    endScan();
+    beginFrame(OP_SCAN_DONE, 0);
+    endFrame();
+  }
+  else if (opcode == OP_SET_FLAGS) {
+    // No reply: the write frame that follows carries the answer
+    nextPayloadFlags = frameBodyLength > 0 ? frameArgs[0] : 0;
+  }
+  else if (opcode == OP_TIMING) {
+    // No reply, like OP_SET_FLAGS
+    timingEnabled = frameBodyLength > 0 && frameArgs[0] != 0;
+  }
+  else if (opcode == OP_TEXT_MODE) {
+    // Queued jobs belong to the binary session
+    clearJobs();
+    beginFrame(OP_TEXT_MODE_OK, 0);
+    endFrame();
+    Serial.flush();
+    binaryMode = false;
+  }
+  else {
+    sendStatusFrame(OP_ERROR, STATUS_UNKNOWN_OPCODE);
+  }
+}
+
+// RF transaction planner - multi-block operations walk the data blocks in
+// sector order and authenticate once per sector instead of before every block
+MFRC522::StatusCode authenticateBlock(byte block) {
+  if (block != lastTouchedBlock) {
+    blocksTouched++;
+    lastTouchedBlock = block;
+  }
+  int sector = sectorOfBlock(block);
+  if (sector == authenticatedSector) return MFRC522::STATUS_OK;
   
-  Serial.print("Cleared ");
-  Serial.print(blocksCleared);
-  Serial.println(" data blocks");
+  MFRC522::StatusCode status = mfrc522.PCD_Authenticate(
+    MFRC522::PICC_CMD_MF_AUTH_KEY_A, block, &cardKey, &(mfrc522.uid)
+  );
+  authCount++;
+  authenticatedSector = status == MFRC522::STATUS_OK ? sector : -1;
+  return status;
+}
+
+MFRC522::StatusCode readBlock(byte block, byte* buffer) {
+  byte size = 18;
+  MFRC522::StatusCode status = mfrc522.MIFARE_Read(block, buffer, &size);
+  transferCount++;
+  // A failed command drops the card out of the authenticated state
+  if (status != MFRC522::STATUS_OK) authenticatedSector = -1;
+  return status;
+}
+
+MFRC522::StatusCode writeBlock(byte block, byte* data) {
+  MFRC522::StatusCode status = mfrc522.MIFARE_Write(block, data, 16);
+  transferCount++;
+  if (status != MFRC522::STATUS_OK) authenticatedSector = -1;
+  return status;
+}
+
+void beginRfPlan() {
+  authCount = 0;
+  transferCount = 0;
+  authenticatedSector = -1;
+  blocksTouched = 0;
+  lastTouchedBlock = -1;
+  resultCount = 0;
+}
+
+// Block number of the n-th data block (sector trailers and sector 0 are skipped)
+byte dataBlockNumber(int index) {
+  const int smallDataBlocks = (SMALL_SECTOR_COUNT - 1) * DATA_BLOCKS_PER_SECTOR;
+  if (index < smallDataBlocks) {
+    return (index / DATA_BLOCKS_PER_SECTOR + 1) * BLOCKS_PER_SECTOR + index % DATA_BLOCKS_PER_SECTOR;
+  }
+  index -= smallDataBlocks;
+  return LARGE_SECTOR_FIRST_BLOCK + (index / DATA_BLOCKS_PER_LARGE_SECTOR) * BLOCKS_PER_LARGE_SECTOR
+    + index % DATA_BLOCKS_PER_LARGE_SECTOR;
+}
+
+int sectorOfBlock(byte block) {
+  if (block < LARGE_SECTOR_FIRST_BLOCK) return block / BLOCKS_PER_SECTOR;
+  return SMALL_SECTOR_COUNT + (block - LARGE_SECTOR_FIRST_BLOCK) / BLOCKS_PER_LARGE_SECTOR;
+}
+
+// Data blocks usable on the card in the field, limited by the message buffer
+int detectCardDataBlocks() {
+  int blocks = 0;
+  switch (mfrc522.PICC_GetType(mfrc522.uid.sak)) {
+    case MFRC522::PICC_TYPE_MIFARE_MINI: blocks = MINI_DATA_BLOCKS; break;
+    case MFRC522::PICC_TYPE_MIFARE_1K: blocks = CLASSIC_1K_DATA_BLOCKS; break;
+    case MFRC522::PICC_TYPE_MIFARE_4K: blocks = CLASSIC_4K_DATA_BLOCKS; break;
+    default: blocks = 0; // Not a MIFARE Classic card
+  }
+  return min(blocks, MAX_DATA_BLOCKS);
+}
+
+// Header block plus the blocks holding length bytes of payload
+int blocksForLength(int length) {
+  return 1 + (length + BYTES_PER_BLOCK - 1) / BYTES_PER_BLOCK;
+}
+
+uint16_t crc16(const byte* data, int length) {
+  uint16_t crc = 0xFFFF;
+  for (int i = 0; i < length; i++) crc = crc16Update(crc, data[i]);
+  return crc;
+}
+
+void buildHeader(byte* header) {
+  uint16_t payloadCrc = crc16(payload, payloadLength);
+  for (byte i = 0; i < 16; i++) header[i] = 0;
+  header[0] = 'K';
+  header[1] = 'B';
+  header[2] = LAYOUT_VERSION;
+  header[3] = payloadFlags;
+  header[4] = payloadLength & 0xFF;
+  header[5] = payloadLength >> 8;
+  header[6] = payloadCrc & 0xFF;
+  header[7] = payloadCrc >> 8;
+  uint16_t headerCrc = crc16(header, HEADER_CRC_OFFSET);
+  header[8] = headerCrc & 0xFF;
+  header[9] = headerCrc >> 8;
+}
+
+// Returns the payload length stored in a valid header, or -1 for cards without one
+int parseHeader(const byte* header, uint16_t* payloadCrc, byte* flags) {
+  if (header[0] != 'K' || header[1] != 'B' || header[2] != LAYOUT_VERSION) return -1;
+  uint16_t headerCrc = header[8] | (header[9] << 8);
+  if (crc16(header, HEADER_CRC_OFFSET) != headerCrc) return -1;
+  *flags = header[3];
+  *payloadCrc = header[6] | (header[7] << 8);
+  return header[4] | (header[5] << 8);
+}
+
+// Blocks in use by the message currently on the card, from its header
+// (cards written before the header layout used at most LEGACY_DATA_BLOCKS)
+int storedMessageBlocks(const byte* header) {
+  uint16_t storedCrc;
+  byte storedFlags;
+  int storedLength = parseHeader(header, &storedCrc, &storedFlags);
+  if (storedLength < 0) return isEmptyBlock(header) ? 0 : LEGACY_DATA_BLOCKS;
+  return blocksForLength(storedLength);
+}
+
+void reportBlockFailure(const char* what, byte block, MFRC522::StatusCode status) {
+  out().print(what);
+  out().print(" failed for block ");
+  out().print(block);
+  out().print(": ");
+  if (status == BLOCK_VERIFY_MISMATCH) out().println("Data read back differs");
+  else out().println(mfrc522.GetStatusCodeName(status));
+}
+
+void reportRfPlan() {
+  out().print("RF: ");
+  out().print(authCount);
+  out().print(" auth, ");
+  out().print(transferCount);
+  out().print(" read/write commands on ");
+  out().print(blocksTouched);
+  out().println(" blocks");
 }
 
 void readSingleBlock() {
   byte block = 4;
   byte buffer[18];
   byte size = sizeof(buffer);
-
+  
   MFRC522::MIFARE_Key key;
   for (byte i = 0; i < 6; i++) key.keyByte[i] = 0xFF;
-
+  
   MFRC522::StatusCode status = mfrc522.PCD_Authenticate(
     MFRC522::PICC_CMD_MF_AUTH_KEY_A, block, &key, &(mfrc522.uid)
   );
-
+  
   if (status != MFRC522::STATUS_OK) {
     Serial.print("Read failed: Authentication error - ");
     Serial.println(mfrc522.GetStatusCodeName(status));
     return;
   }
-
+  
   status = mfrc522.MIFARE_Read(block, buffer, &size);
-
+  
   if (status == MFRC522::STATUS_OK) {
     Serial.print("DATA:");
     for (byte i = 0; i < 16; i++) {
@@ -173,69 +839,146 @@ void readSingleBlock() {
 }
 
 void readMultipleBlocks() {
-  String fullData = "";
-  MFRC522::MIFARE_Key key;
-  for (byte i = 0; i < 6; i++) key.keyByte[i] = 0xFF;
+  payloadLength = 0;
+  payloadFlags = 0;
+  beginRfPlan();
+  int blocksRead = 0;
+  bool checksumOk = true;
+  cardDataBlocks = detectCardDataBlocks();
   
-  Serial.println("Reading multiple blocks...");
+  if (cardDataBlocks == 0) {
+    if (binaryMode) sendResultFrame(OP_READ_RESULT, STATUS_UNSUPPORTED_CARD, NULL, 0);
+    else Serial.println("Read failed: Unsupported card type");
+    return;
+  }
   
-  // Read from multiple sectors and blocks
-  for (int sector = 1; sector < MAX_SECTORS; sector++) {
-    for (int blockInSector = 0; blockInSector < DATA_BLOCKS_PER_SECTOR; blockInSector++) {
-      byte block = sector * BLOCKS_PER_SECTOR + blockInSector;
-      byte buffer[18];
-      byte size = sizeof(buffer);
-      
-      // Authenticate for this sector
-      MFRC522::StatusCode status = mfrc522.PCD_Authenticate(
-        MFRC522::PICC_CMD_MF_AUTH_KEY_A, block, &key, &(mfrc522.uid)
-      );
+  out().println("Reading multiple blocks...");
+  
+  // The header block says exactly how many blocks follow
+  byte header[18];
+  byte headerBlock = dataBlockNumber(0);
+  MFRC522::StatusCode status = authenticateBlock(headerBlock);
+  if (status == MFRC522::STATUS_OK) status = readBlock(headerBlock, header);
+  recordBlockResult(headerBlock, status);
+  markPhase("header");
+  
+  if (status != MFRC522::STATUS_OK) {
+    reportBlockFailure("Read", headerBlock, status);
+  }
+  else {
+    uint16_t storedCrc;
+    int storedLength = parseHeader(header, &storedCrc, &payloadFlags);
+    
+    if (storedLength >= 0) {
+      int plannedBlocks = blocksForLength(storedLength);
+      out().print("Layout v");
+      out().print(LAYOUT_VERSION);
+      out().print(": ");
+      out().print(storedLength);
+      out().print(" bytes in ");
+      out().print(plannedBlocks);
+      out().println(" blocks");
       
-      if (status != MFRC522::STATUS_OK) {
-        Serial.print("Auth failed for block ");
-        Serial.print(block);
-        Serial.print(": ");
-        Serial.println(mfrc522.GetStatusCodeName(status));
-        continue;
+      if (plannedBlocks > cardDataBlocks) {
+        out().println("Header length exceeds card capacity");
+        checksumOk = false;
       }
-      
-      status = mfrc522.MIFARE_Read(block, buffer, &size);
-      
-      if (status == MFRC522::STATUS_OK) {
-        // Check if block contains data (not all zeros)
-        bool hasData = false;
-        for (byte i = 0; i < 16; i++) {
-          if (buffer[i] != 0) {
-            hasData = true;
+      else {
+        blocksRead++;
+        for (int index = 1; index < plannedBlocks; index++) {
+          byte block = dataBlockNumber(index);
+          byte buffer[18];
+          
+          status = authenticateBlock(block);
+          if (status == MFRC522::STATUS_OK) status = readBlock(block, buffer);
+          recordBlockResult(block, status);
+          if (status != MFRC522::STATUS_OK) {
+            reportBlockFailure("Read", block, status);
+            checksumOk = false;
             break;
           }
+          
+          blocksRead++;
+          int chunk = min(BYTES_PER_BLOCK, storedLength - payloadLength);
+          memcpy(payload + payloadLength, buffer, chunk);
+          payloadLength += chunk;
         }
+        checksumOk = checksumOk && crc16(payload, payloadLength) == storedCrc;
+      }
+    }
+    else if (!isEmptyBlock(header)) {
+      // No header: the layout used before, scan until the first empty block
+      blocksRead++;
+      memcpy(payload, header, BYTES_PER_BLOCK);
+      payloadLength = BYTES_PER_BLOCK;
+      int plannedBlocks = constrain(blocksToRead, 1, min(LEGACY_DATA_BLOCKS, cardDataBlocks));
+      
+      for (int index = 1; index < plannedBlocks; index++) {
+        byte block = dataBlockNumber(index);
+        byte buffer[18];
         
-        if (hasData) {
-          for (byte i = 0; i < 16; i++) {
-            if (buffer[i] != 0) {
-              fullData += (char)buffer[i];
-            }
-          }
-        } else {
-          // If we hit an empty block, we've reached the end of data
-          goto read_complete;
+        status = authenticateBlock(block);
+        if (status == MFRC522::STATUS_OK) status = readBlock(block, buffer);
+        if (status != MFRC522::STATUS_OK) {
+          recordBlockResult(block, status);
+          reportBlockFailure("Read", block, status);
+          continue;
         }
-      } else {
-        Serial.print("Read failed for block ");
-        Serial.print(block);
-        Serial.print(": ");
-        Serial.println(mfrc522.GetStatusCodeName(status));
+        
+        // If we hit an empty block, we've reached the end of data
+        if (isEmptyBlock(buffer)) break;
+        
+        recordBlockResult(block, status);
+        blocksRead++;
+        memcpy(payload + payloadLength, buffer, BYTES_PER_BLOCK);
+        payloadLength += BYTES_PER_BLOCK;
       }
+      
+      // The last block is zero padded
+      while (payloadLength > 0 && payload[payloadLength - 1] == 0) payloadLength--;
     }
   }
   
-  read_complete:
-  if (fullData.length() > 0) {
+  markPhase("data");
+  reportRfPlan();
+  
+  if (binaryMode) {
+    // Read result data: header flags, then the payload
+    byte result = !checksumOk ? STATUS_BAD_CHECKSUM : (payloadLength > 0 ? operationStatus(blocksRead) : STATUS_NO_DATA);
+    beginResultFrame(OP_READ_RESULT, result, 1 + payloadLength);
+    frameByte(payloadFlags);
+    for (int i = 0; i < payloadLength; i++) frameByte(payload[i]);
+    endFrame();
+  }
+  else if (!checksumOk) {
+    Serial.println("Read failed: Checksum mismatch");
+  }
+  else if (payloadLength > 0 && payloadFlags != 0) {
+    // Flagged (compressed) payloads are binary: DATA_HEX:<flags>:<hex>
+    Serial.print("DATA_HEX:");
+    Serial.print(payloadFlags);
+    Serial.print(':');
+    for (int i = 0; i < payloadLength; i++) {
+      if (payload[i] < 0x10) Serial.print('0');
+      Serial.print(payload[i], HEX);
+    }
+    Serial.println();
+    Serial.print("Read successful! Total bytes: ");
+    Serial.println(payloadLength);
+  }
+  else if (payloadLength > 0) {
+    // The text protocol can't carry NUL bytes
+    int characters = 0;
     Serial.print("DATA:");
-    Serial.println(fullData);
+    for (int i = 0; i < payloadLength; i++) {
+      if (payload[i] != 0) {
+        Serial.write(payload[i]);
+        characters++;
+      }
+    }
+    Serial.println();
     Serial.print("Read successful! Total characters: ");
-    Serial.println(fullData.length());
+    Serial.println(characters);
   } else {
     Serial.println("Read failed: No data found");
   }
@@ -251,35 +994,35 @@ void writeSingleBlock() {
   
   MFRC522::MIFARE_Key key;
   for (byte i = 0; i < 6; i++) key.keyByte[i] = 0xFF;
-
+  
   // Clear the block first
   MFRC522::StatusCode status = mfrc522.PCD_Authenticate(
     MFRC522::PICC_CMD_MF_AUTH_KEY_A, block, &key, &(mfrc522.uid)
   );
-
+  
   if (status == MFRC522::STATUS_OK) {
     mfrc522.MIFARE_Write(block, emptyBlock, 16);
     Serial.println("Block cleared");
   }
-
+  
   // Now write the new data
   byte dataBlock[16];
   for (byte i = 0; i < 16; i++) {
-    dataBlock[i] = (i < dataToWrite.length()) ? dataToWrite[i] : 0;
+    dataBlock[i] = (i < payloadLength) ? payload[i] : 0;
   }
-
+  
   status = mfrc522.PCD_Authenticate(
     MFRC522::PICC_CMD_MF_AUTH_KEY_A, block, &key, &(mfrc522.uid)
   );
-
+  
   if (status != MFRC522::STATUS_OK) {
     Serial.print("Write failed: Authentication error - ");
     Serial.println(mfrc522.GetStatusCodeName(status));
     return;
   }
-
+  
   status = mfrc522.MIFARE_Write(block, dataBlock, 16);
-
+  
   if (status == MFRC522::STATUS_OK) {
     Serial.println("Write successful!");
   } else {
@@ -287,76 +1030,501 @@ void writeSingleBlock() {
     Serial.println(mfrc522.GetStatusCodeName(status));
   }
   
-  dataToWrite = "";
+  payloadLength = 0;
 }
 
-void writeMultipleBlocks() {
-  // First, clear all data blocks
-  clearAllDataBlocks();
+// Checks that the message fits the card in the field; reports the failure otherwise
+bool checkCapacity(int blocksNeeded) {
+  cardDataBlocks = detectCardDataBlocks();
+  if (cardDataBlocks == 0) {
+    if (binaryMode) sendResultFrame(OP_WRITE_RESULT, STATUS_UNSUPPORTED_CARD, NULL, 0);
+    else Serial.println("Write failed: Unsupported card type");
+    return false;
+  }
+  if (blocksNeeded > cardDataBlocks) {
+    if (binaryMode) {
+      sendResultFrame(OP_WRITE_RESULT, STATUS_TOO_LONG, NULL, 0);
+    } else {
+      Serial.print("Write failed: Message too long for this card (capacity ");
+      Serial.print((cardDataBlocks - 1) * BYTES_PER_BLOCK);
+      Serial.println(" bytes)");
+    }
+    return false;
+  }
+  return true;
+}
+
+// Journal entry of an interrupted write of the current message to the card in the field, or -1
+int findJournalEntry() {
+  uint16_t payloadCrc = crc16(payload, payloadLength);
+  for (byte i = 0; i < JOURNAL_ENTRIES; i++) {
+    if (journal[i].uidSize == mfrc522.uid.size && memcmp(journal[i].uid, mfrc522.uid.uidByte, journal[i].uidSize) == 0
+        && journal[i].payloadLength == payloadLength && journal[i].payloadCrc == payloadCrc && journal[i].flags == payloadFlags) {
+      return i;
+    }
+  }
+  return -1;
+}
+
+// Remembers (or forgets, with nextIndex 0) how far the write of the current message to the card in the field got
+void updateJournal(int entry, int lastBlock, int nextIndex) {
+  if (entry < 0) {
+    if (nextIndex == 0) return;
+    entry = nextJournalEntry;
+    nextJournalEntry = (nextJournalEntry + 1) % JOURNAL_ENTRIES;
+  }
+  if (nextIndex == 0) {
+    journal[entry].uidSize = 0;
+    return;
+  }
+  journal[entry].uidSize = mfrc522.uid.size;
+  memcpy(journal[entry].uid, mfrc522.uid.uidByte, mfrc522.uid.size);
+  journal[entry].payloadLength = payloadLength;
+  journal[entry].payloadCrc = crc16(payload, payloadLength);
+  journal[entry].flags = payloadFlags;
+  journal[entry].lastBlock = lastBlock;
+  journal[entry].nextIndex = nextIndex;
+}
+
+// Reads a block back after writing it; BLOCK_VERIFY_MISMATCH when it holds something else
+MFRC522::StatusCode verifyBlock(byte block, const byte* expected) {
+  byte buffer[18];
+  MFRC522::StatusCode status = readBlock(block, buffer);
+  if (status != MFRC522::STATUS_OK) return status;
+  if (memcmp(buffer, expected, 16) != 0) return (MFRC522::StatusCode)BLOCK_VERIFY_MISMATCH;
+  return MFRC522::STATUS_OK;
+}
+
+// Returns the operation status (STATUS_OK when every message block was written and verified)
+byte writeMultipleBlocks() {
+  // One pass: header, message blocks, then the blocks the previous message
+  // used are cleared, so no block is written twice. Every message block is
+  // read back. The pass stops at the first failure (usually the card leaving
+  // the field) and the journal keeps its place for the next attempt.
+  beginRfPlan();
+  int blocksNeeded = blocksForLength(payloadLength);
+  if (!checkCapacity(blocksNeeded)) {
+    payloadLength = 0;
+    return cardDataBlocks == 0 ? STATUS_UNSUPPORTED_CARD : STATUS_TOO_LONG;
+  }
   
-  MFRC522::MIFARE_Key key;
-  for (byte i = 0; i < 6; i++) key.keyByte[i] = 0xFF;
+  out().print("Writing ");
+  out().print(payloadLength);
+  out().println(" characters to multiple blocks...");
   
-  Serial.print("Writing ");
-  Serial.print(dataToWrite.length());
-  Serial.println(" characters to multiple blocks...");
+  // The old header tells how far the previous message reached; the new one
+  // on the card means an interrupted write of this message can resume
+  byte header[16];
+  byte stored[18];
+  byte headerBlock = dataBlockNumber(0);
+  int previousBlocks = LEGACY_DATA_BLOCKS;
+  buildHeader(header);
+  int entry = findJournalEntry();
+  int firstIndex = 0;
+  int lastBlock = 0;
+  if (authenticateBlock(headerBlock) == MFRC522::STATUS_OK && readBlock(headerBlock, stored) == MFRC522::STATUS_OK) {
+    previousBlocks = storedMessageBlocks(stored);
+    if (entry >= 0 && memcmp(stored, header, 16) == 0) {
+      firstIndex = journal[entry].nextIndex;
+      lastBlock = journal[entry].lastBlock;
+    }
+  }
+  markPhase("header");
+  if (firstIndex > 0) {
+    out().print("Resuming at data block ");
+    out().print(firstIndex);
+    out().print(" (block ");
+    out().print(dataBlockNumber(firstIndex));
+    out().println(")");
+  }
+  else {
+    lastBlock = max(blocksNeeded, min(previousBlocks, cardDataBlocks));
+  }
   
-  int dataIndex = 0;
   int blocksWritten = 0;
+  int blocksCleared = 0;
+  bool dataMarked = false;
+  int index = firstIndex;
   
-  // Write to multiple sectors and blocks
-  for (int sector = 1; sector < MAX_SECTORS && dataIndex < dataToWrite.length(); sector++) {
-    for (int blockInSector = 0; blockInSector < DATA_BLOCKS_PER_SECTOR && dataIndex < dataToWrite.length(); blockInSector++) {
-      byte block = sector * BLOCKS_PER_SECTOR + blockInSector;
-      byte dataBlock[16];
-      
-      // Prepare data block
+  for (; index < lastBlock; index++) {
+    if (index >= blocksNeeded && !dataMarked) {
+      markPhase("data");
+      dataMarked = true;
+    }
+    byte block = dataBlockNumber(index);
+    bool inMessage = index < blocksNeeded;
+    byte dataBlock[16];
+    
+    // Prepare data block (all zeros past the end of the message)
+    if (index == 0) {
+      memcpy(dataBlock, header, 16);
+    } else {
+      int dataIndex = (index - 1) * BYTES_PER_BLOCK;
       for (byte i = 0; i < 16; i++) {
-        if (dataIndex < dataToWrite.length()) {
-          dataBlock[i] = dataToWrite[dataIndex++];
-        } else {
-          dataBlock[i] = 0; // Pad with zeros
-        }
-      }
-      
-      // Authenticate for this sector
-      MFRC522::StatusCode status = mfrc522.PCD_Authenticate(
-        MFRC522::PICC_CMD_MF_AUTH_KEY_A, block, &key, &(mfrc522.uid)
-      );
-      
-      if (status != MFRC522::STATUS_OK) {
-        Serial.print("Auth failed for block ");
-        Serial.print(block);
-        Serial.print(": ");
-        Serial.println(mfrc522.GetStatusCodeName(status));
-        continue;
-      }
-      
-      status = mfrc522.MIFARE_Write(block, dataBlock, 16);
-      
-      if (status == MFRC522::STATUS_OK) {
-        blocksWritten++;
-        Serial.print("Block ");
-        Serial.print(block);
-        Serial.println(" written successfully");
-      } else {
-        Serial.print("Write failed for block ");
-        Serial.print(block);
-        Serial.print(": ");
-        Serial.println(mfrc522.GetStatusCodeName(status));
+        dataBlock[i] = dataIndex + i < payloadLength ? payload[dataIndex + i] : 0;
       }
     }
+    
+    const char* failed = inMessage ? "Auth" : "Clear auth";
+    MFRC522::StatusCode status = authenticateBlock(block);
+    if (status == MFRC522::STATUS_OK) {
+      failed = inMessage ? "Write" : "Clear";
+      status = writeBlock(block, dataBlock);
+    }
+    if (status == MFRC522::STATUS_OK && inMessage) {
+      blocksWritten++;
+      failed = "Verify";
+      status = verifyBlock(block, dataBlock);
+    }
+    if (inMessage) recordBlockResult(block, status);
+    
+    if (status != MFRC522::STATUS_OK) {
+      reportBlockFailure(failed, block, status);
+      break;
+    }
+    if (inMessage) {
+      out().print("Block ");
+      out().print(block);
+      out().println(" written and verified");
+    }
+    else {
+      blocksCleared++;
+    }
   }
   
-  if (blocksWritten > 0) {
+  if (!dataMarked) markPhase("data");
+  markPhase("clear");
+  
+  out().print("Cleared ");
+  out().print(blocksCleared);
+  out().println(" data blocks");
+  reportRfPlan();
+  
+  // A pass that didn't get the header onto the card leaves the journal as it was
+  if (index > 0) updateJournal(entry, lastBlock, index < lastBlock ? index : 0);
+  int blocksVerified = min(index, blocksNeeded);
+  byte result = STATUS_FAILED;
+  if (blocksVerified == blocksNeeded) result = STATUS_OK;
+  else if (blocksVerified > 0) result = STATUS_PARTIAL;
+  
+  if (binaryMode) {
+    // Data: blocks needed | blocks verified | resumed at (data block index) | blocks written by this pass
+    byte progress[4] = {(byte)blocksNeeded, (byte)blocksVerified, (byte)firstIndex, (byte)blocksWritten};
+    sendResultFrame(OP_WRITE_RESULT, result, progress, 4);
+  }
+  else if (result == STATUS_OK) {
     Serial.print("Write successful! ");
     Serial.print(blocksWritten);
     Serial.print(" blocks written, ");
-    Serial.print(dataToWrite.length());
+    Serial.print(blocksVerified);
+    Serial.print(" verified, ");
+    Serial.print(payloadLength);
     Serial.println(" characters total.");
-  } else {
-    Serial.println("Write failed: No blocks written");
+  }
+  else {
+    Serial.print("Write failed: ");
+    Serial.print(blocksVerified);
+    Serial.print(" of ");
+    Serial.print(blocksNeeded);
+    Serial.print(" blocks verified (");
+    Serial.print(blocksWritten);
+    Serial.print(" written)");
+    if (blocksVerified > 0) {
+      Serial.print(", present card ");
+      printUid();
+      Serial.print(" again to resume");
+    }
+    Serial.println();
+  }
+  
+  payloadLength = 0;
+  return result;
+}
+
+// Whether a job that more jobs can queue behind waits for a card
+bool jobArmed() {
+  return waitingForCard && (currentOperation == "READ_MULTI" || currentOperation == "WRITE_MULTI" || currentOperation == "WRITE_DIFF");
+}
+
+// Arms a READ_MULTI, WRITE_MULTI or WRITE_DIFF job; a write's data is already in payload
+void armJob(byte opcode, byte arg, unsigned int length) {
+  if (opcode == OP_READ_MULTI) {
+    blocksToRead = arg;
+    currentOperation = "READ_MULTI";
+  }
+  else {
+    payloadLength = length;
+    payloadFlags = arg;
+    blocksToWrite = blocksForLength(payloadLength);
+    currentOperation = opcode == OP_WRITE_DIFF ? "WRITE_DIFF" : "WRITE_MULTI";
+  }
+  waitingForCard = true;
+}
+
+// Arms the oldest queued job, if any, once the previous one is done
+void startNextJob() {
+  if (queuedJobs == 0) return;
+  byte opcode = jobOpcode[0];
+  byte arg = jobArg[0];
+  unsigned int length = jobLength[0];
+  memcpy(payload, jobBuffer, length);
+  memmove(jobBuffer, jobBuffer + length, jobBufferUsed - length);
+  jobBufferUsed -= length;
+  queuedJobs--;
+  for (byte i = 0; i < queuedJobs; i++) {
+    jobOpcode[i] = jobOpcode[i + 1];
+    jobArg[i] = jobArg[i + 1];
+    jobLength[i] = jobLength[i + 1];
+  }
+  armJob(opcode, arg, length);
+  markPhase("armed");
+}
+
+void clearJobs() {
+  queuedJobs = 0;
+  jobBufferUsed = 0;
+}
+
+void beginBatch() {
+  clearJobs();
+  batchMode = true;
+  currentOperation = "BATCH";
+  waitingForCard = false;
+  lastBatchUidSize = 0;
+}
+
+void endBatch() {
+  batchMode = false;
+  currentOperation = "";
+  waitingForCard = false;
+  payloadLength = 0;
+}
+
+void beginScan() {
+  clearJobs();
+  batchMode = false;
+  currentOperation = "SCAN";
+  blocksToRead = LEGACY_DATA_BLOCKS;
+  waitingForCard = true;
+}
+
+// Disarms the reader, queued jobs included
+void endScan() {
+  clearJobs();
+  currentOperation = "";
+  waitingForCard = false;
+}
+
+// UID of the card in the field: UID:<hex> in text mode, an OP_SCAN_CARD frame in binary mode
+// (sent before every read or write result, not only while scanning)
+void reportCardUid() {
+  if (binaryMode) {
+    beginFrame(OP_SCAN_CARD, mfrc522.uid.size);
+    for (byte i = 0; i < mfrc522.uid.size; i++) frameByte(mfrc522.uid.uidByte[i]);
+    endFrame();
+    return;
+  }
+  Serial.print("UID:");
+  printUid();
+  Serial.println();
+}
+
+void printUid() {
+  for (byte i = 0; i < mfrc522.uid.size; i++) {
+    if (mfrc522.uid.uidByte[i] < 0x10) Serial.print('0');
+    Serial.print(mfrc522.uid.uidByte[i], HEX);
+  }
+}
+
+bool isLastBatchCard() {
+  return lastBatchUidSize == mfrc522.uid.size && memcmp(lastBatchUid, mfrc522.uid.uidByte, lastBatchUidSize) == 0;
+}
+
+// Writes the armed message to the card in the field and reports
+// status | blocks written | milliseconds (2) | UID, in text as CARD:<uid>:<status>:<blocks>:<ms>
+void writeBatchCard() {
+  unsigned long start = millis();
+  byte status = writeMultipleBlocks();
+  unsigned long elapsed = millis() - start;
+  byte blocksWritten = 0;
+  for (byte i = 0; i < resultCount; i++) {
+    if (resultStatus[i] == MFRC522::STATUS_OK) blocksWritten++;
+  }
+  
+  // Only a fully written card is skipped if it shows up again; a failed one may be retried
+  if (status == STATUS_OK) {
+    lastBatchUidSize = mfrc522.uid.size;
+    memcpy(lastBatchUid, mfrc522.uid.uidByte, lastBatchUidSize);
+  }
+  
+  unsigned int milliseconds = min(elapsed, 0xFFFFUL);
+  if (binaryMode) {
+    beginFrame(OP_BATCH_CARD, 4 + mfrc522.uid.size);
+    frameByte(status);
+    frameByte(blocksWritten);
+    frameByte(milliseconds & 0xFF);
+    frameByte(milliseconds >> 8);
+    for (byte i = 0; i < mfrc522.uid.size; i++) frameByte(mfrc522.uid.uidByte[i]);
+    endFrame();
+  }
+  else {
+    Serial.print("CARD:");
+    printUid();
+    Serial.print(':');
+    Serial.print(status);
+    Serial.print(':');
+    Serial.print(blocksWritten);
+    Serial.print(':');
+    Serial.println(milliseconds);
+  }
+}
+
+bool isEmptyBlock(const byte* buffer) {
+  for (byte i = 0; i < 16; i++) {
+    if (buffer[i] != 0) return false;
+  }
+  return true;
+}
+
+// Differential write: read every block first and only rewrite the ones that
+// differ. Blocks past the new message are cleared only within the extent of
+// the previous message (from its header, or up to its first empty block on
+// cards without one), instead of zeroing every data block up front.
+void writeChangedBlocks() {
+  beginRfPlan();
+  int blocksNeeded = blocksForLength(payloadLength);
+  if (!checkCapacity(blocksNeeded)) {
+    payloadLength = 0;
+    return;
+  }
+  
+  out().print("Writing ");
+  out().print(payloadLength);
+  out().println(" characters (differential)...");
+  
+  byte header[18];
+  buildHeader(header);
+  
+  int previousBlocks = -1; // Unknown until the old header has been read
+  int dataIndex = 0;
+  int blocksRewritten = 0;
+  int blocksUnchanged = 0;
+  int blocksCleared = 0;
+  bool dataMarked = false;
+  
+  for (int index = 0; index < cardDataBlocks; index++) {
+    bool inMessage = index < blocksNeeded;
+    if (!inMessage && !dataMarked) {
+      markPhase("data");
+      dataMarked = true;
+    }
+    // Past the new message only the blocks of the previous one need clearing
+    if (!inMessage && previousBlocks >= 0 && index >= previousBlocks) break;
+    
+    byte block = dataBlockNumber(index);
+    byte dataBlock[16];
+    byte buffer[18];
+    
+    // Prepare data block (all zeros past the end of the message)
+    if (index == 0) {
+      memcpy(dataBlock, header, 16);
+    } else {
+      for (byte i = 0; i < 16; i++) {
+        dataBlock[i] = dataIndex < payloadLength ? payload[dataIndex++] : 0;
+      }
+    }
+    
+    // Stop at the first failure: the header already announces the new message
+    MFRC522::StatusCode status = authenticateBlock(block);
+    if (status != MFRC522::STATUS_OK) {
+      recordBlockResult(block, status);
+      reportBlockFailure("Auth", block, status);
+      break;
+    }
+    
+    status = readBlock(block, buffer);
+    bool known = status == MFRC522::STATUS_OK;
+    if (index == 0) {
+      previousBlocks = known ? storedMessageBlocks(buffer) : LEGACY_DATA_BLOCKS;
+      markPhase("header");
+    }
+    
+    // A message without a header ended at its first empty block
+    if (!inMessage && known && isEmptyBlock(buffer)) break;
+    
+    if (known && memcmp(buffer, dataBlock, 16) == 0) {
+      blocksUnchanged++;
+      recordBlockResult(block, MFRC522::STATUS_OK);
+      continue;
+    }
+    
+    if (!known) {
+      // Re-authenticate after the failed read before trying to write
+      status = authenticateBlock(block);
+      if (status != MFRC522::STATUS_OK) {
+        recordBlockResult(block, status);
+        reportBlockFailure("Auth", block, status);
+        break;
+      }
+    }
+    
+    status = writeBlock(block, dataBlock);
+    recordBlockResult(block, status);
+    
+    if (status == MFRC522::STATUS_OK) {
+      if (inMessage) blocksRewritten++;
+      else blocksCleared++;
+      out().print("Block ");
+      out().print(block);
+      out().println(inMessage ? " written successfully" : " cleared");
+    } else {
+      reportBlockFailure("Write", block, status);
+      break;
+    }
+  }
+  
+  if (!dataMarked) markPhase("data");
+  markPhase("clear");
+  
+  // Only a write that got every message block onto the card saved anything.
+  // Baseline: the clear-all write authenticated and wrote every data block, then every message block again
+  int blocksWritten = blocksRewritten + blocksUnchanged;
+  bool complete = blocksWritten == blocksNeeded;
+  long fullOperations = 2L * LEGACY_DATA_BLOCKS + 2L * blocksNeeded;
+  unsigned int rfSaved = complete ? max(fullOperations - ((long)authCount + transferCount), 0L) : 0;
+  reportRfPlan();
+  
+  if (binaryMode) {
+    // Write result data: rewritten, unchanged, cleared, RF operations saved (2)
+    byte stats[5] = {(byte)blocksRewritten, (byte)blocksUnchanged, (byte)blocksCleared, lowByte(rfSaved), highByte(rfSaved)};
+    byte status = complete ? STATUS_OK : (blocksWritten == 0 ? STATUS_FAILED : STATUS_PARTIAL);
+    sendResultFrame(OP_WRITE_RESULT, status, stats, sizeof(stats));
+  }
+  else {
+    Serial.print("Differential write: ");
+    Serial.print(blocksRewritten);
+    Serial.print(" rewritten, ");
+    Serial.print(blocksUnchanged);
+    Serial.print(" unchanged, ");
+    Serial.print(blocksCleared);
+    Serial.print(" stale cleared, saved ");
+    Serial.print(rfSaved);
+    Serial.println(" RF operations");
+    
+    if (complete) {
+      Serial.print("Write successful! ");
+      Serial.print(blocksWritten);
+      Serial.print(" blocks written, ");
+      Serial.print(payloadLength);
+      Serial.println(" characters total.");
+    } else {
+      Serial.print("Write failed: ");
+      Serial.print(blocksWritten);
+      Serial.print(" of ");
+      Serial.print(blocksNeeded);
+      Serial.println(" message blocks written");
+    }
   }
   
-  dataToWrite = "";
+  payloadLength = 0;
 }
@@ -0,0 +1,282 @@
+"""Batch provisioning: stream messages from a CSV or JSONL file onto cards
+
+The sketch is switched into batch mode once and stays armed. Every new card
+placed on the reader receives the next message, and the next message is sent
+as soon as a card has been reported, so there is no command round trip per
+card. Used by the Batch tab of the GUI and headless:
+
+    python batch.py messages.csv --port /dev/ttyUSB0 --encrypt
+"""
+import argparse
+import csv
+import getpass
+import json
+import os
+import threading
+import time
+from collections import deque, namedtuple
+
+import serial
+
+import card_layout
+from cipher import VigenereCipher
+from compression import compress
+from frame_protocol import (
+    parse_batch_card, parse_batch_line, STATUS_NAMES, STATUS_OK, STATUS_TOO_LONG,
+    OP_BATCH_CARD, OP_BATCH_DONE, OP_BATCH_END, OP_BATCH_WRITE, OP_ERROR, OP_SET_FLAGS,
+)
+from serial_link import SerialLink, HANDSHAKE_TIMEOUT, HIGH_SPEED_BAUDRATES
+
+LOG_FIELDS = ["row", "uid", "status", "blocks", "latency_ms", "timestamp"]
+# Seconds of history behind the cards-per-minute figure
+RATE_WINDOW = 60
+# Cards a row is offered to before it is given up
+MAX_ATTEMPTS = 3
+POLL_INTERVAL = 0.2
+
+CardResult = namedtuple("CardResult", LOG_FIELDS)
+BatchSummary = namedtuple("BatchSummary", ["written", "failed", "skipped", "elapsed"])
+
+
+def read_messages(path):
+    """Yield (row, message) pairs from a CSV or JSONL file, one line at a time
+
+    CSV files use the "message" column when the first row names one and the
+    first column otherwise. JSONL lines are objects with a "message" key or
+    plain JSON strings. Rows are numbered by their line in the file.
+    """
+    with open(path, newline="", encoding="utf-8") as f:
+        if path.lower().endswith((".jsonl", ".ndjson")):
+            for row, line in enumerate(f, 1):
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                message = record.get("message", "") if isinstance(record, dict) else str(record)
+                if message:
+                    yield row, message
+            return
+
+        reader = csv.reader(f)
+        column = 0
+        for fields in reader:
+            if reader.line_num == 1:
+                names = [name.strip().lower() for name in fields]
+                if "message" in names:
+                    column = names.index("message")
+                    continue
+            if column < len(fields) and fields[column]:
+                yield reader.line_num, fields[column]
+
+
+def default_log_path(path):
+    """Result log written next to the message file"""
+    return os.path.splitext(path)[0] + ".results.csv"
+
+
+class RateMeter:
+    """Cards per minute over the last RATE_WINDOW seconds"""
+
+    def __init__(self, window=RATE_WINDOW):
+        self.window = window
+        self.start = time.monotonic()
+        self.times = deque()
+
+    def add(self):
+        self.times.append(time.monotonic())
+
+    def per_minute(self):
+        now = time.monotonic()
+        while self.times and now - self.times[0] > self.window:
+            self.times.popleft()
+        span = min(self.window, now - self.start)
+        return len(self.times) * 60 / span if span > 0 else 0.0
+
+
+class BatchProvisioner:
+    """Writes one message per card while the sketch stays armed in batch mode
+
+    Rows are encrypted with VigenereCipher when a key is given and then
+    compressed when compress is set (binary protocol only). A row whose
+    card fails is offered to the next card, up to MAX_ATTEMPTS cards. Every
+    card, and every row skipped before reaching the reader, is appended to
+    the CSV result log.
+    """
+
+    def __init__(self, link, key="", card_type=card_layout.DEFAULT_CARD_TYPE, log_path=None, compress=False):
+        if compress and not link.binary_mode:
+            raise ValueError("Compressed payloads need the binary protocol")
+        self.link = link
+        self.key = key
+        self.compress = compress
+        self.capacity = card_layout.capacity(card_type)
+        self.log_path = log_path
+        self.rate = None
+        self._stop = threading.Event()
+
+    def stop(self):
+        """Finish after the card in progress; the armed message is discarded"""
+        self._stop.set()
+
+    def run(self, messages, on_card=None):
+        """Provision cards from (row, message) pairs and return a BatchSummary
+
+        on_card(result, cards_per_minute) is called from this thread for
+        every logged result.
+        """
+        written = failed = skipped = 0
+        start = time.monotonic()
+        self.rate = RateMeter()
+        log_file = open(self.log_path, "a", newline="") if self.log_path else None
+        try:
+            log = csv.writer(log_file) if log_file else None
+            if log_file and log_file.tell() == 0:
+                log.writerow(LOG_FIELDS)
+
+            def record(result):
+                if log:
+                    log.writerow(result)
+                    log_file.flush()
+                if on_card:
+                    on_card(result, self.rate.per_minute())
+
+            with self.link.subscribe() as replies:
+                self._begin(replies)
+                try:
+                    for row, message in messages:
+                        if self._stop.is_set():
+                            break
+                        data = (VigenereCipher.encrypt(message, self.key) if self.key else message).encode()
+                        flags = 0
+                        if self.compress:
+                            data, flags = compress(data)
+                        problem = self._check(data)
+                        if problem:
+                            skipped += 1
+                            record(CardResult(row, "", problem, 0, 0, timestamp()))
+                            continue
+
+                        for _ in range(MAX_ATTEMPTS):
+                            card = self._write(replies, data, flags)
+                            if card is None:
+                                break
+                            self.rate.add()
+                            status = STATUS_NAMES.get(card.status, hex(card.status))
+                            record(CardResult(row, card.uid, status, card.blocks, card.latency_ms, timestamp()))
+                            if card.status == STATUS_OK:
+                                written += 1
+                                break
+                        else:
+                            failed += 1
+                finally:
+                    self._end(replies)
+        finally:
+            if log_file:
+                log_file.close()
+        return BatchSummary(written, failed, skipped, time.monotonic() - start)
+
+    def _check(self, data):
+        """Reason a row can't be written, or None"""
+        if len(data) > self.capacity:
+            return STATUS_NAMES[STATUS_TOO_LONG]
+        if not self.link.binary_mode and (b"\n" in data or b"\r" in data):
+            return "Line break (use the binary protocol)"
+        return None
+
+    def _begin(self, replies):
+        if self.link.binary_mode:
+            return  # The first OP_BATCH_WRITE frame switches the sketch into batch mode
+        self.link.send_line("BATCH")
+        if replies.wait_for(lambda r: r == "BATCH_OK", 2) is None:
+            raise serial.SerialTimeoutException("Firmware did not enter batch mode")
+
+    def _end(self, replies):
+        if not self.link.is_open:
+            return
+        if self.link.binary_mode:
+            self.link.send_frame(OP_BATCH_END)
+            replies.wait_for(lambda f: getattr(f, "opcode", None) == OP_BATCH_DONE, 2)
+        else:
+            self.link.send_line("BATCH_END")
+            replies.wait_for(lambda r: r == "BATCH_DONE", 2)
+
+    def _write(self, replies, data, flags=0):
+        """Arm the sketch with data and wait for the next card; None when stopped"""
+        if self.link.binary_mode:
+            if flags:
+                self.link.send_frame(OP_SET_FLAGS, bytes([flags]))
+            self.link.send_frame(OP_BATCH_WRITE, data)
+        else:
+            self.link.send_line(data.decode())
+
+        while not self._stop.is_set():
+            reply = replies.get(POLL_INTERVAL)
+            if reply is None:
+                continue
+            if isinstance(reply, str):
+                if reply.startswith("CARD:"):
+                    return parse_batch_line(reply)
+            elif reply.opcode == OP_BATCH_CARD:
+                return parse_batch_card(reply.payload)
+            elif reply.opcode == OP_ERROR:
+                raise serial.SerialException(
+                    f"Firmware rejected the message: {STATUS_NAMES.get(reply.payload[0], hex(reply.payload[0]))}"
+                )
+        return None
+
+
+def timestamp():
+    return time.strftime("%Y-%m-%dT%H:%M:%S")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Write one message per RFID card from a CSV or JSONL file")
+    parser.add_argument("messages", help="CSV (\"message\" column or first column) or JSONL file")
+    parser.add_argument("--port", required=True, help="serial port of the reader")
+    parser.add_argument("--log", help="CSV result log (default: <messages>.results.csv)")
+    parser.add_argument("--encrypt", action="store_true", help="prompt for a Vigenère key and encrypt every row")
+    parser.add_argument("--card-type", choices=list(card_layout.CARD_DATA_BLOCKS), default=card_layout.DEFAULT_CARD_TYPE)
+    parser.add_argument("--binary", action="store_true", help="use the binary framed protocol")
+    parser.add_argument("--compress", action="store_true", help="compress rows when that saves blocks (needs --binary)")
+    parser.add_argument("--no-reset", action="store_true", help="don't reset the board when opening the port")
+    args = parser.parse_args(argv)
+    if args.compress and not args.binary:
+        parser.error("--compress needs --binary")
+
+    key = getpass.getpass("Encryption key: ") if args.encrypt else ""
+    log_path = args.log or default_log_path(args.messages)
+
+    link = SerialLink.open(
+        args.port,
+        handshake_timeout=HANDSHAKE_TIMEOUT,
+        reset_board=not args.no_reset,
+        fallback_baudrates=HIGH_SPEED_BAUDRATES
+    )
+    try:
+        baudrate = link.negotiate_baud(HIGH_SPEED_BAUDRATES)
+        if args.binary:
+            link.enter_binary_mode()
+        print(f"Connected to {args.port} @ {baudrate} baud; place cards on the reader (Ctrl+C to stop)")
+
+        def on_card(result, rate):
+            print(
+                f"row {result.row}: {result.uid or '-'} {result.status}, {result.blocks} blocks, "
+                f"{result.latency_ms} ms ({rate:.1f} cards/min)"
+            )
+
+        provisioner = BatchProvisioner(link, key, args.card_type, log_path, compress=args.compress)
+        try:
+            summary = provisioner.run(read_messages(args.messages), on_card=on_card)
+        except KeyboardInterrupt:
+            print("Stopped")
+            return 1
+        print(
+            f"{summary.written} written, {summary.failed} failed, {summary.skipped} skipped "
+            f"in {summary.elapsed:.0f} s; results in {log_path}"
+        )
+        return 0 if summary.failed == 0 else 1
+    finally:
+        link.close()
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
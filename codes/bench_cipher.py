@@ -0,0 +1,93 @@
+"""Microbenchmark: table-driven VigenereCipher against the original per-character loop
+
+    python bench_cipher.py [--messages N] [--length N]
+
+Every input is also checked for identical output before anything is timed.
+"""
+import argparse
+import random
+import string
+import timeit
+
+from cipher import VigenereCipher
+
+
+def reference_encrypt(text, key):
+    """The original implementation, kept as the reference"""
+    if not key:
+        return text
+
+    result = ""
+    key = key.upper()
+    key_index = 0
+
+    for char in text:
+        if char.isalpha():
+            shift = ord(key[key_index % len(key)]) - ord('A')
+            if char.isupper():
+                result += chr((ord(char) - ord('A') + shift) % 26 + ord('A'))
+            else:
+                result += chr((ord(char) - ord('a') + shift) % 26 + ord('a'))
+            key_index += 1
+        else:
+            result += char
+
+    return result
+
+
+def reference_decrypt(text, key):
+    if not key:
+        return text
+
+    result = ""
+    key = key.upper()
+    key_index = 0
+
+    for char in text:
+        if char.isalpha():
+            shift = ord(key[key_index % len(key)]) - ord('A')
+            if char.isupper():
+                result += chr((ord(char) - ord('A') - shift) % 26 + ord('A'))
+            else:
+                result += chr((ord(char) - ord('a') - shift) % 26 + ord('a'))
+            key_index += 1
+        else:
+            result += char
+
+    return result
+
+
+def check_identical(rng, count=2000):
+    """Random texts and keys, including non-ASCII letters and non-letter key characters"""
+    alphabet = string.printable + "äöüßÉçñΩжЖ中½²"
+    for _ in range(count):
+        text = "".join(rng.choice(alphabet) for _ in range(rng.randint(0, 80)))
+        key = "".join(rng.choice(string.ascii_letters + "0!ßé ") for _ in range(rng.randint(0, 8)))
+        assert VigenereCipher.encrypt(text, key) == reference_encrypt(text, key), (text, key)
+        assert VigenereCipher.decrypt(text, key) == reference_decrypt(text, key), (text, key)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--messages", type=int, default=1000, help="messages per batch")
+    parser.add_argument("--length", type=int, default=704, help="characters per message (a full 1K card)")
+    args = parser.parse_args()
+
+    rng = random.Random(1)
+    check_identical(rng)
+
+    words = string.ascii_letters + " .,-0123456789"
+    messages = ["".join(rng.choice(words) for _ in range(args.length)) for _ in range(args.messages)]
+    key = "PROVISIONING"
+
+    reference = min(timeit.repeat(lambda: [reference_encrypt(m, key) for m in messages], number=1, repeat=3))
+    table = min(timeit.repeat(lambda: VigenereCipher.encrypt_many(messages, key), number=1, repeat=3))
+    chars = args.messages * args.length
+    print(f"{args.messages} messages x {args.length} characters, outputs identical")
+    print(f"reference loop: {reference * 1000:8.1f} ms ({chars / reference / 1e6:6.2f} M chars/s)")
+    print(f"table driven:   {table * 1000:8.1f} ms ({chars / table / 1e6:6.2f} M chars/s)")
+    print(f"speedup:        {reference / table:8.1f}x")
+
+
+if __name__ == "__main__":
+    main()
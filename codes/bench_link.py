@@ -0,0 +1,224 @@
+"""End-to-end latency and throughput benchmark for card writes and reads
+
+    python bench_link.py --emulate [--binary] [--sizes 16,64,256,704] [--count 20] [--output bench.json]
+    python bench_link.py --port /dev/ttyUSB0 [--binary] ...
+
+Every operation is timed on the client from the command to the result, and
+the sketch's per-phase marks (see timing.py) split that time into waiting
+for the card, header, data and clear phases. For each operation and payload
+size the run reports p50/p95/p99 latency and ops/sec, plus the median of
+every client and firmware phase, and writes them as JSON to --output. With
+--baseline, a p50 more than --tolerance slower than the baseline's fails
+the run (exit status 1), so a saved result file doubles as a regression check.
+
+On a real reader every operation needs the card to be presented again; with
+--emulate the run goes against emulator.py, which presents its card as soon
+as the sketch waits for one (--arrival).
+"""
+import argparse
+import json
+import platform
+import statistics
+import string
+import sys
+import time
+from datetime import datetime
+
+import card_layout
+from emulator import Emulator, make_cards, BLOCK_LATENCY, AUTH_LATENCY
+from frame_protocol import STATUS_OK
+from serial_link import SerialLink
+from timing import PhaseTimer
+
+DEFAULT_SIZES = (16, 64, 256, 704)
+DEFAULT_COUNT = 20
+OPERATION_TIMEOUT = 10
+PERCENTILES = (50, 95, 99)
+
+
+def percentile(samples, p):
+    """p-th percentile with linear interpolation between the closest ranks"""
+    ordered = sorted(samples)
+    if not ordered:
+        return None
+    position = (len(ordered) - 1) * p / 100
+    lower = int(position)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (position - lower)
+
+
+def make_payload(size):
+    """Printable payload of size bytes, so the text protocol can carry it too"""
+    alphabet = string.ascii_letters + string.digits
+    return "".join(alphabet[i % len(alphabet)] for i in range(size))
+
+
+def run_write(link, message, timer):
+    """One write; True when every block was written"""
+    if link.binary_mode:
+        result = link.binary_write(message.encode(), timeout=OPERATION_TIMEOUT, timer=timer)
+        return result is not None and result.status == STATUS_OK
+    response = link.text_write(message, timeout=OPERATION_TIMEOUT, timer=timer)
+    return response is not None and response.startswith("Write successful")
+
+
+def run_read(link, message, timer):
+    """One read; True when the card returned exactly message"""
+    if link.binary_mode:
+        result = link.binary_read(timeout=OPERATION_TIMEOUT, timer=timer)
+        return result is not None and result.status == STATUS_OK and result.data == message.encode()
+    response = link.text_read(timeout=OPERATION_TIMEOUT, timer=timer)
+    return response == f"DATA:{message}"
+
+
+def median_phases(phase_lists):
+    """{phase: median ms} over several operations' [(phase, ms)] lists"""
+    samples = {}
+    for phases in phase_lists:
+        for name, ms in phases:
+            samples.setdefault(name, []).append(ms)
+    return {name: round(statistics.median(values), 3) for name, values in samples.items()}
+
+
+def summarize(operation, size, timers, failures, elapsed):
+    latencies = [timer.total_ms for timer in timers]
+    return {
+        "operation": operation,
+        "size": size,
+        "count": len(timers),
+        "failures": failures,
+        "ops_per_sec": round(len(timers) / elapsed, 3) if elapsed > 0 else None,
+        "latency_ms": {
+            **{f"p{p}": round(percentile(latencies, p), 3) for p in PERCENTILES},
+            "mean": round(statistics.mean(latencies), 3),
+            "min": round(min(latencies), 3),
+            "max": round(max(latencies), 3),
+        },
+        "client_phases_ms": median_phases(timer.client_phases() for timer in timers),
+        "firmware_phases_ms": median_phases(timer.firmware_phases() for timer in timers),
+    }
+
+
+def bench(link, sizes, count, on_result=None):
+    """Writes then reads of every size, count times each; returns the summaries"""
+    results = []
+    for size in sizes:
+        message = make_payload(size)
+        for operation, run in (("write", run_write), ("read", run_read)):
+            timers = []
+            failures = 0
+            start = time.perf_counter()
+            for _ in range(count):
+                timer = PhaseTimer()
+                if not run(link, message, timer):
+                    failures += 1
+                timers.append(timer)
+            summary = summarize(operation, size, timers, failures, time.perf_counter() - start)
+            results.append(summary)
+            if on_result:
+                on_result(summary)
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """Descriptions of every p50 that got slower than the baseline by more than tolerance"""
+    previous = {(r["operation"], r["size"]): r for r in baseline["results"]}
+    regressions = []
+    for result in results:
+        old = previous.get((result["operation"], result["size"]))
+        if old is None:
+            continue
+        old_p50, new_p50 = old["latency_ms"]["p50"], result["latency_ms"]["p50"]
+        if old_p50 and new_p50 > old_p50 * (1 + tolerance):
+            regressions.append(
+                f"{result['operation']} {result['size']} B: p50 {new_p50:.1f} ms vs {old_p50:.1f} ms baseline"
+            )
+    return regressions
+
+
+def print_result(result):
+    latency = result["latency_ms"]
+    firmware = ", ".join(f"{name} {ms:g}" for name, ms in result["firmware_phases_ms"].items())
+    print(
+        f"{result['operation']:5} {result['size']:5} B  p50 {latency['p50']:8.1f} ms  p95 {latency['p95']:8.1f} ms  "
+        f"p99 {latency['p99']:8.1f} ms  {result['ops_per_sec']:7.2f} ops/s  {result['failures']} failed"
+        + (f"  [firmware ms: {firmware}]" if firmware else "")
+    )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument("--port", help="serial port of a KhabiByte reader")
+    target.add_argument("--emulate", action="store_true", help="run against the software emulator")
+    parser.add_argument("--binary", action="store_true", help="use the binary framed protocol")
+    parser.add_argument("--sizes", default=",".join(map(str, DEFAULT_SIZES)), help="payload sizes in bytes")
+    parser.add_argument("--count", type=int, default=DEFAULT_COUNT, help="operations per size")
+    parser.add_argument("--baud", type=int, default=115200, help="rate to negotiate after connecting (9600 keeps the default)")
+    parser.add_argument("--arrival", type=float, default=0.0, help="emulator: seconds until the card arrives")
+    parser.add_argument("--block-latency", type=float, default=BLOCK_LATENCY, help="emulator: seconds per block")
+    parser.add_argument("--auth-latency", type=float, default=AUTH_LATENCY, help="emulator: seconds per authentication")
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    parser.add_argument("--baseline", help="JSON results to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed p50 slowdown against the baseline")
+    args = parser.parse_args(argv)
+
+    sizes = [int(size) for size in args.sizes.split(",")]
+    too_big = [size for size in sizes if size > card_layout.capacity()]
+    if too_big:
+        parser.error(f"sizes {too_big} don't fit a {card_layout.DEFAULT_CARD_TYPE} card ({card_layout.capacity()} bytes)")
+
+    emulator = None
+    if args.emulate:
+        emulator = Emulator(make_cards(1), args.arrival, args.block_latency, args.auth_latency)
+        emulator.start()
+    port = emulator.port if emulator else args.port
+
+    try:
+        link = SerialLink.open(port, reset_board=not args.emulate)
+        try:
+            if args.baud != link.baudrate:
+                link.negotiate_baud((args.baud,))
+            if args.binary:
+                link.enter_binary_mode()
+            if not link.set_timing(True):
+                print("Firmware doesn't report phase timings; only client phases are measured")
+
+            protocol = "binary" if link.binary_mode else "text"
+            print(f"{port} @ {link.baudrate} baud ({protocol}), {args.count} operations per size")
+            results = bench(link, sizes, args.count, on_result=print_result)
+            report = {
+                "created": datetime.now().isoformat(timespec="seconds"),
+                "port": port,
+                "baudrate": link.baudrate,
+                "protocol": protocol,
+                "python": platform.python_version(),
+                "emulator": {
+                    "arrival_latency": args.arrival,
+                    "block_latency": args.block_latency,
+                    "auth_latency": args.auth_latency,
+                } if emulator else None,
+                "results": results,
+            }
+        finally:
+            link.close()
+    finally:
+        if emulator:
+            emulator.close()
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Results written to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(report["results"], json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,141 @@
+"""Cold start benchmark for the GUI and the headless entry point
+
+    python bench_startup.py [--runs 10] [--output startup.json] [--baseline startup.json]
+
+Each probe runs in a fresh interpreter, so nothing is cached in
+sys.modules. For every probe the run reports the median and worst time
+spent inside the interpreter (imports and construction) and the wall time
+of the whole process, interpreter start included. "first_frame" builds the
+window and draws it once; it is skipped without a display. The headless
+probe also fails the run if it imports tkinter.
+
+With --baseline, a probe whose median is more than --tolerance slower than
+the baseline's fails the run (exit status 1).
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+from datetime import datetime
+
+PROBES = {
+    "interpreter": "",
+    "gui_import": "import KhabiByte",
+    "first_frame": "import KhabiByte\napp = KhabiByte.RFIDManager()\napp.root.update()\napp.root.destroy()",
+    "headless_import": "import headless",
+}
+
+PROBE_TEMPLATE = """import sys, time
+start = time.perf_counter()
+{code}
+print(time.perf_counter() - start, any(name.startswith("tkinter") for name in sys.modules))
+"""
+
+# Inside-interpreter times are this small for the empty probe, so a relative tolerance would be meaningless
+MIN_COMPARED_MS = 5.0
+
+
+def run_probe(code):
+    """((ms inside the interpreter, ms wall, tkinter imported), None) for one fresh process,
+    or (None, [last line of stderr]) if it failed"""
+    start = time.perf_counter()
+    process = subprocess.run(
+        [sys.executable, "-c", PROBE_TEMPLATE.format(code=code)],
+        cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True
+    )
+    wall = (time.perf_counter() - start) * 1000
+    if process.returncode != 0:
+        return None, process.stderr.strip().splitlines()[-1:] or ["failed"]
+    inside, tkinter = process.stdout.split()[-2:]
+    return (float(inside) * 1000, wall, tkinter == "True"), None
+
+
+def measure(name, code, runs):
+    samples = []
+    for _ in range(runs):
+        sample, error = run_probe(code)
+        if sample is None:
+            return {"probe": name, "skipped": error[0]}
+        samples.append(sample)
+    inside = [s[0] for s in samples]
+    wall = [s[1] for s in samples]
+    return {
+        "probe": name,
+        "runs": runs,
+        "median_ms": round(statistics.median(inside), 2),
+        "max_ms": round(max(inside), 2),
+        "wall_median_ms": round(statistics.median(wall), 2),
+        "tkinter": any(s[2] for s in samples),
+    }
+
+
+def compare(results, baseline, tolerance):
+    """Descriptions of every probe whose median got slower than the baseline by more than tolerance"""
+    previous = {r["probe"]: r for r in baseline["results"] if "median_ms" in r}
+    regressions = []
+    for result in results:
+        old = previous.get(result["probe"])
+        if old is None or "median_ms" not in result:
+            continue
+        limit = max(old["median_ms"] * (1 + tolerance), old["median_ms"] + MIN_COMPARED_MS)
+        if result["median_ms"] > limit:
+            regressions.append(
+                f"{result['probe']}: median {result['median_ms']:.1f} ms vs {old['median_ms']:.1f} ms baseline"
+            )
+    return regressions
+
+
+def print_result(result):
+    if "skipped" in result:
+        print(f"{result['probe']:16} skipped ({result['skipped']})")
+        return
+    print(
+        f"{result['probe']:16} median {result['median_ms']:7.1f} ms  max {result['max_ms']:7.1f} ms  "
+        f"process {result['wall_median_ms']:7.1f} ms" + ("  [imports tkinter]" if result["tkinter"] else "")
+    )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=10, help="fresh interpreters per probe")
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    parser.add_argument("--baseline", help="JSON results to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed median slowdown against the baseline")
+    args = parser.parse_args(argv)
+
+    results = []
+    for name, code in PROBES.items():
+        result = measure(name, code, args.runs)
+        print_result(result)
+        results.append(result)
+    report = {
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "results": results,
+    }
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Results written to {args.output}")
+
+    failures = []
+    headless = next(r for r in results if r["probe"] == "headless_import")
+    if headless.get("tkinter"):
+        failures.append("headless entry point imports tkinter")
+    if args.baseline:
+        with open(args.baseline) as f:
+            failures += compare(results, json.load(f), args.tolerance)
+    for failure in failures:
+        print(f"REGRESSION {failure}")
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
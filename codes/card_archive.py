@@ -0,0 +1,461 @@
+"""Append-only local archive of every card read and write
+
+    python card_archive.py last E0000001 [--archive DIR]
+    python card_archive.py history E0000001 [--limit 20]
+    python card_archive.py since 2026-10-01T08:00 [--until 2026-10-02]
+    python card_archive.py stats
+
+An archive is a directory of three files:
+
+    records.bin  every operation's UID, raw payload (as a read returns it)
+                 and decrypted text, appended back to back with a CRC-32
+    index.bin    one fixed-size entry per record, in time order: timestamp,
+                 offset and length of the record, operation, status, block
+                 count, latency, UID and the entry of the card's previous
+                 operation
+    uids.bin     open addressing hash table from UID to its latest entry
+
+index.bin and uids.bin are memory-mapped and grow by doubling, so memory
+use stays flat however many records an archive holds: a time range is a
+binary search over index.bin, the latest operation on a card one probe of
+uids.bin and its history a walk back along the previous-entry links.
+Records go through a large write buffer and reach records.bin in bulk, and
+a time range is read back in one piece per batch of entries.
+
+Timestamps never go backwards within an archive (a clock stepped back is
+clamped to the latest one), which keeps index.bin sorted by time. Opening
+an archive drops the entries whose record didn't reach the disk before a
+crash and brings uids.bin back in line with index.bin.
+"""
+import argparse
+import mmap
+import os
+import struct
+import sys
+import threading
+import time
+import zlib
+from collections import namedtuple
+from datetime import datetime
+
+DEFAULT_ARCHIVE = os.path.join(os.path.expanduser("~"), ".khabibyte", "archive")
+
+READ = "read"
+WRITE = "write"
+KINDS = (READ, WRITE)
+MAX_UID_SIZE = 10  # Triple size ISO 14443 UID
+
+# magic | version | entries
+INDEX_HEADER = struct.Struct("<4sHxxQ")
+# timestamp | record offset | previous entry of the card (-1: none) | record length | latency ms
+# | kind | ok | blocks | UID size | UID
+INDEX_ENTRY = struct.Struct("<dQqIfBBBB10s2x")
+# magic | version | slots | cards | entries applied
+UID_HEADER = struct.Struct("<4sHxxQQQ")
+# UID size (0: empty slot) | UID | operations | latest entry (-1: none)
+UID_SLOT = struct.Struct("<B10sxIq")
+# UID size | raw length | text length (0xFFFFFFFF: no text); then UID, raw, text and a CRC-32 of all of it
+RECORD_HEADER = struct.Struct("<BII")
+RECORD_CRC = struct.Struct("<I")
+NO_TEXT = 0xFFFFFFFF
+
+INDEX_MAGIC = b"KBAI"
+UID_MAGIC = b"KBAU"
+VERSION = 1
+INITIAL_ENTRIES = 4096
+INITIAL_SLOTS = 4096
+# Share of used slots before uids.bin is doubled
+MAX_LOAD = 0.6
+WRITE_BUFFER = 1 << 20
+# Entries whose records are read back with one read
+READ_BATCH = 1024
+
+ArchiveEntry = namedtuple("ArchiveEntry", ["number", "timestamp", "kind", "uid", "ok", "blocks", "latency_ms"])
+# raw is the payload as a read returns it (bytes), text the decrypted message or None
+ArchiveRecord = namedtuple("ArchiveRecord", ArchiveEntry._fields + ("raw", "text"))
+
+
+class ArchiveError(Exception):
+    """The archive files are not a KhabiByte archive or don't belong together"""
+
+
+def uid_bytes(uid):
+    """UID as bytes from a hex string (any case, spaces or colons allowed) or bytes"""
+    if isinstance(uid, str):
+        uid = bytes.fromhex(uid.replace(":", "").replace(" ", ""))
+    uid = bytes(uid)
+    if not 0 < len(uid) <= MAX_UID_SIZE:
+        raise ValueError(f"A UID has 1 to {MAX_UID_SIZE} bytes, not {len(uid)}")
+    return uid
+
+
+class CardArchive:
+    """Archive directory opened for appending and lookups; safe from any thread"""
+
+    def __init__(self, path=DEFAULT_ARCHIVE):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self._lock = threading.Lock()
+        self._index_file, self._index = self._open_map(
+            "index.bin", INDEX_HEADER, INDEX_MAGIC, (0,), INITIAL_ENTRIES * INDEX_ENTRY.size
+        )
+        self._uid_file, self._uids = self._open_map(
+            "uids.bin", UID_HEADER, UID_MAGIC, (INITIAL_SLOTS, 0, 0), INITIAL_SLOTS * UID_SLOT.size
+        )
+        self._slots = UID_HEADER.unpack_from(self._uids)[2]
+        records = os.path.join(path, "records.bin")
+        self._records = open(records, "ab", buffering=WRITE_BUFFER)
+        self._reader = open(records, "rb")
+        self._unflushed = False
+        self._recover()
+        self._last_timestamp = self._entry(self.count - 1).timestamp if self.count else 0.0
+
+    def _open_map(self, name, header, magic, empty=None, body_size=0):
+        """(file, mmap) of name; a missing file is created from the empty header fields and body_size zero bytes"""
+        path = os.path.join(self.path, name)
+        if empty and (not os.path.exists(path) or os.path.getsize(path) == 0):
+            with open(path, "wb") as f:
+                f.write(header.pack(magic, VERSION, *empty))
+                f.truncate(header.size + body_size)
+        f = open(path, "r+b")
+        mapped = mmap.mmap(f.fileno(), 0)
+        found, version = header.unpack_from(mapped)[:2]
+        if found != magic or version != VERSION:
+            mapped.close()
+            f.close()
+            raise ArchiveError(f"{path} is not a version {VERSION} card archive file")
+        return f, mapped
+
+    @property
+    def count(self):
+        """Operations in the archive"""
+        return INDEX_HEADER.unpack_from(self._index)[2]
+
+    @property
+    def cards(self):
+        """Distinct cards in the archive"""
+        return UID_HEADER.unpack_from(self._uids)[3]
+
+    def append(self, kind, uid, raw=b"", text=None, blocks=0, latency_ms=0.0, ok=True, timestamp=None):
+        """Record one operation; returns its entry number
+
+        raw is the payload as a read of the card returns it (for a write,
+        the message that was sent, encrypted if it was), text the plain
+        message when it was encrypted. A failed write is recorded too: it
+        marks the card's contents as unknown.
+        """
+        uid = uid_bytes(uid)
+        if isinstance(raw, str):
+            raw = raw.encode()
+        encoded = text.encode() if text is not None else b""
+        body = RECORD_HEADER.pack(len(uid), len(raw), len(encoded) if text is not None else NO_TEXT) + uid + raw + encoded
+        body += RECORD_CRC.pack(zlib.crc32(body))
+        with self._lock:
+            number = self.count
+            timestamp = max(time.time() if timestamp is None else timestamp, self._last_timestamp)
+            self._last_timestamp = timestamp
+            offset = self._records.tell()
+            self._records.write(body)
+            self._unflushed = True
+            if INDEX_HEADER.size + (number + 1) * INDEX_ENTRY.size > len(self._index):
+                self._index = self._grow(self._index_file, self._index, len(self._index) * 2)
+            slot = self._find_slot(uid, insert=True)
+            previous = self._slot(slot)[2]
+            INDEX_ENTRY.pack_into(
+                self._index, INDEX_HEADER.size + number * INDEX_ENTRY.size,
+                timestamp, offset, previous, len(body), latency_ms, KINDS.index(kind), bool(ok), min(blocks, 0xFF),
+                len(uid), uid
+            )
+            self._set_count(number + 1)
+            self._link(slot, uid, number)
+            self._set_applied(number + 1)
+        return number
+
+    def last(self, uid):
+        """ArchiveEntry of the latest operation on the card, or None"""
+        with self._lock:
+            slot = self._find_slot(uid_bytes(uid))
+            latest = self._slot(slot)[2] if slot is not None else -1
+            return self._entry(latest) if latest >= 0 else None
+
+    def last_known(self, uid):
+        """ArchiveRecord of the card's current contents, or None when they aren't known
+
+        That is the latest successful read or write. Failed reads leave the
+        card as it was and are skipped; after a failed write the contents
+        are unknown.
+        """
+        for entry in self.history(uid, records=False):
+            if entry.ok:
+                return self.record(entry.number)
+            if entry.kind == WRITE:
+                return None
+        return None
+
+    def history(self, uid, limit=None, records=True):
+        """The card's operations, latest first: ArchiveRecords, or ArchiveEntries with records=False"""
+        entry = self.last(uid)
+        while entry is not None and limit != 0:
+            yield self.record(entry.number) if records else entry
+            limit = limit - 1 if limit is not None else None
+            with self._lock:
+                previous = self._previous(entry.number)
+                entry = self._entry(previous) if previous >= 0 else None
+
+    def between(self, start=None, end=None):
+        """ArchiveRecords with start <= timestamp < end (Unix times, None: open), oldest first"""
+        with self._lock:
+            first = self._bisect(start) if start is not None else 0
+            stop = self._bisect(end) if end is not None else self.count
+        for batch in range(first, stop, READ_BATCH):
+            with self._lock:
+                entries = [self._entry(number) for number in range(batch, min(batch + READ_BATCH, stop))]
+                offsets = [self._locate(entry.number) for entry in entries]
+                chunk = self._read(offsets[0][0], offsets[-1][0] + offsets[-1][1] - offsets[0][0])
+            for entry, (offset, length) in zip(entries, offsets):
+                start_at = offset - offsets[0][0]
+                yield ArchiveRecord(*entry, *self._decode(chunk[start_at:start_at + length]))
+
+    def record(self, number):
+        """ArchiveRecord of entry number"""
+        with self._lock:
+            entry = self._entry(number)
+            offset, length = self._locate(number)
+            return ArchiveRecord(*entry, *self._decode(self._read(offset, length)))
+
+    def flush(self):
+        """Write the buffered records out and sync the mapped index"""
+        with self._lock:
+            self._records.flush()
+            self._unflushed = False
+            self._index.flush()
+            self._uids.flush()
+
+    def close(self):
+        self.flush()
+        with self._lock:
+            for closable in (self._index, self._uids, self._index_file, self._uid_file, self._records, self._reader):
+                closable.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    # Index entries
+
+    def _entry(self, number):
+        timestamp, _, _, _, latency_ms, kind, ok, blocks, uid_size, uid = INDEX_ENTRY.unpack_from(
+            self._index, INDEX_HEADER.size + number * INDEX_ENTRY.size
+        )
+        return ArchiveEntry(number, timestamp, KINDS[kind], uid[:uid_size].hex().upper(), bool(ok), blocks, latency_ms)
+
+    def _locate(self, number):
+        """(offset, length) of the record of entry number"""
+        _, offset, _, length = INDEX_ENTRY.unpack_from(self._index, INDEX_HEADER.size + number * INDEX_ENTRY.size)[:4]
+        return offset, length
+
+    def _previous(self, number):
+        return INDEX_ENTRY.unpack_from(self._index, INDEX_HEADER.size + number * INDEX_ENTRY.size)[2]
+
+    def _uid(self, number):
+        fields = INDEX_ENTRY.unpack_from(self._index, INDEX_HEADER.size + number * INDEX_ENTRY.size)
+        return fields[9][:fields[8]]
+
+    def _set_count(self, count):
+        struct.pack_into("<Q", self._index, 8, count)
+
+    def _bisect(self, timestamp):
+        """First entry at or after timestamp"""
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if struct.unpack_from("<d", self._index, INDEX_HEADER.size + middle * INDEX_ENTRY.size)[0] < timestamp:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    # Records
+
+    def _read(self, offset, length):
+        if self._unflushed:
+            self._records.flush()
+            self._unflushed = False
+        self._reader.seek(offset)
+        return self._reader.read(length)
+
+    @staticmethod
+    def _decode(record):
+        """(raw, text) from one record"""
+        uid_size, raw_length, text_length = RECORD_HEADER.unpack_from(record)
+        start = RECORD_HEADER.size + uid_size
+        raw = record[start:start + raw_length]
+        if text_length == NO_TEXT:
+            return raw, None
+        start += raw_length
+        return raw, record[start:start + text_length].decode(errors="replace")
+
+    def _record_intact(self, number, size):
+        offset, length = self._locate(number)
+        if offset + length > size:
+            return False
+        record = self._read(offset, length)
+        return zlib.crc32(record[:-RECORD_CRC.size]) == RECORD_CRC.unpack_from(record, length - RECORD_CRC.size)[0]
+
+    # UID table
+
+    def _slot(self, slot):
+        """(UID, operations, latest entry) in slot"""
+        uid_size, uid, operations, latest = UID_SLOT.unpack_from(self._uids, UID_HEADER.size + slot * UID_SLOT.size)
+        return uid[:uid_size], operations, latest
+
+    def _find_slot(self, uid, insert=False):
+        """Slot holding uid; with insert, claims an empty one for a new card (None otherwise)"""
+        mask = self._slots - 1
+        slot = zlib.crc32(uid) & mask
+        while True:
+            found = self._slot(slot)[0]
+            if found == uid:
+                return slot
+            if not found:
+                break
+            slot = (slot + 1) & mask
+        if not insert:
+            return None
+        if self.cards + 1 > self._slots * MAX_LOAD:
+            self._rehash(self._slots * 2)
+            return self._find_slot(uid, insert=True)
+        UID_SLOT.pack_into(self._uids, UID_HEADER.size + slot * UID_SLOT.size, len(uid), uid, 0, -1)
+        struct.pack_into("<Q", self._uids, 16, self.cards + 1)
+        return slot
+
+    def _link(self, slot, uid, number):
+        operations = self._slot(slot)[1]
+        UID_SLOT.pack_into(self._uids, UID_HEADER.size + slot * UID_SLOT.size, len(uid), uid, operations + 1, number)
+
+    def _set_applied(self, count):
+        struct.pack_into("<Q", self._uids, 24, count)
+
+    def _rehash(self, slots):
+        """Rebuild uids.bin with room for slots cards"""
+        path = os.path.join(self.path, "uids.bin")
+        rebuilt = path + ".new"
+        cards, applied = UID_HEADER.unpack_from(self._uids)[3:]
+        with open(rebuilt, "wb") as f:
+            f.write(UID_HEADER.pack(UID_MAGIC, VERSION, slots, cards, applied))
+            f.truncate(UID_HEADER.size + slots * UID_SLOT.size)
+        with open(rebuilt, "r+b") as f, mmap.mmap(f.fileno(), 0) as table:
+            mask = slots - 1
+            for old in range(self._slots):
+                uid, operations, latest = self._slot(old)
+                if not uid:
+                    continue
+                slot = zlib.crc32(uid) & mask
+                while table[UID_HEADER.size + slot * UID_SLOT.size]:
+                    slot = (slot + 1) & mask
+                UID_SLOT.pack_into(table, UID_HEADER.size + slot * UID_SLOT.size, len(uid), uid, operations, latest)
+            table.flush()
+        self._uids.close()
+        self._uid_file.close()
+        os.replace(rebuilt, path)
+        self._uid_file, self._uids = self._open_map("uids.bin", UID_HEADER, UID_MAGIC)
+        self._slots = slots
+
+    @staticmethod
+    def _grow(f, mapped, size):
+        """Remap f at size bytes"""
+        mapped.flush()
+        mapped.close()
+        f.truncate(size)
+        return mmap.mmap(f.fileno(), 0)
+
+    def _recover(self):
+        """Drop entries without an intact record and bring the UID table up to date with the index"""
+        count = self.count
+        size = os.path.getsize(os.path.join(self.path, "records.bin"))
+        valid = count
+        while valid and not self._record_intact(valid - 1, size):
+            valid -= 1
+        applied = UID_HEADER.unpack_from(self._uids)[4]
+        if applied > count:
+            raise ArchiveError(f"{self.path}: uids.bin is ahead of index.bin")
+        # Undo the dropped entries the table already links to, latest first
+        for number in range(min(applied, count) - 1, valid - 1, -1):
+            slot = self._find_slot(self._uid(number))
+            if slot is None:
+                continue
+            uid, operations, latest = self._slot(slot)
+            if latest == number:
+                UID_SLOT.pack_into(
+                    self._uids, UID_HEADER.size + slot * UID_SLOT.size, len(uid), uid, operations - 1, self._previous(number)
+                )
+        # Link the entries the table never saw
+        for number in range(min(applied, valid), valid):
+            uid = self._uid(number)
+            self._link(self._find_slot(uid, insert=True), uid, number)
+        self._set_applied(valid)
+        self._set_count(valid)
+        # Whatever follows the last intact record is a torn append
+        end = sum(self._locate(valid - 1)) if valid else 0
+        if end < size:
+            self._records.truncate(end)
+            self._records.seek(end)
+
+
+def parse_time(value):
+    """Unix time from an ISO date or date and time"""
+    return datetime.fromisoformat(value).timestamp()
+
+
+def format_record(record):
+    stamp = datetime.fromtimestamp(record.timestamp).isoformat(sep=" ", timespec="seconds")
+    status = "ok" if record.ok else "failed"
+    line = f"{stamp}  #{record.number}  {record.uid}  {record.kind:5} {status:6} {record.blocks} blocks  {record.latency_ms:.0f} ms"
+    if isinstance(record, ArchiveRecord) and (record.ok or record.raw):
+        line += f"  {record.raw.decode(errors='replace')!r}"
+        if record.text is not None:
+            line += f" -> {record.text!r}"
+    return line
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--archive", default=DEFAULT_ARCHIVE, help="archive directory")
+    commands = parser.add_subparsers(dest="command", required=True)
+    last = commands.add_parser("last", help="last known contents of a card")
+    last.add_argument("uid")
+    history = commands.add_parser("history", help="operations on a card, latest first")
+    history.add_argument("uid")
+    history.add_argument("--limit", type=int, default=20, help="operations to show (0: all)")
+    since = commands.add_parser("since", help="operations from a point in time on, oldest first")
+    since.add_argument("start", help="ISO date or date and time")
+    since.add_argument("--until", help="ISO date or date and time to stop before")
+    commands.add_parser("stats", help="number of operations and cards")
+    args = parser.parse_args(argv)
+
+    if not os.path.isdir(args.archive):
+        print(f"No archive at {args.archive}", file=sys.stderr)
+        return 1
+    with CardArchive(args.archive) as archive:
+        if args.command == "last":
+            record = archive.last_known(args.uid)
+            if record is None:
+                print(f"Contents of {args.uid.upper()} are not known", file=sys.stderr)
+                return 1
+            print(format_record(record))
+        elif args.command == "history":
+            for record in archive.history(args.uid, limit=args.limit or None):
+                print(format_record(record))
+        elif args.command == "since":
+            until = parse_time(args.until) if args.until else None
+            for record in archive.between(parse_time(args.start), until):
+                print(format_record(record))
+        else:
+            print(f"{archive.count} operations on {archive.cards} cards in {archive.path}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,90 @@
+"""Card layout shared with arduino_rfid_manager.ino
+
+The first data block of the card holds a 16-byte header:
+
+    'K' 'B' | version | flags | length (2) | payload CRC (2) | header CRC (2) | reserved (6)
+
+Integers are little-endian and both CRCs are CRC-16/CCITT-FALSE. The payload
+follows in the next data blocks, so a read fetches exactly the blocks the
+header asks for. Sector 0 and the sector trailers are never used.
+"""
+import math
+import struct
+
+from frame_protocol import crc16
+
+BYTES_PER_BLOCK = 16
+HEADER_MAGIC = b"KB"
+LAYOUT_VERSION = 1
+HEADER_FORMAT = "<2sBBHH"
+HEADER_CRC_OFFSET = 8
+
+# Cards written before the header layout used sectors 1-4 without a header
+LEGACY_DATA_BLOCKS = 12
+
+# Data blocks per card type: 3 per 4-block sector, 15 per 16-block sector (4K sectors 32-39)
+CARD_DATA_BLOCKS = {
+    "MIFARE Mini": 4 * 3,
+    "MIFARE 1K": 15 * 3,
+    "MIFARE 4K": 31 * 3 + 8 * 15,
+}
+DEFAULT_CARD_TYPE = "MIFARE 1K"
+
+# Message buffer of the sketch: a full 1K card on boards with less than 4 KB of RAM (Uno, Nano,
+# Pro Micro), a full 4K card on bigger ones such as the Mega
+SMALL_BOARD_MAX_PAYLOAD = (CARD_DATA_BLOCKS["MIFARE 1K"] - 1) * BYTES_PER_BLOCK
+LARGE_BOARD_MAX_PAYLOAD = (CARD_DATA_BLOCKS["MIFARE 4K"] - 1) * BYTES_PER_BLOCK
+
+
+def capacity(card_type=DEFAULT_CARD_TYPE, max_payload=SMALL_BOARD_MAX_PAYLOAD):
+    """Payload bytes that fit on a card of the given type and in the sketch's message buffer
+
+    max_payload defaults to the buffer of the boards the project is built
+    for; pass LARGE_BOARD_MAX_PAYLOAD for a board that holds a full 4K card.
+    """
+    return min((CARD_DATA_BLOCKS[card_type] - 1) * BYTES_PER_BLOCK, max_payload)
+
+
+def blocks_needed(payload_length):
+    """Data blocks used by a payload, header block included"""
+    return 1 + math.ceil(payload_length / BYTES_PER_BLOCK)
+
+
+def data_block_number(index):
+    """Absolute block number of the index-th data block"""
+    small_data_blocks = 31 * 3
+    if index < small_data_blocks:
+        return (index // 3 + 1) * 4 + index % 3
+    index -= small_data_blocks
+    return 128 + (index // 15) * 16 + index % 15
+
+
+def sector_of_block(block):
+    if block < 128:
+        return block // 4
+    return 32 + (block - 128) // 16
+
+
+def encode_header(payload, flags=0):
+    """Build the header block for payload"""
+    header = struct.pack(HEADER_FORMAT, HEADER_MAGIC, LAYOUT_VERSION, flags, len(payload), crc16(payload))
+    header += struct.pack("<H", crc16(header))
+    return header.ljust(BYTES_PER_BLOCK, b"\0")
+
+
+def parse_header(block):
+    """Return (length, payload_crc, flags) for a valid header block, else None"""
+    magic, version, flags, length, payload_crc = struct.unpack_from(HEADER_FORMAT, block)
+    if magic != HEADER_MAGIC or version != LAYOUT_VERSION:
+        return None
+    (header_crc,) = struct.unpack_from("<H", block, HEADER_CRC_OFFSET)
+    if crc16(block[:HEADER_CRC_OFFSET]) != header_crc:
+        return None
+    return length, payload_crc, flags
+
+
+def encode_card(payload, flags=0):
+    """Header plus zero-padded payload, as the list of data blocks written to the card"""
+    image = encode_header(payload, flags) + bytes(payload)
+    image = image.ljust(blocks_needed(len(payload)) * BYTES_PER_BLOCK, b"\0")
+    return [image[i:i + BYTES_PER_BLOCK] for i in range(0, len(image), BYTES_PER_BLOCK)]
@@ -0,0 +1,101 @@
+"""Vigenère cipher used for card messages
+
+Letters are shifted by the key, which only advances on letters; every other
+character is copied unchanged. ASCII text (the normal case) is handled with
+whole-buffer operations: the letters are pulled out with bytes.translate,
+shifted all at once by adding the repeated key as a big integer (no byte
+can carry into the next), reduced mod 26 with another translate table and
+put back between the untouched characters. The key schedule is cached per
+key. Other text goes through the per-character path, which keeps the
+original semantics of str.isalpha/str.isupper for non-ASCII letters.
+"""
+import re
+from functools import lru_cache
+
+ALPHABET_SIZE = 26
+# Keys whose shift schedules are kept
+KEY_CACHE_SIZE = 128
+
+_UPPER = bytes(range(ord("A"), ord("Z") + 1))
+_LOWER = bytes(range(ord("a"), ord("z") + 1))
+_NON_LETTERS = bytes(b for b in range(256) if b not in _UPPER and b not in _LOWER)
+_LETTER_RUNS = re.compile(rb"([A-Za-z]+)")
+# Letter -> position in its alphabet, and letter -> first letter of its case
+_TO_INDEX = bytes.maketrans(_UPPER + _LOWER, bytes(range(ALPHABET_SIZE)) * 2)
+_TO_BASE = bytes.maketrans(_UPPER + _LOWER, _UPPER[:1] * ALPHABET_SIZE + _LOWER[:1] * ALPHABET_SIZE)
+# index + shift is at most 50
+_MOD_ALPHABET = bytes(b % ALPHABET_SIZE for b in range(256))
+
+
+@lru_cache(maxsize=KEY_CACHE_SIZE)
+def _schedule(key, direction):
+    """Shift for every key position, as used by the original loop and reduced mod 26 as bytes"""
+    shifts = tuple(direction * (ord(k) - ord("A")) for k in key.upper())
+    return shifts, bytes(shift % ALPHABET_SIZE for shift in shifts)
+
+
+def _apply(text, key, direction):
+    if not key:
+        return text
+    shifts, stream = _schedule(key, direction)
+    if not text.isascii():
+        return _apply_per_character(text, shifts)
+
+    raw = text.encode("ascii")
+    letters = raw.translate(None, _NON_LETTERS)
+    count = len(letters)
+    if not count:
+        return text
+
+    # Letter i uses key position i % len(key)
+    stream = (stream * (count // len(stream) + 1))[:count]
+    shifted = int.from_bytes(letters.translate(_TO_INDEX), "big") + int.from_bytes(stream, "big")
+    shifted = shifted.to_bytes(count, "big").translate(_MOD_ALPHABET)
+    shifted = int.from_bytes(shifted, "big") + int.from_bytes(letters.translate(_TO_BASE), "big")
+    shifted = shifted.to_bytes(count, "big")
+    if count == len(raw):
+        return shifted.decode("ascii")
+
+    # Put the shifted letters back between the untouched characters
+    pieces = _LETTER_RUNS.split(raw)
+    offset = 0
+    for i in range(1, len(pieces), 2):
+        end = offset + len(pieces[i])
+        pieces[i] = shifted[offset:end]
+        offset = end
+    return b"".join(pieces).decode("ascii")
+
+
+def _apply_per_character(text, shifts):
+    result = []
+    key_index = 0
+    for char in text:
+        if char.isalpha():
+            base = ord("A") if char.isupper() else ord("a")
+            result.append(chr((ord(char) - base + shifts[key_index % len(shifts)]) % ALPHABET_SIZE + base))
+            key_index += 1
+        else:
+            result.append(char)
+    return "".join(result)
+
+
+class VigenereCipher:
+    @staticmethod
+    def encrypt(text, key):
+        """Encrypt text using Vigenère cipher"""
+        return _apply(text, key, 1)
+
+    @staticmethod
+    def decrypt(text, key):
+        """Decrypt text using Vigenère cipher"""
+        return _apply(text, key, -1)
+
+    @staticmethod
+    def encrypt_many(messages, key):
+        """Encrypt a batch of messages with one key"""
+        return [_apply(text, key, 1) for text in messages]
+
+    @staticmethod
+    def decrypt_many(messages, key):
+        """Decrypt a batch of messages with one key"""
+        return [_apply(text, key, -1) for text in messages]
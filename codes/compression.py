@@ -0,0 +1,62 @@
+"""Optional payload compression, flagged in the card header
+
+A compressed payload is raw deflate (no zlib wrapper; the card header
+already checksums the payload) primed with PRESET_DICTIONARY, which holds
+words and fragments common in short messages so that even a few dozen
+characters compress. The header flags byte records the method, so a
+reader knows how to expand the payload. PRESET_DICTIONARY must never
+change: cards written with it could no longer be read. A new dictionary
+needs a new flag.
+
+Compression works on the bytes that go onto the card, i.e. after
+encryption: VigenereCipher works on text, and deflate output is not text.
+Encrypted text compresses less well than plain text because the key hides
+repeated words, but it still loses the redundancy of spaces, punctuation
+and key-aligned repeats.
+"""
+import zlib
+
+import card_layout
+
+FLAG_DEFLATE = 0x01  # Raw deflate with PRESET_DICTIONARY
+KNOWN_FLAGS = FLAG_DEFLATE
+
+# Most common material last: deflate finds the nearest match first
+PRESET_DICTIONARY = (
+    b"0123456789 :/-.,;!?()@#%&+=_\"' "
+    b"https://www. .com .org .net mailto: tel: +1 "
+    b"Name: Email: Phone: Address: Room: Floor: Building: Access: Level: Expires: Valid until: "
+    b"ID: Employee Student Visitor Guest Staff Member Card Badge Pass Ticket Key "
+    b"January February March April May June July August September October November December "
+    b"Monday Tuesday Wednesday Thursday Friday Saturday Sunday "
+    b"please thank you welcome hello contact number information message secret private "
+    b"about after again also because before could first from have into just like more most "
+    b"only other over some than their there these they this time very what when where which "
+    b"will with would your you are was were has had not but all can her his one our out "
+    b" the The and And of Of to To in In is Is for For on On it It that That a A "
+)
+
+
+def compress(data):
+    """Return (payload, flags): deflated data if that saves card blocks, else the data unchanged"""
+    compressor = zlib.compressobj(9, zlib.DEFLATED, -15, 9, zlib.Z_DEFAULT_STRATEGY, PRESET_DICTIONARY)
+    packed = compressor.compress(data) + compressor.flush()
+    if card_layout.blocks_needed(len(packed)) < card_layout.blocks_needed(len(data)):
+        return packed, FLAG_DEFLATE
+    return data, 0
+
+
+def decompress(payload, flags):
+    """Expand a payload read from a card with the given header flags"""
+    if flags & ~KNOWN_FLAGS:
+        raise ValueError(f"Unknown payload flags 0x{flags:02x}")
+    if not flags & FLAG_DEFLATE:
+        return payload
+    decompressor = zlib.decompressobj(-15, PRESET_DICTIONARY)
+    return decompressor.decompress(payload) + decompressor.flush()
+
+
+def parse_hex_line(line):
+    """Decode the text protocol's DATA_HEX:<flags>:<hex> line into (payload, flags)"""
+    flags, data = line[len("DATA_HEX:"):].split(":", 1)
+    return bytes.fromhex(data), int(flags)
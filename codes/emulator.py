@@ -0,0 +1,1264 @@
+"""Software KhabiByte reader: arduino_rfid_manager.ino and an RC522 behind a pseudo-terminal
+
+    python emulator.py [--cards N] [--card-type "MIFARE 1K"] [--arrival 0.5] [--block-latency 0.005]
+
+Prints the path of the pty; SerialLink, KhabiByte.py, batch.py and the
+reader pool connect to it exactly as to a board on a USB port. Firmware is a
+line-for-line port of the sketch: the same text commands and response
+lines, the same binary frames, the same card header layout and RF plan
+(one authentication per sector). It runs against VirtualCard objects that
+hold the full block memory of a MIFARE Mini, 1K or 4K card, sector
+trailers and manufacturer block included.
+
+Cards reach the reader through Emulator.present(). With auto_present (the
+default) the next virtual card, in turn, arrives arrival_latency seconds
+after the sketch starts waiting for one, which is what load runs need. Each
+authentication and each block read or write takes auth_latency or
+block_latency seconds, and with model_baud the serial output takes as long
+as it would at the negotiated baud rate.
+
+    with Emulator(make_cards(3), arrival_latency=0.05) as emulator:
+        link = SerialLink.open(emulator.port, reset_board=False)
+"""
+import argparse
+import os
+import re
+import select
+import struct
+import threading
+import time
+import tty
+from collections import deque, namedtuple
+
+import card_layout
+from frame_protocol import (
+    crc16, encode_frame, SYNC,
+    STATUS_OK, STATUS_PARTIAL, STATUS_FAILED, STATUS_NO_DATA, STATUS_BAD_CRC, STATUS_TOO_LONG,
+    STATUS_UNKNOWN_OPCODE, STATUS_BAD_CHECKSUM, STATUS_UNSUPPORTED_CARD,
+    OP_PING, OP_READ_MULTI, OP_WRITE_MULTI, OP_WRITE_DIFF, OP_BATCH_WRITE, OP_BATCH_END, OP_SCAN, OP_SCAN_END,
+    OP_SET_FLAGS, OP_TIMING, OP_TEXT_MODE, OP_PONG, OP_READ_RESULT, OP_WRITE_RESULT, OP_ARMED, OP_BATCH_CARD,
+    OP_BATCH_DONE, OP_SCAN_CARD, OP_SCAN_DONE, OP_PHASE, OP_QUEUED, OP_TEXT_MODE_OK, OP_ERROR, STATUS_QUEUE_FULL,
+    BLOCK_VERIFY_MISMATCH,
+)
+
+# Seconds between a card being wanted and the next virtual card arriving
+ARRIVAL_LATENCY = 0.5
+# Seconds per authentication and per block read or write, about what an RC522 takes
+AUTH_LATENCY = 0.005
+BLOCK_LATENCY = 0.005
+POLL_INTERVAL = 0.05
+
+# Sketch limits: a board with 8 KB of RAM buffers a full 4K card
+DEFAULT_BAUD = 9600
+SUPPORTED_BAUDS = (19200, 38400, 57600, 115200, 230400, 250000, 500000, 1000000)
+BAUD_VERIFY_TIMEOUT = 1.0
+COMMAND_BUFFER_SIZE = 32
+MAX_DATA_BLOCKS = card_layout.CARD_DATA_BLOCKS["MIFARE 4K"]
+MAX_PAYLOAD = (MAX_DATA_BLOCKS - 1) * card_layout.BYTES_PER_BLOCK
+MAX_FRAME_ARGS = 16
+FRAME_TIMEOUT = 0.2
+DATA_OPCODES = (OP_WRITE_MULTI, OP_WRITE_DIFF, OP_BATCH_WRITE)
+JOURNAL_ENTRIES = 4
+JOB_BUFFER_SIZE = 1024
+MAX_QUEUED_JOBS = 4
+# AVR serial RX buffer. With no card in the field every PICC_IsNewCardPresent() waits for the RC522
+# timeout, and input that arrives meanwhile beyond the buffer is lost; hence the limit on queued data
+RX_BUFFER_SIZE = 64
+CARD_POLL_TIMEOUT = 0.025
+MAX_QUEUED_DATA = RX_BUFFER_SIZE - 13
+JOB_OPERATIONS = ("READ_MULTI", "WRITE_MULTI", "WRITE_DIFF")
+
+# MFRC522::StatusCode values and their GetStatusCodeName() texts
+MFRC522_OK = 0
+MFRC522_ERROR = 1
+MFRC522_TIMEOUT = 3
+MFRC522_NACK = 0xFF
+MFRC522_STATUS_NAMES = {
+    0: "Success.",
+    1: "Error in communication.",
+    2: "Collision detected.",
+    3: "Timeout in communication.",
+    4: "A buffer is not big enough.",
+    5: "Internal error in the code. Should not happen.",
+    6: "Invalid argument.",
+    7: "The CRC_A does not match.",
+    0xFF: "A MIFARE PICC responded with NAK.",
+}
+
+# Total blocks and SAK per card type; PICC_GetType() goes by the SAK
+CARD_BLOCKS = {"MIFARE Mini": 20, "MIFARE 1K": 64, "MIFARE 4K": 256}
+CARD_SAK = {"MIFARE Mini": 0x09, "MIFARE 1K": 0x08, "MIFARE 4K": 0x18}
+SAK_DATA_BLOCKS = {CARD_SAK[name]: blocks for name, blocks in card_layout.CARD_DATA_BLOCKS.items()}
+DEFAULT_KEY = b"\xff" * 6
+# Transport configuration: key A, access bits FF 07 80, user byte, key B
+DEFAULT_TRAILER = DEFAULT_KEY + b"\xff\x07\x80\x69" + DEFAULT_KEY
+
+_LEADING_INT = re.compile(rb"\s*([-+]?\d+)")
+
+# Where an interrupted write stopped: next_index is the first data block not yet written and verified
+JournalEntry = namedtuple("JournalEntry", ["uid", "payload_length", "payload_crc", "flags", "last_block", "next_index"])
+
+
+def make_cards(count, card_type=card_layout.DEFAULT_CARD_TYPE):
+    """count blank cards with distinct 4-byte UIDs"""
+    return [VirtualCard(f"{0xE0000001 + i:08X}", card_type) for i in range(count)]
+
+
+def _to_int(text):
+    """String::toInt(): leading digits, 0 when there are none"""
+    match = _LEADING_INT.match(text)
+    return int(match.group(1)) if match else 0
+
+
+class VirtualCard:
+    """A MIFARE Classic card: UID, SAK and block memory
+
+    Blocks in faulty_blocks time out on every read and write, like a card
+    with a damaged antenna or one held at the edge of the field. After
+    leave_after(n) the card answers n more RF commands and then leaves the
+    field: everything times out until it is presented again.
+    """
+
+    def __init__(self, uid, card_type=card_layout.DEFAULT_CARD_TYPE, sak=None):
+        self.uid = bytes.fromhex(uid) if isinstance(uid, str) else bytes(uid)
+        self.card_type = card_type
+        self.sak = CARD_SAK[card_type] if sak is None else sak
+        self.memory = [bytearray(card_layout.BYTES_PER_BLOCK) for _ in range(CARD_BLOCKS[card_type])]
+        self.faulty_blocks = set()
+        self.authenticated_sector = None
+        self.commands_left = None  # RF commands until the card leaves the field, None to stay
+
+        # Manufacturer block: UID, BCC (4-byte UIDs), SAK, ATQA
+        block0 = self.uid + (bytes([self.uid[0] ^ self.uid[1] ^ self.uid[2] ^ self.uid[3]]) if len(self.uid) == 4 else b"")
+        block0 += bytes([self.sak, 0x04, 0x00])
+        self.memory[0][:len(block0)] = block0
+        for block in range(len(self.memory)):
+            if self.is_trailer(block):
+                self.memory[block][:] = DEFAULT_TRAILER
+
+    @property
+    def uid_hex(self):
+        return self.uid.hex().upper()
+
+    @staticmethod
+    def is_trailer(block):
+        if block < 128:
+            return block % 4 == 3
+        return (block - 128) % 16 == 15
+
+    def halt(self):
+        self.authenticated_sector = None
+
+    def leave_after(self, commands):
+        self.commands_left = commands
+
+    @property
+    def in_field(self):
+        return self.commands_left != 0
+
+    def _answers(self):
+        """Whether the card is still there for one more RF command"""
+        if self.commands_left == 0:
+            return False
+        if self.commands_left is not None:
+            self.commands_left -= 1
+        return True
+
+    def authenticate(self, block, key):
+        """PCD_Authenticate with key A"""
+        if not self._answers() or block >= len(self.memory) or block in self.faulty_blocks:
+            self.authenticated_sector = None
+            return MFRC522_TIMEOUT
+        sector = card_layout.sector_of_block(block)
+        trailer = block | 3 if block < 128 else block | 15
+        if bytes(self.memory[trailer][:6]) != key:
+            self.authenticated_sector = None
+            return MFRC522_TIMEOUT
+        self.authenticated_sector = sector
+        return MFRC522_OK
+
+    def _check_access(self, block):
+        if not self._answers() or block in self.faulty_blocks:
+            self.authenticated_sector = None
+            return MFRC522_TIMEOUT
+        if block >= len(self.memory) or card_layout.sector_of_block(block) != self.authenticated_sector:
+            # The card drops out of the authenticated state after a NAK
+            self.authenticated_sector = None
+            return MFRC522_NACK
+        return MFRC522_OK
+
+    def read_block(self, block):
+        """MIFARE_Read; returns (status, 16 bytes)"""
+        status = self._check_access(block)
+        if status != MFRC522_OK:
+            return status, bytes(card_layout.BYTES_PER_BLOCK)
+        return status, bytes(self.memory[block])
+
+    def write_block(self, block, data):
+        """MIFARE_Write; block 0 is read-only"""
+        status = self._check_access(block)
+        if status == MFRC522_OK and block == 0:
+            self.authenticated_sector = None
+            status = MFRC522_NACK
+        if status == MFRC522_OK:
+            self.memory[block][:] = bytes(data[:card_layout.BYTES_PER_BLOCK]).ljust(card_layout.BYTES_PER_BLOCK, b"\0")
+        return status
+
+    def data_blocks(self):
+        return card_layout.CARD_DATA_BLOCKS[self.card_type]
+
+    def load(self, payload, flags=0):
+        """Store payload with a header, as a write by the sketch would (stale blocks are left alone)"""
+        for index, block in enumerate(card_layout.encode_card(payload, flags)):
+            self.memory[card_layout.data_block_number(index)][:] = block
+
+    def stored_payload(self):
+        """(payload, flags) from the card header, or None when the card holds no valid message"""
+        header = card_layout.parse_header(bytes(self.memory[card_layout.data_block_number(0)]))
+        if header is None:
+            return None
+        length, payload_crc, flags = header
+        blocks = card_layout.blocks_needed(length)
+        if blocks > self.data_blocks():
+            return None
+        payload = b"".join(bytes(self.memory[card_layout.data_block_number(i)]) for i in range(1, blocks))[:length]
+        if crc16(payload) != payload_crc:
+            return None
+        return payload, flags
+
+
+def _is_empty(block):
+    return not any(block)
+
+
+class Firmware:
+    """Port of arduino_rfid_manager.ino; every method mirrors the sketch function of the same name"""
+
+    def __init__(self, emulator):
+        self.emulator = emulator
+        self.binary_mode = False
+        self.batch_mode = False
+        self.waiting_for_card = False
+        self.current_operation = ""
+        self.blocks_to_read = card_layout.LEGACY_DATA_BLOCKS
+        self.blocks_to_write = 1
+        self.payload = b""
+        self.payload_flags = 0
+        self.next_payload_flags = 0
+        self.last_batch_uid = None
+        self.card = None
+        self.card_data_blocks = 0
+        self.baudrate = DEFAULT_BAUD
+        self.timing_enabled = False
+        self.boot_time = time.monotonic()
+        self.frame = bytearray()
+        self.last_frame_byte = 0
+        self.journal = [None] * JOURNAL_ENTRIES
+        self.next_journal_entry = 0
+        self.jobs = deque()  # (opcode, arg, data) of queued jobs
+        self.frame_target = None
+        self._begin_rf_plan()
+
+    # Serial output
+
+    def print(self, text):
+        self.emulator.send(text.encode() if isinstance(text, str) else text)
+
+    def println(self, text=""):
+        self.print((text.encode() if isinstance(text, str) else text) + b"\r\n")
+
+    def out(self, text):
+        """Human readable chatter, dropped in binary mode"""
+        if not self.binary_mode:
+            self.println(text)
+
+    def send_frame(self, opcode, payload=b""):
+        self.emulator.send(encode_frame(opcode, payload))
+
+    def millis(self):
+        return int((time.monotonic() - self.boot_time) * 1000) & 0xFFFFFFFF
+
+    def mark_phase(self, phase):
+        if not self.timing_enabled:
+            return
+        if self.binary_mode:
+            self.send_frame(OP_PHASE, struct.pack("<I", self.millis()) + phase.encode())
+        else:
+            self.println(f"T:{phase}:{self.millis()}")
+
+    def send_result_frame(self, opcode, status, data=b""):
+        # status | auth count (2) | read/write count (2) | block count | (block, status) pairs | data
+        body = struct.pack("<BHHHB", status, self.auth_count, self.transfer_count, self.blocks_touched, len(self.results))
+        body += b"".join(bytes(result) for result in self.results)
+        self.send_frame(opcode, body + data)
+
+    # Main loop
+
+    def loop(self):
+        if self.binary_mode:
+            self.receive_frame_bytes()
+        else:
+            line = self.emulator.read_line()
+            if line is not None:
+                self.handle_line(line)
+
+        if self.waiting_for_card:
+            card = self.emulator.next_card()
+            if card is not None:
+                self.serve_card(card)
+
+    def handle_line(self, line):
+        expecting_message = self.current_operation in ("WRITE_MULTI", "WRITE_DIFF", "WRITE", "BATCH") and not self.waiting_for_card
+        # Lines that don't fit the command buffer are messages or noise
+        if len(line) >= COMMAND_BUFFER_SIZE:
+            if expecting_message:
+                self.accept_message(line)
+            return
+
+        command = line.strip().decode("latin-1")
+        if command == "BATCH_END":
+            self.end_batch()
+            self.println("BATCH_DONE")
+        elif self.batch_mode and expecting_message:
+            self.accept_message(line)
+        elif command == "PING":
+            self.println("PONG")
+        elif command.startswith("BAUD:"):
+            self.negotiate_baud(_to_int(line.strip()[5:]))
+        elif command.startswith("TIMING:"):
+            self.timing_enabled = _to_int(line.strip()[7:]) != 0
+            self.println("TIMING_OK")
+        elif command == "BINARY":
+            self.println("BINARY_OK")
+            self.binary_mode = True
+            self.frame.clear()
+        elif command == "BATCH":
+            self.begin_batch()
+            self.println("BATCH_OK")
+        elif command == "SCAN":
+            self.begin_scan()
+            self.println("SCAN_OK")
+        elif command == "SCAN_END":
+            self.end_scan()
+            self.println("SCAN_DONE")
+        elif command == "READ_MULTI" or command.startswith("READ_MULTI:"):
+            self.current_operation = "READ_MULTI"
+            self.blocks_to_read = _to_int(line.strip()[11:]) if len(command) > 11 else card_layout.LEGACY_DATA_BLOCKS
+            self.waiting_for_card = True
+            self.println("Ready to read multiple blocks. Please place card near reader...")
+            self.mark_phase("armed")
+        elif command.startswith("WRITE_MULTI:"):
+            self.current_operation = "WRITE_MULTI"
+            self.blocks_to_write = _to_int(line.strip()[12:])
+            self.println(f"Ready to write {self.blocks_to_write} blocks. Send message to write...")
+        elif command.startswith("WRITE_DIFF:"):
+            self.current_operation = "WRITE_DIFF"
+            self.blocks_to_write = _to_int(line.strip()[11:])
+            self.println(f"Ready to write {self.blocks_to_write} blocks (differential). Send message to write...")
+        elif command == "READ":
+            self.current_operation = "READ"
+            self.waiting_for_card = True
+            self.println("Ready to read single block. Please place card near reader...")
+        elif command == "WRITE":
+            self.current_operation = "WRITE"
+            self.blocks_to_write = 1
+            self.println("Ready to receive data. Send message to write...")
+        elif expecting_message:
+            self.accept_message(line)
+
+    def serve_card(self, card):
+        """PICC_IsNewCardPresent() && PICC_ReadCardSerial() succeeded"""
+        self.card = card
+        card.halt()
+        self.mark_phase("card")
+        try:
+            if self.current_operation == "BATCH":
+                # The card that was just provisioned may be lifted and put back; leave it alone
+                if card.uid != self.last_batch_uid:
+                    self.write_batch_card()
+                    self.waiting_for_card = False
+                return
+
+            # Every other result is preceded by the card's UID
+            self.report_card_uid()
+
+            if self.current_operation == "SCAN":
+                self.read_multiple_blocks()
+                return
+
+            if self.current_operation == "READ_MULTI":
+                self.read_multiple_blocks()
+            elif self.current_operation == "READ":
+                self.read_single_block()
+            elif self.current_operation == "WRITE_MULTI":
+                self.write_multiple_blocks()
+            elif self.current_operation == "WRITE_DIFF":
+                self.write_changed_blocks()
+            elif self.current_operation == "WRITE":
+                self.write_single_block()
+
+            self.waiting_for_card = False
+            self.current_operation = "BATCH" if self.batch_mode else ""
+            self.start_next_job()
+        finally:
+            card.halt()
+            self.card = None
+
+    def accept_message(self, line):
+        # Refuse a message that overflows the buffer rather than write a truncated one
+        if line[MAX_PAYLOAD:].strip():
+            self.payload = b""
+            if not self.batch_mode:
+                self.current_operation = ""
+            self.println("Write failed: Message too long")
+            return
+        self.payload = line[:MAX_PAYLOAD].strip()
+        self.payload_flags = 0
+        self.waiting_for_card = True
+        if not self.batch_mode:
+            # In batch mode the client streams the next message right after each card
+            self.println(f"Ready to write. Message length: {len(self.payload)} characters. Please place card near reader...")
+        self.mark_phase("armed")
+
+    def negotiate_baud(self, rate):
+        if rate not in SUPPORTED_BAUDS:
+            self.println(f"BAUD failed: unsupported rate {rate}")
+            return
+
+        self.println(f"BAUD_OK:{rate}")
+        self.baudrate = rate
+        # The client must echo a line back at the new rate, otherwise we drop back
+        deadline = time.monotonic() + BAUD_VERIFY_TIMEOUT
+        while time.monotonic() < deadline:
+            line = self.emulator.read_line(deadline - time.monotonic())
+            if line is not None and line.strip().startswith(b"ECHO:"):
+                self.println(line.strip())
+                return
+
+        self.baudrate = DEFAULT_BAUD
+        self.println(f"BAUD_FALLBACK:{DEFAULT_BAUD}")
+
+    # Binary framed protocol
+
+    def receive_frame_bytes(self):
+        # Drop a partial frame if the sender went quiet in the middle of it
+        if self.frame and time.monotonic() - self.last_frame_byte > FRAME_TIMEOUT:
+            self.frame.clear()
+
+        for b in self.emulator.read_bytes():
+            self.last_frame_byte = time.monotonic()
+            if not self.frame:
+                if b == SYNC:
+                    self.frame.append(b)  # Anything else is noise, resync on SYNC
+                continue
+
+            self.frame.append(b)
+            if len(self.frame) == 4:
+                opcode, length = struct.unpack_from("<BH", self.frame, 1)
+                # Where the sketch receives the body: payload, behind the queued jobs' data or nowhere
+                self.frame_target = "payload" if opcode in DATA_OPCODES else "args"
+                if opcode in DATA_OPCODES and opcode != OP_BATCH_WRITE and self.job_armed():
+                    used = sum(len(job[2]) for job in self.jobs)
+                    fits = len(self.jobs) < MAX_QUEUED_JOBS and length <= JOB_BUFFER_SIZE - used
+                    self.frame_target = "queue" if fits else None
+                if length > (MAX_PAYLOAD if opcode in DATA_OPCODES else MAX_FRAME_ARGS):
+                    self.send_frame(OP_ERROR, bytes([STATUS_TOO_LONG]))
+                    self.frame.clear()
+                elif self.frame_target in ("queue", None) and length > MAX_QUEUED_DATA:
+                    # Part of it may already be lost; the client sends it again once the reader is idle
+                    self.send_frame(OP_ERROR, bytes([STATUS_QUEUE_FULL]))
+                    self.frame.clear()
+                continue
+
+            if len(self.frame) > 4:
+                opcode, length = struct.unpack_from("<BH", self.frame, 1)
+                if len(self.frame) == 4 + length + 2:
+                    body = bytes(self.frame[4:4 + length])
+                    (received,) = struct.unpack_from("<H", self.frame, 4 + length)
+                    valid = crc16(self.frame[1:4 + length]) == received
+                    self.frame.clear()
+                    if valid:
+                        self.handle_frame(opcode, body)
+                    else:
+                        if self.frame_target == "payload":
+                            # The armed write buffer was overwritten by a corrupt frame
+                            self.waiting_for_card = False
+                            self.current_operation = ""
+                        self.send_frame(OP_ERROR, bytes([STATUS_BAD_CRC]))
+
+    def handle_frame(self, opcode, body):
+        if opcode == OP_PING:
+            self.send_frame(OP_PONG)
+        elif opcode in (OP_READ_MULTI, OP_WRITE_MULTI, OP_WRITE_DIFF):
+            # Reads take an optional argument: the number of blocks the client expects
+            if opcode == OP_READ_MULTI:
+                arg = body[0] if body else card_layout.LEGACY_DATA_BLOCKS
+                body = b""
+            else:
+                arg = self.next_payload_flags
+                self.next_payload_flags = 0
+
+            # A write goes where its data was received
+            queue = self.job_armed() if opcode == OP_READ_MULTI else self.frame_target != "payload"
+            if not queue:
+                self.arm_job(opcode, arg, body)
+                self.send_frame(OP_ARMED, bytes([STATUS_OK]))
+                self.mark_phase("armed")
+            elif self.frame_target is None or len(self.jobs) == MAX_QUEUED_JOBS:
+                self.send_frame(OP_ERROR, bytes([STATUS_QUEUE_FULL]))
+            else:
+                self.jobs.append((opcode, arg, body))
+                self.send_frame(OP_QUEUED, bytes([len(self.jobs)]))
+                # The armed job may have finished while this frame was coming in
+                if not self.job_armed():
+                    self.start_next_job()
+        elif opcode == OP_BATCH_WRITE:
+            # Message for the next new card; the reader stays in batch mode until OP_BATCH_END
+            if not self.batch_mode:
+                self.begin_batch()
+            self.arm_write(body)
+            self.current_operation = "BATCH"
+            self.send_frame(OP_ARMED, bytes([STATUS_OK]))
+            self.mark_phase("armed")
+        elif opcode == OP_BATCH_END:
+            self.end_batch()
+            self.send_frame(OP_BATCH_DONE)
+        elif opcode == OP_SCAN:
+            self.begin_scan()
+            self.send_frame(OP_ARMED, bytes([STATUS_OK]))
+        elif opcode == OP_SCAN_END:
+            self.end_scan()
+            self.send_frame(OP_SCAN_DONE)
+        elif opcode == OP_SET_FLAGS:
+            # No reply: the write frame that follows carries the answer
+            self.next_payload_flags = body[0] if body else 0
+        elif opcode == OP_TIMING:
+            # No reply, like OP_SET_FLAGS
+            self.timing_enabled = bool(body) and body[0] != 0
+        elif opcode == OP_TEXT_MODE:
+            # Queued jobs belong to the binary session
+            self.clear_jobs()
+            self.send_frame(OP_TEXT_MODE_OK)
+            self.binary_mode = False
+        else:
+            self.send_frame(OP_ERROR, bytes([STATUS_UNKNOWN_OPCODE]))
+
+    def arm_write(self, body):
+        self.payload = body
+        self.payload_flags = self.next_payload_flags
+        self.next_payload_flags = 0
+        self.blocks_to_write = card_layout.blocks_needed(len(body))
+        self.waiting_for_card = True
+
+    # RF transaction planner: one authentication per sector
+
+    def _begin_rf_plan(self):
+        self.auth_count = 0
+        self.transfer_count = 0
+        self.authenticated_sector = None
+        # Data blocks the operation moved to, each one an authentication for a plan without sector reuse
+        self.blocks_touched = 0
+        self.last_touched_block = None
+        self.results = []
+
+    def authenticate_block(self, block):
+        if block != self.last_touched_block:
+            self.blocks_touched += 1
+            self.last_touched_block = block
+        sector = card_layout.sector_of_block(block)
+        if sector == self.authenticated_sector:
+            return MFRC522_OK
+        self.emulator.rf_delay(self.emulator.auth_latency)
+        status = self.card.authenticate(block, DEFAULT_KEY)
+        self.auth_count += 1
+        self.authenticated_sector = sector if status == MFRC522_OK else None
+        return status
+
+    def read_block(self, block):
+        self.emulator.rf_delay(self.emulator.block_latency)
+        status, data = self.card.read_block(block)
+        self.transfer_count += 1
+        if status != MFRC522_OK:
+            self.authenticated_sector = None
+        return status, data
+
+    def write_block(self, block, data):
+        self.emulator.rf_delay(self.emulator.block_latency)
+        status = self.card.write_block(block, data)
+        self.transfer_count += 1
+        if status != MFRC522_OK:
+            self.authenticated_sector = None
+        return status
+
+    def record_block_result(self, block, status):
+        if len(self.results) < MAX_DATA_BLOCKS:
+            self.results.append((block, status))
+
+    def operation_status(self, blocks_done):
+        if blocks_done == 0:
+            return STATUS_FAILED
+        if blocks_done < len(self.results):
+            return STATUS_PARTIAL
+        return STATUS_OK
+
+    def detect_card_data_blocks(self):
+        return min(SAK_DATA_BLOCKS.get(self.card.sak & 0x7F, 0), MAX_DATA_BLOCKS)
+
+    def build_header(self):
+        return card_layout.encode_header(self.payload, self.payload_flags)
+
+    def stored_message_blocks(self, header):
+        parsed = card_layout.parse_header(header)
+        if parsed is None:
+            return 0 if _is_empty(header) else card_layout.LEGACY_DATA_BLOCKS
+        return card_layout.blocks_needed(parsed[0])
+
+    def report_block_failure(self, what, block, status):
+        reason = "Data read back differs" if status == BLOCK_VERIFY_MISMATCH else MFRC522_STATUS_NAMES.get(status, "Unknown error")
+        self.out(f"{what} failed for block {block}: {reason}")
+
+    def report_rf_plan(self):
+        self.out(f"RF: {self.auth_count} auth, {self.transfer_count} read/write commands on {self.blocks_touched} blocks")
+
+    # Card operations
+
+    def read_single_block(self):
+        block = 4
+        self.emulator.rf_delay(self.emulator.auth_latency)
+        status = self.card.authenticate(block, DEFAULT_KEY)
+        if status != MFRC522_OK:
+            self.println(f"Read failed: Authentication error - {MFRC522_STATUS_NAMES[status]}")
+            return
+
+        self.emulator.rf_delay(self.emulator.block_latency)
+        status, data = self.card.read_block(block)
+        if status == MFRC522_OK:
+            self.println(b"DATA:" + data.replace(b"\0", b""))
+            self.println("Read successful!")
+        else:
+            self.println(f"Read failed: {MFRC522_STATUS_NAMES[status]}")
+
+    def read_multiple_blocks(self):
+        self.payload = b""
+        self.payload_flags = 0
+        self._begin_rf_plan()
+        blocks_read = 0
+        checksum_ok = True
+        self.card_data_blocks = self.detect_card_data_blocks()
+
+        if self.card_data_blocks == 0:
+            if self.binary_mode:
+                self.send_result_frame(OP_READ_RESULT, STATUS_UNSUPPORTED_CARD)
+            else:
+                self.println("Read failed: Unsupported card type")
+            return
+
+        self.out("Reading multiple blocks...")
+
+        # The header block says exactly how many blocks follow
+        header_block = card_layout.data_block_number(0)
+        status = self.authenticate_block(header_block)
+        header = bytes(card_layout.BYTES_PER_BLOCK)
+        if status == MFRC522_OK:
+            status, header = self.read_block(header_block)
+        self.record_block_result(header_block, status)
+        self.mark_phase("header")
+
+        payload = bytearray()
+        if status != MFRC522_OK:
+            self.report_block_failure("Read", header_block, status)
+        elif card_layout.parse_header(header) is not None:
+            stored_length, stored_crc, self.payload_flags = card_layout.parse_header(header)
+            planned_blocks = card_layout.blocks_needed(stored_length)
+            self.out(f"Layout v{card_layout.LAYOUT_VERSION}: {stored_length} bytes in {planned_blocks} blocks")
+
+            if planned_blocks > self.card_data_blocks:
+                self.out("Header length exceeds card capacity")
+                checksum_ok = False
+            else:
+                blocks_read += 1
+                for index in range(1, planned_blocks):
+                    block = card_layout.data_block_number(index)
+                    status = self.authenticate_block(block)
+                    if status == MFRC522_OK:
+                        status, data = self.read_block(block)
+                    self.record_block_result(block, status)
+                    if status != MFRC522_OK:
+                        self.report_block_failure("Read", block, status)
+                        checksum_ok = False
+                        break
+
+                    blocks_read += 1
+                    payload += data[:stored_length - len(payload)]
+                checksum_ok = checksum_ok and crc16(payload) == stored_crc
+        elif not _is_empty(header):
+            # No header: the layout used before, scan until the first empty block
+            blocks_read += 1
+            payload += header
+            planned_blocks = max(1, min(self.blocks_to_read, card_layout.LEGACY_DATA_BLOCKS, self.card_data_blocks))
+
+            for index in range(1, planned_blocks):
+                block = card_layout.data_block_number(index)
+                status = self.authenticate_block(block)
+                if status == MFRC522_OK:
+                    status, data = self.read_block(block)
+                if status != MFRC522_OK:
+                    self.record_block_result(block, status)
+                    self.report_block_failure("Read", block, status)
+                    continue
+
+                # If we hit an empty block, we've reached the end of data
+                if _is_empty(data):
+                    break
+
+                self.record_block_result(block, status)
+                blocks_read += 1
+                payload += data
+
+            # The last block is zero padded
+            payload = payload.rstrip(b"\0")
+
+        self.payload = bytes(payload)
+        self.mark_phase("data")
+        self.report_rf_plan()
+
+        if self.binary_mode:
+            # Read result data: header flags, then the payload
+            if not checksum_ok:
+                result = STATUS_BAD_CHECKSUM
+            else:
+                result = self.operation_status(blocks_read) if self.payload else STATUS_NO_DATA
+            self.send_result_frame(OP_READ_RESULT, result, bytes([self.payload_flags]) + self.payload)
+        elif not checksum_ok:
+            self.println("Read failed: Checksum mismatch")
+        elif self.payload and self.payload_flags:
+            # Flagged (compressed) payloads are binary: DATA_HEX:<flags>:<hex>
+            self.println(f"DATA_HEX:{self.payload_flags}:{self.payload.hex().upper()}")
+            self.println(f"Read successful! Total bytes: {len(self.payload)}")
+        elif self.payload:
+            # The text protocol can't carry NUL bytes
+            characters = self.payload.replace(b"\0", b"")
+            self.println(b"DATA:" + characters)
+            self.println(f"Read successful! Total characters: {len(characters)}")
+        else:
+            self.println("Read failed: No data found")
+
+    def write_single_block(self):
+        self.println("Clearing block 4...")
+        block = 4
+
+        self.emulator.rf_delay(self.emulator.auth_latency)
+        status = self.card.authenticate(block, DEFAULT_KEY)
+        if status == MFRC522_OK:
+            self.emulator.rf_delay(self.emulator.block_latency)
+            self.card.write_block(block, bytes(card_layout.BYTES_PER_BLOCK))
+            self.println("Block cleared")
+
+        self.emulator.rf_delay(self.emulator.auth_latency)
+        status = self.card.authenticate(block, DEFAULT_KEY)
+        if status != MFRC522_OK:
+            self.println(f"Write failed: Authentication error - {MFRC522_STATUS_NAMES[status]}")
+            return
+
+        self.emulator.rf_delay(self.emulator.block_latency)
+        status = self.card.write_block(block, self.payload[:card_layout.BYTES_PER_BLOCK])
+        if status == MFRC522_OK:
+            self.println("Write successful!")
+        else:
+            self.println(f"Write failed: {MFRC522_STATUS_NAMES[status]}")
+        self.payload = b""
+
+    def check_capacity(self, blocks_needed):
+        self.card_data_blocks = self.detect_card_data_blocks()
+        if self.card_data_blocks == 0:
+            if self.binary_mode:
+                self.send_result_frame(OP_WRITE_RESULT, STATUS_UNSUPPORTED_CARD)
+            else:
+                self.println("Write failed: Unsupported card type")
+            return False
+        if blocks_needed > self.card_data_blocks:
+            if self.binary_mode:
+                self.send_result_frame(OP_WRITE_RESULT, STATUS_TOO_LONG)
+            else:
+                capacity = (self.card_data_blocks - 1) * card_layout.BYTES_PER_BLOCK
+                self.println(f"Write failed: Message too long for this card (capacity {capacity} bytes)")
+            return False
+        return True
+
+    def find_journal_entry(self):
+        payload_crc = crc16(self.payload)
+        for i, entry in enumerate(self.journal):
+            if entry is not None and entry.uid == self.card.uid and entry.payload_length == len(self.payload) \
+                    and entry.payload_crc == payload_crc and entry.flags == self.payload_flags:
+                return i
+        return -1
+
+    def update_journal(self, entry, last_block, next_index):
+        if entry < 0:
+            if next_index == 0:
+                return
+            entry = self.next_journal_entry
+            self.next_journal_entry = (self.next_journal_entry + 1) % JOURNAL_ENTRIES
+        if next_index == 0:
+            self.journal[entry] = None
+            return
+        self.journal[entry] = JournalEntry(
+            self.card.uid, len(self.payload), crc16(self.payload), self.payload_flags, last_block, next_index
+        )
+
+    def verify_block(self, block, expected):
+        status, data = self.read_block(block)
+        if status != MFRC522_OK:
+            return status
+        if data != expected:
+            return BLOCK_VERIFY_MISMATCH
+        return MFRC522_OK
+
+    def write_multiple_blocks(self):
+        """Returns the operation status (STATUS_OK when every message block was written and verified)"""
+        self._begin_rf_plan()
+        blocks_needed = card_layout.blocks_needed(len(self.payload))
+        if not self.check_capacity(blocks_needed):
+            self.payload = b""
+            return STATUS_UNSUPPORTED_CARD if self.card_data_blocks == 0 else STATUS_TOO_LONG
+
+        self.out(f"Writing {len(self.payload)} characters to multiple blocks...")
+
+        # The old header tells how far the previous message reached; the new one
+        # on the card means an interrupted write of this message can resume
+        header_block = card_layout.data_block_number(0)
+        previous_blocks = card_layout.LEGACY_DATA_BLOCKS
+        image = b"".join(card_layout.encode_card(self.payload, self.payload_flags))
+        entry = self.find_journal_entry()
+        first_index = 0
+        last_block = 0
+        if self.authenticate_block(header_block) == MFRC522_OK:
+            status, stored = self.read_block(header_block)
+            if status == MFRC522_OK:
+                previous_blocks = self.stored_message_blocks(stored)
+                if entry >= 0 and stored == image[:card_layout.BYTES_PER_BLOCK]:
+                    first_index = self.journal[entry].next_index
+                    last_block = self.journal[entry].last_block
+        self.mark_phase("header")
+        if first_index > 0:
+            self.out(f"Resuming at data block {first_index} (block {card_layout.data_block_number(first_index)})")
+        else:
+            last_block = max(blocks_needed, min(previous_blocks, self.card_data_blocks))
+
+        blocks_written = 0
+        blocks_cleared = 0
+        data_marked = False
+        index = first_index
+        while index < last_block:
+            if index >= blocks_needed and not data_marked:
+                self.mark_phase("data")
+                data_marked = True
+            block = card_layout.data_block_number(index)
+            in_message = index < blocks_needed
+            data = image[index * card_layout.BYTES_PER_BLOCK:(index + 1) * card_layout.BYTES_PER_BLOCK]
+            data = data.ljust(card_layout.BYTES_PER_BLOCK, b"\0")
+
+            failed = "Auth" if in_message else "Clear auth"
+            status = self.authenticate_block(block)
+            if status == MFRC522_OK:
+                failed = "Write" if in_message else "Clear"
+                status = self.write_block(block, data)
+            if status == MFRC522_OK and in_message:
+                blocks_written += 1
+                failed = "Verify"
+                status = self.verify_block(block, data)
+            if in_message:
+                self.record_block_result(block, status)
+
+            if status != MFRC522_OK:
+                self.report_block_failure(failed, block, status)
+                break
+            if in_message:
+                self.out(f"Block {block} written and verified")
+            else:
+                blocks_cleared += 1
+            index += 1
+
+        if not data_marked:
+            self.mark_phase("data")
+        self.mark_phase("clear")
+
+        self.out(f"Cleared {blocks_cleared} data blocks")
+        self.report_rf_plan()
+
+        # A pass that didn't get the header onto the card leaves the journal as it was
+        if index > 0:
+            self.update_journal(entry, last_block, index if index < last_block else 0)
+        blocks_verified = min(index, blocks_needed)
+        result = STATUS_FAILED
+        if blocks_verified == blocks_needed:
+            result = STATUS_OK
+        elif blocks_verified > 0:
+            result = STATUS_PARTIAL
+
+        if self.binary_mode:
+            self.send_result_frame(
+                OP_WRITE_RESULT, result, bytes([blocks_needed, blocks_verified, first_index, blocks_written])
+            )
+        elif result == STATUS_OK:
+            self.println(
+                f"Write successful! {blocks_written} blocks written, {blocks_verified} verified, "
+                f"{len(self.payload)} characters total."
+            )
+        else:
+            resume = f", present card {self.card.uid_hex} again to resume" if blocks_verified > 0 else ""
+            self.println(
+                f"Write failed: {blocks_verified} of {blocks_needed} blocks verified ({blocks_written} written){resume}"
+            )
+
+        self.payload = b""
+        return result
+
+    def job_armed(self):
+        return self.waiting_for_card and self.current_operation in JOB_OPERATIONS
+
+    def arm_job(self, opcode, arg, data):
+        if opcode == OP_READ_MULTI:
+            self.blocks_to_read = arg
+            self.current_operation = "READ_MULTI"
+        else:
+            self.payload = data
+            self.payload_flags = arg
+            self.blocks_to_write = card_layout.blocks_needed(len(data))
+            self.current_operation = "WRITE_DIFF" if opcode == OP_WRITE_DIFF else "WRITE_MULTI"
+        self.waiting_for_card = True
+
+    def start_next_job(self):
+        if not self.jobs:
+            return
+        self.arm_job(*self.jobs.popleft())
+        self.mark_phase("armed")
+
+    def clear_jobs(self):
+        self.jobs.clear()
+
+    def begin_batch(self):
+        self.clear_jobs()
+        self.batch_mode = True
+        self.current_operation = "BATCH"
+        self.waiting_for_card = False
+        self.last_batch_uid = None
+
+    def end_batch(self):
+        self.batch_mode = False
+        self.current_operation = ""
+        self.waiting_for_card = False
+        self.payload = b""
+
+    def begin_scan(self):
+        self.clear_jobs()
+        self.batch_mode = False
+        self.current_operation = "SCAN"
+        self.blocks_to_read = card_layout.LEGACY_DATA_BLOCKS
+        self.waiting_for_card = True
+
+    def end_scan(self):
+        self.clear_jobs()
+        self.current_operation = ""
+        self.waiting_for_card = False
+
+    def report_card_uid(self):
+        if self.binary_mode:
+            self.send_frame(OP_SCAN_CARD, self.card.uid)
+        else:
+            self.println(f"UID:{self.card.uid_hex}")
+
+    def write_batch_card(self):
+        start = time.monotonic()
+        status = self.write_multiple_blocks()
+        milliseconds = min(int((time.monotonic() - start) * 1000), 0xFFFF)
+        blocks_written = sum(1 for _, block_status in self.results if block_status == MFRC522_OK)
+
+        # Only a fully written card is skipped if it shows up again; a failed one may be retried
+        if status == STATUS_OK:
+            self.last_batch_uid = self.card.uid
+
+        if self.binary_mode:
+            self.send_frame(OP_BATCH_CARD, struct.pack("<BBH", status, blocks_written, milliseconds) + self.card.uid)
+        else:
+            self.println(f"CARD:{self.card.uid_hex}:{status}:{blocks_written}:{milliseconds}")
+
+    def write_changed_blocks(self):
+        self._begin_rf_plan()
+        blocks_needed = card_layout.blocks_needed(len(self.payload))
+        if not self.check_capacity(blocks_needed):
+            self.payload = b""
+            return
+
+        self.out(f"Writing {len(self.payload)} characters (differential)...")
+        image = b"".join(card_layout.encode_card(self.payload, self.payload_flags))
+
+        previous_blocks = None  # Unknown until the old header has been read
+        rewritten = unchanged = cleared = 0
+        data_marked = False
+        for index in range(self.card_data_blocks):
+            in_message = index < blocks_needed
+            if not in_message and not data_marked:
+                self.mark_phase("data")
+                data_marked = True
+            # Past the new message only the blocks of the previous one need clearing
+            if not in_message and previous_blocks is not None and index >= previous_blocks:
+                break
+
+            block = card_layout.data_block_number(index)
+            data = image[index * card_layout.BYTES_PER_BLOCK:(index + 1) * card_layout.BYTES_PER_BLOCK]
+            data = data.ljust(card_layout.BYTES_PER_BLOCK, b"\0")
+
+            # Stop at the first failure: the header already announces the new message
+            status = self.authenticate_block(block)
+            if status != MFRC522_OK:
+                self.record_block_result(block, status)
+                self.report_block_failure("Auth", block, status)
+                break
+
+            status, current = self.read_block(block)
+            known = status == MFRC522_OK
+            if index == 0:
+                previous_blocks = self.stored_message_blocks(current) if known else card_layout.LEGACY_DATA_BLOCKS
+                self.mark_phase("header")
+
+            # A message without a header ended at its first empty block
+            if not in_message and known and _is_empty(current):
+                break
+
+            if known and current == data:
+                unchanged += 1
+                self.record_block_result(block, MFRC522_OK)
+                continue
+
+            if not known:
+                # Re-authenticate after the failed read before trying to write
+                status = self.authenticate_block(block)
+                if status != MFRC522_OK:
+                    self.record_block_result(block, status)
+                    self.report_block_failure("Auth", block, status)
+                    break
+
+            status = self.write_block(block, data)
+            self.record_block_result(block, status)
+            if status == MFRC522_OK:
+                if in_message:
+                    rewritten += 1
+                else:
+                    cleared += 1
+                self.out(f"Block {block} {'written successfully' if in_message else 'cleared'}")
+            else:
+                self.report_block_failure("Write", block, status)
+                break
+
+        if not data_marked:
+            self.mark_phase("data")
+        self.mark_phase("clear")
+
+        # Only a write that got every message block onto the card saved anything.
+        # Baseline: the clear-all write authenticated and wrote every data block, then every message block again
+        blocks_written = rewritten + unchanged
+        complete = blocks_written == blocks_needed
+        full_operations = 2 * card_layout.LEGACY_DATA_BLOCKS + 2 * blocks_needed
+        rf_saved = max(full_operations - (self.auth_count + self.transfer_count), 0) if complete else 0
+        self.report_rf_plan()
+
+        if self.binary_mode:
+            # Write result data: rewritten, unchanged, cleared, RF operations saved (2)
+            if complete:
+                status = STATUS_OK
+            else:
+                status = STATUS_PARTIAL if blocks_written else STATUS_FAILED
+            stats = struct.pack("<BBBH", rewritten, unchanged, cleared, rf_saved)
+            self.send_result_frame(OP_WRITE_RESULT, status, stats)
+        else:
+            self.println(
+                f"Differential write: {rewritten} rewritten, {unchanged} unchanged, "
+                f"{cleared} stale cleared, saved {rf_saved} RF operations"
+            )
+            if complete:
+                self.println(f"Write successful! {blocks_written} blocks written, {len(self.payload)} characters total.")
+            else:
+                self.println(f"Write failed: {blocks_written} of {blocks_needed} message blocks written")
+
+        self.payload = b""
+
+
+class Emulator:
+    """Runs Firmware behind a pseudo-terminal, with a field that virtual cards enter"""
+
+    def __init__(self, cards=(), arrival_latency=ARRIVAL_LATENCY, block_latency=BLOCK_LATENCY,
+                 auth_latency=AUTH_LATENCY, auto_present=True, model_baud=True):
+        self.cards = {card.uid: card for card in cards}
+        self.arrival_latency = arrival_latency
+        self.block_latency = block_latency
+        self.auth_latency = auth_latency
+        self.auto_present = auto_present
+        self.model_baud = model_baud
+        self.firmware = Firmware(self)
+        self.cards_served = 0
+
+        self._arrivals = deque()  # (time, card) in order of arrival
+        self._rotation = 0
+        self._input = bytearray()
+        self._wakeup = threading.Condition()
+        self._running = False
+        self._master = self._slave = None
+        self._threads = []
+        self.port = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def start(self):
+        """Open the pty and boot the firmware; the port path is in self.port"""
+        self._master, self._slave = os.openpty()
+        tty.setraw(self._slave)
+        self.port = os.ttyname(self._slave)
+        self._running = True
+        self._threads = [
+            threading.Thread(target=self._receive_loop, daemon=True),
+            threading.Thread(target=self._firmware_loop, daemon=True),
+        ]
+        for thread in self._threads:
+            thread.start()
+        return self.port
+
+    def close(self):
+        self._running = False
+        with self._wakeup:
+            self._wakeup.notify_all()
+        for thread in self._threads:
+            thread.join(timeout=1)
+        for fd in (self._master, self._slave):
+            if fd is not None:
+                os.close(fd)
+        self._master = self._slave = None
+
+    def add_card(self, card):
+        self.cards[card.uid] = card
+        return card
+
+    def present(self, card, delay=0):
+        """Bring a card (a VirtualCard or the UID of one) into the field after delay seconds
+
+        The card is served once, like a card tapped on the reader.
+        """
+        if not isinstance(card, VirtualCard):
+            card = self.cards[bytes.fromhex(card) if isinstance(card, str) else bytes(card)]
+        with self._wakeup:
+            self._arrivals.append((time.monotonic() + delay, card))
+            self._wakeup.notify_all()
+
+    def next_card(self):
+        """The card that has entered the field, if any (PICC_IsNewCardPresent)"""
+        now = time.monotonic()
+        with self._wakeup:
+            if not self._arrivals and self.auto_present and self.cards:
+                cards = list(self.cards.values())
+                self._arrivals.append((now + self.arrival_latency, cards[self._rotation % len(cards)]))
+                self._rotation += 1
+            if self._arrivals and self._arrivals[0][0] <= now:
+                self.cards_served += 1
+                card = self._arrivals.popleft()[1]
+                if not card.in_field:
+                    # A card that left the field is back
+                    card.leave_after(None)
+                return card
+        time.sleep(CARD_POLL_TIMEOUT)
+        return None
+
+    def rf_delay(self, seconds):
+        if seconds > 0:
+            time.sleep(seconds)
+
+    # Serial side
+
+    def send(self, data):
+        """Bytes from the sketch to the client; dropped when nobody reads them, like a UART"""
+        if self.model_baud:
+            time.sleep(len(data) * 10 / self.firmware.baudrate)
+        while data and self._running:
+            _, writable, _ = select.select([], [self._master], [], POLL_INTERVAL)
+            if writable:
+                data = data[os.write(self._master, data):]
+
+    def read_line(self, timeout=0):
+        """A complete input line without its newline, or None"""
+        deadline = time.monotonic() + timeout
+        with self._wakeup:
+            while b"\n" not in self._input:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not self._running:
+                    return None
+                self._wakeup.wait(remaining)
+            line, _, rest = bytes(self._input).partition(b"\n")
+            self._input[:] = rest
+        return line
+
+    def read_bytes(self):
+        with self._wakeup:
+            data = bytes(self._input)
+            self._input.clear()
+        return data
+
+    def _receive_loop(self):
+        while self._running:
+            readable, _, _ = select.select([self._master], [], [], POLL_INTERVAL)
+            if not readable:
+                continue
+            try:
+                data = os.read(self._master, 4096)
+            except OSError:
+                continue
+            with self._wakeup:
+                if self.firmware.waiting_for_card:
+                    # The sketch is stuck in a card poll; the UART drops what the RX buffer can't hold
+                    data = data[:max(RX_BUFFER_SIZE - len(self._input), 0)]
+                self._input.extend(data)
+                self._wakeup.notify_all()
+
+    def _firmware_loop(self):
+        self.firmware.println("RFID Manager Ready - Multi-Block Support with Auto-Clear")
+        self.firmware.println("Waiting for commands...")
+        while self._running:
+            self.firmware.loop()
+            with self._wakeup:
+                if self._input and (self.firmware.binary_mode or b"\n" in self._input):
+                    continue
+                # Sleep until input arrives or the next card is due
+                timeout = POLL_INTERVAL
+                if self.firmware.waiting_for_card and self._arrivals:
+                    timeout = min(timeout, max(self._arrivals[0][0] - time.monotonic(), 0))
+                if timeout > 0:
+                    self._wakeup.wait(timeout)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Emulate a KhabiByte reader and its cards on a pseudo-terminal.")
+    parser.add_argument("--cards", type=int, default=3, help="number of virtual cards")
+    parser.add_argument("--card-type", default=card_layout.DEFAULT_CARD_TYPE, choices=list(CARD_BLOCKS))
+    parser.add_argument("--arrival", type=float, default=ARRIVAL_LATENCY, help="seconds until the next card arrives")
+    parser.add_argument("--block-latency", type=float, default=BLOCK_LATENCY, help="seconds per block read or write")
+    parser.add_argument("--auth-latency", type=float, default=AUTH_LATENCY, help="seconds per authentication")
+    parser.add_argument("--no-baud-timing", action="store_true", help="don't slow output down to the baud rate")
+    args = parser.parse_args(argv)
+
+    cards = make_cards(args.cards, args.card_type)
+    with Emulator(cards, args.arrival, args.block_latency, args.auth_latency,
+                  model_baud=not args.no_baud_timing) as emulator:
+        print(f"Emulated reader on {emulator.port}")
+        print(f"Cards: {', '.join(card.uid_hex for card in cards)}")
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,268 @@
+"""Binary framed protocol shared with arduino_rfid_manager.ino
+
+Frame layout (all integers little-endian):
+
+    SYNC (0xA5) | opcode (1) | length (2) | payload (length) | CRC-16 (2)
+
+The CRC is CRC-16/CCITT-FALSE over opcode, length and payload. The link is
+switched into binary mode with the text command BINARY (answered by the
+line BINARY_OK) and back with an OP_TEXT_MODE frame.
+"""
+import re
+import struct
+from collections import namedtuple
+
+SYNC = 0xA5
+HEADER_SIZE = 4  # sync, opcode, length
+CRC_SIZE = 2
+MAX_PAYLOAD = 4096  # Room for a full MIFARE 4K card
+# Write data the sketch queues behind an armed job: it polls for a card meanwhile and only its
+# 64-byte serial RX buffer catches the frame, with its framing and an OP_SET_FLAGS frame
+MAX_QUEUED_DATA = 64 - 13
+
+# Requests
+OP_PING = 0x01
+OP_READ_MULTI = 0x02
+OP_WRITE_MULTI = 0x03
+OP_WRITE_DIFF = 0x04
+OP_BATCH_WRITE = 0x05
+OP_BATCH_END = 0x06
+OP_SCAN = 0x07
+OP_SCAN_END = 0x08
+OP_SET_FLAGS = 0x09  # Header flags for the next write; not answered
+OP_TIMING = 0x0A  # Per-phase timing on (1) or off (0); not answered
+OP_TEXT_MODE = 0x0F
+
+# Responses have the high bit set
+OP_PONG = 0x81
+OP_READ_RESULT = 0x82
+OP_WRITE_RESULT = 0x83
+OP_ARMED = 0x84
+OP_BATCH_CARD = 0x85
+OP_BATCH_DONE = 0x86
+OP_SCAN_CARD = 0x87  # UID of the card a result that follows belongs to (scan, read or write)
+OP_SCAN_DONE = 0x88
+OP_PHASE = 0x89  # Sent when TIMING is on: millis (4) | phase name
+OP_QUEUED = 0x8A  # Accepted behind the armed job: jobs queued (1)
+OP_TEXT_MODE_OK = 0x8F
+OP_ERROR = 0xFF
+
+# Operation status codes
+STATUS_OK = 0x00
+STATUS_PARTIAL = 0x01
+STATUS_FAILED = 0x02
+STATUS_NO_DATA = 0x03
+STATUS_BAD_CRC = 0x04
+STATUS_TOO_LONG = 0x05
+STATUS_UNKNOWN_OPCODE = 0x06
+STATUS_BAD_CHECKSUM = 0x07
+STATUS_UNSUPPORTED_CARD = 0x08
+STATUS_QUEUE_FULL = 0x09
+
+STATUS_NAMES = {
+    STATUS_OK: "OK",
+    STATUS_PARTIAL: "Partial",
+    STATUS_FAILED: "Failed",
+    STATUS_NO_DATA: "No data",
+    STATUS_BAD_CRC: "Bad CRC",
+    STATUS_TOO_LONG: "Payload too long",
+    STATUS_UNKNOWN_OPCODE: "Unknown opcode",
+    STATUS_BAD_CHECKSUM: "Checksum mismatch",
+    STATUS_UNSUPPORTED_CARD: "Unsupported card type",
+    STATUS_QUEUE_FULL: "Job queue full",
+}
+
+# Per-block codes are MFRC522::StatusCode values, plus the sketch's own for a failed read-back
+BLOCK_VERIFY_MISMATCH = 0xFE
+BLOCK_STATUS_NAMES = {
+    0: "OK",
+    1: "Error",
+    2: "Collision",
+    3: "Timeout",
+    4: "No room",
+    5: "Internal error",
+    6: "Invalid",
+    7: "CRC wrong",
+    BLOCK_VERIFY_MISMATCH: "Verify mismatch",
+    0xFF: "MIFARE NAK",
+}
+
+Frame = namedtuple("Frame", ["opcode", "payload"])
+BlockResult = namedtuple("BlockResult", ["block", "status"])
+OperationResult = namedtuple(
+    "OperationResult", ["status", "auth_ops", "transfer_ops", "blocks_touched", "blocks", "data", "flags"], defaults=(0,)
+)
+DiffStats = namedtuple("DiffStats", ["rewritten", "unchanged", "cleared", "rf_saved"])
+WriteProgress = namedtuple("WriteProgress", ["needed", "verified", "resumed_at", "written"])
+BatchCard = namedtuple("BatchCard", ["uid", "status", "blocks", "latency_ms"])
+Phase = namedtuple("Phase", ["name", "millis"])
+
+WRITE_LINE_PATTERN = re.compile(r"Write successful! (\d+) blocks written, (\d+) verified")
+WRITE_FAILED_LINE_PATTERN = re.compile(r"Write failed: (\d+) of (\d+) blocks verified \((\d+) written\)")
+RESUME_LINE_PATTERN = re.compile(r"Resuming at data block (\d+)")
+DIFF_LINE_PATTERN = re.compile(
+    r"Differential write: (\d+) rewritten, (\d+) unchanged, (\d+) stale cleared, saved (\d+) RF operations"
+)
+
+
+def crc16(data, crc=0xFFFF):
+    """CRC-16/CCITT-FALSE (poly 0x1021, init 0xFFFF)"""
+    for byte in data:
+        crc ^= byte << 8
+        for _ in range(8):
+            if crc & 0x8000:
+                crc = ((crc << 1) ^ 0x1021) & 0xFFFF
+            else:
+                crc = (crc << 1) & 0xFFFF
+    return crc
+
+
+def encode_frame(opcode, payload=b""):
+    """Build a complete frame for opcode and payload"""
+    if len(payload) > MAX_PAYLOAD:
+        raise ValueError(f"Frame payload too long ({len(payload)} > {MAX_PAYLOAD} bytes)")
+    body = struct.pack("<BH", opcode, len(payload)) + bytes(payload)
+    return bytes([SYNC]) + body + struct.pack("<H", crc16(body))
+
+
+class FrameDecoder:
+    """Incremental decoder; feed raw bytes and collect complete frames
+
+    Bytes before a sync marker and frames with a bad CRC are skipped, so the
+    decoder resynchronises on its own after line noise.
+    """
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.crc_errors = 0
+
+    def feed(self, data):
+        """Add bytes and return the list of frames completed by them"""
+        self.buffer.extend(data)
+        frames = []
+        while True:
+            start = self.buffer.find(SYNC)
+            if start < 0:
+                self.buffer.clear()
+                return frames
+            del self.buffer[:start]
+            if len(self.buffer) < HEADER_SIZE:
+                return frames
+
+            opcode, length = struct.unpack_from("<BH", self.buffer, 1)
+            if length > MAX_PAYLOAD:
+                del self.buffer[0]
+                continue
+            end = HEADER_SIZE + length + CRC_SIZE
+            if len(self.buffer) < end:
+                return frames
+
+            (expected,) = struct.unpack_from("<H", self.buffer, end - CRC_SIZE)
+            if crc16(self.buffer[1:end - CRC_SIZE]) != expected:
+                self.crc_errors += 1
+                del self.buffer[0]
+                continue
+            frames.append(Frame(opcode, bytes(self.buffer[HEADER_SIZE:end - CRC_SIZE])))
+            del self.buffer[:end]
+
+
+def parse_result(payload):
+    """Decode a READ_RESULT or WRITE_RESULT payload
+
+    Layout: status (1) | auth count (2) | read/write count (2) | blocks touched (2)
+            | block count n (1) | n x (block number, block status) | data
+    """
+    status, auth_ops, transfer_ops, blocks_touched, count = struct.unpack_from("<BHHHB", payload)
+    blocks = [BlockResult(payload[8 + 2 * i], payload[9 + 2 * i]) for i in range(count)]
+    return OperationResult(status, auth_ops, transfer_ops, blocks_touched, blocks, payload[8 + 2 * count:])
+
+
+def parse_read_result(payload):
+    """Decode a READ_RESULT payload, whose data starts with the card header flags"""
+    result = parse_result(payload)
+    if not result.data:
+        return result
+    return result._replace(flags=result.data[0], data=result.data[1:])
+
+
+def parse_diff_stats(result):
+    """Decode the statistics carried in the data of a differential WRITE_RESULT
+
+    rf_saved is 16 bits wide (a rewritten 4K card saves more than 255 RF
+    operations) and is 0 unless every message block was written.
+    """
+    if len(result.data) < 5:
+        return None
+    return DiffStats(*struct.unpack("<BBBH", bytes(result.data[:5])))
+
+
+def parse_write_progress(result):
+    """Decode the progress carried in the data of a multi-block WRITE_RESULT"""
+    if len(result.data) < 4:
+        return None
+    return WriteProgress(*result.data[:4])
+
+
+def parse_write_line(line, resumed_at=0):
+    """Decode the text protocol equivalent, the "Write successful! ..." or "Write failed: n of m ..." line
+
+    The line doesn't say where a resumed write started; that comes from the
+    "Resuming at data block" line before it (see parse_resume_line).
+    """
+    match = WRITE_LINE_PATTERN.match(line)
+    if match:
+        written, verified = map(int, match.groups())
+        return WriteProgress(verified, verified, resumed_at, written)
+    match = WRITE_FAILED_LINE_PATTERN.match(line)
+    if match:
+        verified, needed, written = map(int, match.groups())
+        return WriteProgress(needed, verified, resumed_at, written)
+    return None
+
+
+def parse_resume_line(line):
+    """Data block index from a "Resuming at data block n" line, or None"""
+    match = RESUME_LINE_PATTERN.match(line)
+    return int(match.group(1)) if match else None
+
+
+def parse_diff_line(line):
+    """Decode the text protocol equivalent, the "Differential write: ..." line"""
+    match = DIFF_LINE_PATTERN.match(line)
+    return DiffStats(*map(int, match.groups())) if match else None
+
+
+def parse_batch_card(payload):
+    """Decode a BATCH_CARD payload: status (1) | blocks written (1) | milliseconds (2) | UID"""
+    status, blocks, latency_ms = struct.unpack_from("<BBH", payload)
+    return BatchCard(payload[4:].hex().upper(), status, blocks, latency_ms)
+
+
+def parse_batch_line(line):
+    """Decode the text protocol equivalent, CARD:<uid>:<status>:<blocks>:<ms>"""
+    uid, status, blocks, latency_ms = line[5:].split(":")
+    return BatchCard(uid, int(status), int(blocks), int(latency_ms))
+
+
+def parse_phase_frame(payload):
+    """Decode a PHASE payload: millis (4) | phase name"""
+    (millis,) = struct.unpack_from("<I", payload)
+    return Phase(payload[4:].decode(errors="replace"), millis)
+
+
+def parse_phase_line(line):
+    """Decode the text protocol equivalent, T:<phase>:<millis>"""
+    name, millis = line[2:].rsplit(":", 1)
+    return Phase(name, int(millis))
+
+
+def describe_result(result):
+    """Human readable per-block summary for the status panes"""
+    parts = [
+        f"block {b.block}: {BLOCK_STATUS_NAMES.get(b.status, hex(b.status))}"
+        for b in result.blocks
+    ]
+    return (
+        f"{STATUS_NAMES.get(result.status, hex(result.status))} ({', '.join(parts)}); "
+        f"RF: {result.auth_ops} auth, {result.transfer_ops} read/write commands on {result.blocks_touched} blocks"
+    )
@@ -0,0 +1,141 @@
+"""Command line entry point without Tk: list ports, read and write cards
+
+    python headless.py ports
+    python headless.py read --port /dev/ttyUSB0 [--binary] [--decrypt KEY] [--timeout 45]
+    python headless.py write "message" ["message" ...] --port /dev/ttyUSB0 [--binary] [--encrypt KEY] [--diff] [--compress]
+
+Runs on RFIDClient (rfid_client.py) and never imports tkinter or
+customtkinter, so it works on machines without a display and starts in a
+fraction of the GUI's time. The card contents go to stdout and everything
+else to stderr; the exit status is 1 when the operation failed or timed out.
+Several messages go to as many cards, in order; with --binary they are all
+queued on the reader up front, so each card is written as soon as it arrives.
+With --archive every operation is also recorded in a card archive (see
+card_archive.py).
+"""
+import argparse
+import asyncio
+import sys
+
+import serial
+
+from card_archive import CardArchive, ArchiveError, READ, WRITE
+from cipher import VigenereCipher
+from compression import compress
+from rfid_client import RFIDClient, CARD_TIMEOUT, RESUME_ATTEMPTS
+from serial_link import HIGH_SPEED_BAUDRATES
+
+
+def list_ports():
+    import serial.tools.list_ports
+    for port in serial.tools.list_ports.comports():
+        print(f"{port.device}\t{port.description}")
+    return 0
+
+
+def archive_operation(archive, kind, operation, raw, text, blocks):
+    """Record a CardRead or CardWrite whose card reported its UID"""
+    if archive is not None and operation.uid:
+        archive.append(kind, operation.uid, raw, text, blocks, operation.timer.total_ms, operation.ok)
+
+
+async def run(args):
+    archive = CardArchive(args.archive) if args.archive else None
+    try:
+        return await operate(args, archive)
+    finally:
+        if archive is not None:
+            archive.close()
+
+
+async def operate(args, archive):
+    log = (lambda line: print(f"Arduino: {line}", file=sys.stderr)) if args.verbose else None
+    baudrates = (args.baud,) if args.baud else HIGH_SPEED_BAUDRATES
+    # Compressed payloads are binary, so they need the binary protocol
+    binary = args.binary or getattr(args, "compress", False)
+    async with await RFIDClient.connect(args.port, baudrates=baudrates, binary=binary, reset_board=not args.no_reset) as client:
+        print(f"Connected to {client.port}, waiting for a card...", file=sys.stderr)
+        if args.command == "read":
+            card = await client.read_card(timeout=args.timeout, on_line=log)
+            if not card.ok:
+                archive_operation(archive, READ, card, b"", None, card.blocks)
+                print(f"Read failed: {card.status}", file=sys.stderr)
+                return 1
+            text = card.text
+            if args.decrypt:
+                text = VigenereCipher.decrypt(text, args.decrypt)
+            archive_operation(archive, READ, card, card.data, text if args.decrypt else None, card.blocks)
+            print(text)
+            return 0
+
+        writes = []
+        messages = []
+        for message in args.messages:
+            plain = message
+            if args.encrypt:
+                message = VigenereCipher.encrypt(message, args.encrypt)
+            messages.append((message, plain if args.encrypt else None))
+            payload, flags = message.encode(), 0
+            if args.compress:
+                payload, flags = compress(payload)
+            writes.append(asyncio.ensure_future(client.write_card(
+                payload, timeout=args.timeout, differential=args.diff, flags=flags, on_line=log, resume=args.resume
+            )))
+        failures = 0
+        for number, (write, (message, plain)) in enumerate(zip(writes, messages), 1):
+            prefix = f"Card {number}: " if len(writes) > 1 else ""
+            try:
+                written = await write
+            except (asyncio.TimeoutError, serial.SerialException) as e:
+                print(f"{prefix}Not written: {e}", file=sys.stderr)
+                failures += 1
+                continue
+            archive_operation(archive, WRITE, written, message.encode(), plain, written.blocks)
+            progress = written.progress
+            if progress:
+                print(f"{prefix}{progress.verified} of {progress.needed} blocks verified, {progress.written} written"
+                      + (f", resumed at data block {progress.resumed_at}" if progress.resumed_at else ""), file=sys.stderr)
+            if not written.ok:
+                print(f"{prefix}Write failed: {written.status}", file=sys.stderr)
+                failures += 1
+                continue
+            print(f"{prefix}Written to {written.blocks} blocks ({written.status})", file=sys.stderr)
+        return 1 if failures else 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("ports", help="list the serial ports")
+    read = commands.add_parser("read", help="read the next card")
+    read.add_argument("--decrypt", metavar="KEY", help="Vigenère key to decrypt the message with")
+    write = commands.add_parser("write", help="write a message to the next card, or several to the next cards")
+    write.add_argument("messages", nargs="+", metavar="message")
+    write.add_argument("--encrypt", metavar="KEY", help="Vigenère key to encrypt the message with")
+    write.add_argument("--diff", action="store_true", help="only rewrite the blocks that changed")
+    write.add_argument("--compress", action="store_true", help="deflate the payload (implies --binary)")
+    write.add_argument("--resume", type=int, default=RESUME_ATTEMPTS,
+                       help="times to wait for the card again after it was lifted mid-write")
+    for command in (read, write):
+        command.add_argument("--port", required=True, help="serial port of the reader")
+        command.add_argument("--binary", action="store_true", help="use the binary framed protocol")
+        command.add_argument("--baud", type=int, help="rate to negotiate after connecting")
+        command.add_argument("--no-reset", action="store_true", help="don't reset the board when opening the port")
+        command.add_argument("--timeout", type=float, default=CARD_TIMEOUT, help="seconds to wait for a card")
+        command.add_argument("--verbose", action="store_true", help="show the sketch's status lines")
+        command.add_argument("--archive", metavar="DIR", help="also record the operation in this card archive")
+    args = parser.parse_args(argv)
+
+    if args.command == "ports":
+        return list_ports()
+    try:
+        return asyncio.run(run(args))
+    except asyncio.TimeoutError as e:
+        print(f"Timed out: {e}", file=sys.stderr)
+    except (serial.SerialException, OSError, ArchiveError) as e:
+        print(f"Error: {e}", file=sys.stderr)
+    return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,285 @@
+"""Reader pool: drive every attached KhabiByte reader in parallel
+
+Every port from serial.tools.list_ports.comports() is opened and has to
+answer the firmware handshake before it joins the pool; the pool talks to
+its readers over the binary protocol. Each reader has its own job queue and
+worker thread, so N readers serve N cards at once. A job goes to the reader
+with the fewest pending jobs. Idle readers are pinged regularly, and a reader
+that stops answering is evicted and its queued jobs move to the others.
+A job that gets no card in time disarms its reader and fails with
+TimeoutError, so a late card is left alone.
+
+    pool = ReaderPool.discover()
+    futures = [pool.submit_write(message) for message in messages]
+    for future in futures:
+        print(future.result())
+"""
+import queue
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import serial
+import serial.tools.list_ports
+
+from frame_protocol import MAX_PAYLOAD
+from serial_link import SerialLink, SerialLinkClosed, HANDSHAKE_TIMEOUT, HIGH_SPEED_BAUDRATES
+
+# Seconds between health pings of idle readers
+HEALTH_INTERVAL = 2.0
+PING_TIMEOUT = 0.5
+# Consecutive failed pings before a reader is evicted
+MAX_FAILURES = 3
+# Seconds a job waits for a card
+JOB_TIMEOUT = 45
+
+JobResult = namedtuple("JobResult", ["port", "result", "elapsed"])
+ReaderHealth = namedtuple("ReaderHealth", ["port", "pending", "jobs_done", "errors", "failures", "ping"])
+
+
+class PoolExhausted(serial.SerialException):
+    """Raised for jobs when no healthy reader is left to run them"""
+
+
+class _Job:
+    def __init__(self, operation, kwargs):
+        self.operation = operation
+        self.kwargs = kwargs
+        self.future = Future()
+
+
+class Reader:
+    """One attached reader: its SerialLink, job queue and worker thread"""
+
+    def __init__(self, pool, link):
+        self.pool = pool
+        self.link = link
+        self.jobs = queue.Queue()
+        self.pending = 0
+        self.jobs_done = 0
+        self.errors = 0
+        self.failures = 0
+        self.ping_time = None
+        self.evicted = False
+        self._worker = threading.Thread(target=self._work, daemon=True)
+        self._worker.start()
+
+    @property
+    def port(self):
+        return self.link.port
+
+    def health(self):
+        return ReaderHealth(self.port, self.pending, self.jobs_done, self.errors, self.failures, self.ping_time)
+
+    def check(self):
+        """Ping the firmware; returns False once the reader should be evicted"""
+        try:
+            self.ping_time = self.link.ping(PING_TIMEOUT)
+        except (serial.SerialException, OSError):
+            self.ping_time = None
+        if self.ping_time is None:
+            self.failures += 1
+        else:
+            self.failures = 0
+        return self.link.is_open and self.failures < MAX_FAILURES
+
+    def _work(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                return
+            # A job handed over from an evicted reader is already running
+            if not job.future.running() and not job.future.set_running_or_notify_cancel():
+                self.pool._job_finished(self)
+                continue
+
+            start = time.monotonic()
+            try:
+                if job.operation == "write":
+                    result = self.link.binary_write(**job.kwargs)
+                else:
+                    result = self.link.binary_read(**job.kwargs)
+            except (SerialLinkClosed, OSError) as e:
+                # The port went away under the job; another reader takes it over
+                self.errors += 1
+                self.pool._evict(self, str(e))
+                self.pool._dispatch(job)
+                continue
+            except serial.SerialException as e:
+                # Rejected by the firmware: the reader is fine, the job is not
+                self.errors += 1
+                job.future.set_exception(e)
+                self.pool._job_finished(self)
+                continue
+            except Exception as e:
+                # Anything else is the job's fault; the worker must live on to serve the next one
+                self.errors += 1
+                job.future.set_exception(e)
+                self.pool._job_finished(self)
+                continue
+
+            if result is None:
+                # Tell a missing card from a reader that stopped answering; either way it must not stay armed
+                try:
+                    disarmed = self.link.disarm(PING_TIMEOUT * 4)
+                except (serial.SerialException, OSError):
+                    disarmed = False
+                if not disarmed:
+                    self.check()
+                if not disarmed and self.ping_time is None:
+                    self.pool._evict(self, "Stopped answering during a job")
+                    self.pool._dispatch(job)
+                    continue
+                self.failures = 0
+                job.future.set_exception(TimeoutError(f"No card within {job.kwargs['timeout']} s"))
+                self.pool._job_finished(self)
+                continue
+
+            self.jobs_done += 1
+            self.failures = 0
+            job.future.set_result(JobResult(self.port, result, time.monotonic() - start))
+            self.pool._job_finished(self)
+
+
+class ReaderPool:
+    """Spreads read and write jobs over several readers"""
+
+    def __init__(self, links=()):
+        self._lock = threading.Lock()
+        self._closed = threading.Event()
+        self.readers = [Reader(self, link) for link in links]
+        self.rejected = {}  # Ports that didn't answer the firmware handshake
+        self.evicted = {}  # Readers dropped while running, with the reason
+        self._monitor = threading.Thread(target=self._monitor_loop, daemon=True)
+        self._monitor.start()
+
+    @classmethod
+    def discover(cls, ports=None, reset_board=True, handshake_timeout=HANDSHAKE_TIMEOUT):
+        """Open the given ports (every detected port by default) in parallel
+
+        Ports that don't answer the KhabiByte handshake are left closed and
+        listed in the pool's rejected dict.
+        """
+        if ports is None:
+            ports = [port.device for port in serial.tools.list_ports.comports()]
+
+        def connect(port):
+            link = SerialLink.open(
+                port,
+                handshake_timeout=handshake_timeout,
+                reset_board=reset_board,
+                fallback_baudrates=HIGH_SPEED_BAUDRATES
+            )
+            try:
+                link.negotiate_baud(HIGH_SPEED_BAUDRATES)
+                link.enter_binary_mode()
+            except Exception:
+                link.close()
+                raise
+            return link
+
+        links = []
+        rejected = {}
+        with ThreadPoolExecutor(max_workers=max(len(ports), 1)) as executor:
+            attempts = {port: executor.submit(connect, port) for port in ports}
+        for port, attempt in attempts.items():
+            try:
+                links.append(attempt.result())
+            except (serial.SerialException, OSError) as e:
+                rejected[port] = str(e)
+
+        pool = cls(links)
+        pool.rejected = rejected
+        return pool
+
+    def submit_write(self, data, differential=False, timeout=JOB_TIMEOUT, flags=0):
+        """Queue a write for the next card on the least busy reader; returns a Future of JobResult
+
+        data is str or bytes. The Future fails with TimeoutError when no card
+        arrives within timeout.
+        """
+        if isinstance(data, str):
+            data = data.encode()
+        if len(data) > MAX_PAYLOAD:
+            raise ValueError(f"Write data too long ({len(data)} > {MAX_PAYLOAD} bytes)")
+        return self._dispatch(_Job(
+            "write", {"data": data, "differential": differential, "timeout": timeout, "flags": flags}
+        ))
+
+    def submit_read(self, blocks=None, timeout=JOB_TIMEOUT):
+        """Queue a read of the next card on the least busy reader; returns a Future of JobResult
+
+        The Future fails with TimeoutError when no card arrives within timeout.
+        """
+        return self._dispatch(_Job("read", {"blocks": blocks, "timeout": timeout}))
+
+    def _dispatch(self, job):
+        with self._lock:
+            readers = [reader for reader in self.readers if not reader.evicted]
+            if not readers or self._closed.is_set():
+                reader = None
+            else:
+                reader = min(readers, key=lambda r: r.pending)
+                reader.pending += 1
+        if reader is None:
+            if job.future.running() or job.future.set_running_or_notify_cancel():
+                reason = "Reader pool closed" if self._closed.is_set() else "No healthy readers left in the pool"
+                job.future.set_exception(PoolExhausted(reason))
+        else:
+            reader.jobs.put(job)
+        return job.future
+
+    def _job_finished(self, reader):
+        with self._lock:
+            reader.pending = max(reader.pending - 1, 0)
+
+    def _evict(self, reader, reason):
+        """Drop a reader and hand its queued jobs to the others (or fail them once closed)"""
+        with self._lock:
+            if reader.evicted:
+                return
+            reader.evicted = True
+            reader.pending = 0
+            self.evicted[reader.port] = reason
+        reader.link.close()
+
+        while True:
+            try:
+                job = reader.jobs.get_nowait()
+            except queue.Empty:
+                break
+            if job is not None:
+                self._dispatch(job)
+        reader.jobs.put(None)
+
+    def _monitor_loop(self):
+        """Ping idle readers; busy ones prove their health by finishing jobs"""
+        while not self._closed.wait(HEALTH_INTERVAL):
+            for reader in self.active_readers():
+                if reader.pending == 0 and not reader.check():
+                    self._evict(reader, f"No answer to {reader.failures} health pings")
+
+    def active_readers(self):
+        with self._lock:
+            return [reader for reader in self.readers if not reader.evicted]
+
+    def health(self):
+        """Snapshot of every reader still in the pool"""
+        return [reader.health() for reader in self.active_readers()]
+
+    def close(self):
+        """Stop the health monitor, fail queued jobs and close every port"""
+        self._closed.set()
+        for reader in self.active_readers():
+            self._evict(reader, "Pool closed")
+        self._monitor.join(timeout=1)
+
+
+if __name__ == "__main__":
+    pool = ReaderPool.discover()
+    for health in pool.health():
+        print(f"{health.port}: KhabiByte reader")
+    for port, reason in pool.rejected.items():
+        print(f"{port}: skipped ({reason})")
+    pool.close()
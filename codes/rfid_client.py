@@ -0,0 +1,569 @@
+"""Headless asyncio client for a KhabiByte reader
+
+No Tk and no thread per operation: the SerialLink reader thread stays the
+only consumer of the port and hands every line or frame to the event loop,
+where read_card() and write_card() await them. One event loop drives any
+number of readers (one RFIDClient each) at once.
+
+In binary mode operations on the same reader are pipelined: each one is
+sent as soon as it is called, and the sketch queues up to MAX_QUEUED_JOBS
+behind the armed one, so the next job's data is already on the reader
+when the card of the current one leaves the field. Writes longer than
+MAX_QUEUED_DATA are the exception: they wait until the reader is idle. The
+sketch runs the jobs in order and the results are matched to them in the
+same order. In text
+mode the sketch takes one command at a time, so operations wait for each
+other on the client.
+
+An operation that times out or is cancelled disarms the sketch (SCAN_END:
+endScan() clears the armed operation and the queue), so the next
+operation starts clean; the other operations in the queue fail with
+JobsCleared.
+
+A write cut short by the card leaving the field ends with status Partial;
+the sketch keeps its place, and writing the same data to the same card
+again continues from the first block it could not verify. write_card(...,
+resume=n) re-arms the sketch for that up to n times.
+
+    async def main():
+        async with await RFIDClient.connect("/dev/ttyUSB0", binary=True) as client:
+            await client.write_card("hello")
+            card = await client.read_card(timeout=10)
+            print(card.text)
+"""
+import asyncio
+from collections import deque, namedtuple
+
+import serial
+
+import card_layout
+from compression import decompress, parse_hex_line
+from frame_protocol import (
+    parse_read_result, parse_result, parse_diff_stats, parse_diff_line, parse_write_progress, parse_write_line,
+    parse_resume_line, MAX_QUEUED_DATA, STATUS_NAMES, STATUS_OK, STATUS_PARTIAL, STATUS_QUEUE_FULL,
+    OP_ARMED, OP_ERROR, OP_PING, OP_PONG, OP_QUEUED, OP_READ_MULTI, OP_READ_RESULT, OP_SCAN_CARD, OP_SCAN_DONE,
+    OP_SCAN_END, OP_SET_FLAGS, OP_WRITE_DIFF, OP_WRITE_MULTI, OP_WRITE_RESULT,
+)
+from serial_link import (
+    SerialLink, SerialLinkClosed, HANDSHAKE_TIMEOUT, HIGH_SPEED_BAUDRATES, READ_RESULT_PREFIXES, WRITE_RESULT_PREFIXES,
+)
+from timing import PhaseTimer
+
+# Seconds a card operation waits for a card
+CARD_TIMEOUT = 45
+# Seconds the sketch gets to acknowledge a command
+ACK_TIMEOUT = 5
+DISARM_TIMEOUT = 2
+# Interrupted writes the GUI and the command line re-arm before giving up
+RESUME_ATTEMPTS = 3
+
+# ok is True when the sketch reported success, including Partial for a read; status is the sketch's verdict
+# uid is the hex UID of the card the sketch used, or None if an older sketch didn't report it; blocks counts
+# the data blocks read (the header and the payload as stored, compressed or not, over the text protocol)
+CardRead = namedtuple("CardRead", ["ok", "status", "data", "text", "result", "timer", "uid", "blocks"], defaults=(None, 0))
+# A write is only ok once the whole message is on the card; blocks counts the message blocks
+# written (and, for WRITE_MULTI, verified), progress is the WriteProgress of a WRITE_MULTI
+CardWrite = namedtuple(
+    "CardWrite", ["ok", "status", "blocks", "stats", "result", "timer", "progress", "uid"], defaults=(None, None)
+)
+
+
+class JobsCleared(serial.SerialException):
+    """An operation queued on the sketch was dropped before it ran"""
+
+
+class AsyncSubscription:
+    """LineSubscription counterpart whose lines are awaited on an event loop"""
+
+    def __init__(self, link, loop=None):
+        self.link = link
+        self.loop = loop or asyncio.get_running_loop()
+        self.lines = asyncio.Queue()
+
+    def deliver(self, line):
+        """Queue a line; called from the reader thread"""
+        try:
+            self.loop.call_soon_threadsafe(self.lines.put_nowait, line)
+        except RuntimeError:
+            pass  # The loop has been closed
+
+    async def get(self, timeout=None):
+        """Return the next line, or None once the timeout expires"""
+        try:
+            line = await asyncio.wait_for(self.lines.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+        if line is None:
+            raise SerialLinkClosed("Serial connection closed")
+        return line
+
+    async def wait_for(self, predicate, timeout, on_line=None):
+        """Return the first line matching predicate, or None on timeout"""
+        deadline = self.loop.time() + timeout
+        while True:
+            remaining = deadline - self.loop.time()
+            if remaining <= 0:
+                return None
+            line = await self.get(remaining)
+            if line is None:
+                return None
+            if on_line:
+                on_line(line)
+            if predicate(line):
+                return line
+
+    def close(self):
+        """Stop receiving lines"""
+        self.link._unsubscribe(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class _Job:
+    """One operation sent to the sketch; started is set once it is the armed one"""
+
+    def __init__(self, loop, timer):
+        self.timer = timer
+        self.uid = None
+        self.started = asyncio.Event()
+        self.result = loop.create_future()
+
+    def begin(self):
+        if not self.started.is_set():
+            self.started.set()
+            self.timer.mark("armed")
+
+    def fail(self, error):
+        self.started.set()
+        if not self.result.done():
+            self.result.set_exception(error)
+
+
+class JobPipeline:
+    """Binary card operations queued on the sketch, with their results matched in order
+
+    A subscription to the link, like AsyncSubscription. jobs holds the
+    operations the sketch has accepted, the armed one first; a
+    READ_RESULT or WRITE_RESULT frame always belongs to the first one.
+    Operations are sent one at a time, each waiting for its ARMED, QUEUED
+    or ERROR frame, and a full queue is retried once a job has finished.
+    """
+
+    def __init__(self, link, loop=None):
+        self.link = link
+        self.loop = loop or asyncio.get_running_loop()
+        self.jobs = deque()
+        self._send_lock = asyncio.Lock()
+        self._ack = None
+        # Resolved (and replaced) whenever jobs leave the queue
+        self._freed = self.loop.create_future()
+        # Pending from a SCAN_END until its SCAN_DONE; results in between belong to cleared jobs
+        self._draining = None
+        self._closed = None
+
+    def deliver(self, frame):
+        """Handle a frame; called from the reader thread"""
+        try:
+            self.loop.call_soon_threadsafe(self._dispatch, frame)
+        except RuntimeError:
+            pass  # The loop has been closed
+
+    def _dispatch(self, frame):
+        if frame is None:
+            self._fail_all(SerialLinkClosed("Serial connection closed"))
+            return
+        if frame.opcode in (OP_ARMED, OP_QUEUED, OP_ERROR):
+            if self._ack is not None and not self._ack.done():
+                self._ack.set_result(frame)
+        elif frame.opcode == OP_SCAN_DONE:
+            if self._draining is not None and not self._draining.done():
+                self._draining.set_result(None)
+        elif self._draining is not None and not self._draining.done():
+            pass
+        elif frame.opcode in (OP_READ_RESULT, OP_WRITE_RESULT):
+            if self.jobs:
+                job = self.jobs.popleft()
+                job.timer.mark("result")
+                if not job.result.done():
+                    job.result.set_result(frame.payload)
+                # The sketch arms the next queued job straight away
+                if self.jobs:
+                    self.jobs[0].begin()
+            self._wake()
+        elif frame.opcode == OP_SCAN_CARD:
+            if self.jobs:
+                self.jobs[0].uid = frame.payload.hex().upper()
+        elif self.jobs:
+            self.jobs[0].timer.collect(frame)
+
+    def _wake(self):
+        freed, self._freed = self._freed, self.loop.create_future()
+        if not freed.done():
+            freed.set_result(None)
+
+    def _fail_all(self, error):
+        self._closed = error
+        jobs, self.jobs = self.jobs, deque()
+        for job in jobs:
+            job.fail(error)
+        for future in (self._ack, self._freed, self._draining):
+            if future is not None and not future.done():
+                future.set_exception(error)
+                # Nobody may be waiting for it
+                future.exception()
+
+    def clear(self, error, abandoned=None):
+        """Empty the sketch's queue and disarm it; every job but abandoned fails with error
+
+        Nothing is awaited between dropping the jobs and sending SCAN_END,
+        so no operation can be sent in between and be cleared unnoticed.
+        """
+        jobs, self.jobs = self.jobs, deque()
+        for job in jobs:
+            if job is not abandoned:
+                job.fail(error)
+        if self.link.is_open:
+            self._draining = self.loop.create_future()
+            self.link.send_frame(OP_SCAN_END)
+        self._wake()
+
+    async def submit(self, opcode, payload, timeout, timer, flags=0):
+        """Send one operation; returns the UID of its card and its result frame's payload
+
+        timeout counts from the moment the sketch arms the operation, not
+        from when it was queued. An operation that times out or is cancelled
+        clears the queue behind it.
+        """
+        job = _Job(self.loop, timer)
+        try:
+            async with self._send_lock:
+                ack = await self._send(job, opcode, payload, flags)
+            if ack.opcode == OP_ARMED:
+                job.begin()
+            elif not job.started.is_set():
+                timer.mark("queued")
+            await job.started.wait()
+            payload = await asyncio.wait_for(asyncio.shield(job.result), timeout)
+            return job.uid, payload
+        except asyncio.TimeoutError:
+            if job not in self.jobs:
+                raise
+            self.clear(JobsCleared("The reader's queue was cleared: an operation in it timed out"), job)
+            if not job.started.is_set():
+                raise asyncio.TimeoutError("Arduino did not acknowledge the command") from None
+            raise asyncio.TimeoutError(f"No card within {timeout} s") from None
+        except asyncio.CancelledError:
+            if job in self.jobs:
+                self.clear(JobsCleared("The reader's queue was cleared: an operation in it was cancelled"), job)
+            raise
+
+    async def _send(self, job, opcode, payload, flags):
+        """Send job until the sketch accepts it; returns the ARMED or QUEUED frame"""
+        while True:
+            if self._closed:
+                raise self._closed
+            # Longer writes would overflow the RX buffer of a sketch polling for a card; they wait until it is idle
+            while len(payload) > MAX_QUEUED_DATA and self.jobs:
+                await self._freed
+            if self._draining is not None:
+                try:
+                    await asyncio.wait_for(asyncio.shield(self._draining), DISARM_TIMEOUT)
+                except asyncio.TimeoutError:
+                    pass  # SCAN_DONE got lost; the queue was cleared anyway
+                self._draining = None
+            freed = self._freed
+            self._ack = self.loop.create_future()
+            self.jobs.append(job)
+            if flags:
+                self.link.send_frame(OP_SET_FLAGS, bytes([flags]))
+            self.link.send_frame(opcode, payload)
+            job.timer.mark("sent")
+            ack = await asyncio.wait_for(self._ack, ACK_TIMEOUT)
+            if ack.opcode != OP_ERROR:
+                return ack
+            if job in self.jobs:
+                self.jobs.remove(job)
+            if ack.payload[0] != STATUS_QUEUE_FULL:
+                raise serial.SerialException(
+                    f"Firmware rejected the command: {STATUS_NAMES.get(ack.payload[0], hex(ack.payload[0]))}"
+                )
+            await freed
+
+    def close(self):
+        """Stop receiving frames"""
+        self.link._unsubscribe(self)
+
+
+class RFIDClient:
+    """Card operations on one reader as coroutines
+
+    Timeouts raise asyncio.TimeoutError, a command the firmware rejects
+    raises serial.SerialException and a closed port SerialLinkClosed. The
+    result of an operation always comes back as CardRead or CardWrite,
+    whether the card answered OK or not.
+    """
+
+    def __init__(self, link):
+        self.link = link
+        self._lock = asyncio.Lock()
+        self._jobs = None
+
+    @classmethod
+    async def connect(cls, port, baudrates=HIGH_SPEED_BAUDRATES, binary=False, timing=True,
+                      reset_board=True, handshake_timeout=HANDSHAKE_TIMEOUT):
+        """Open port, step up to the first of baudrates the sketch accepts and switch protocols
+
+        The handshake and baud negotiation happen once per reader, so the
+        blocking SerialLink code runs for them on the loop's default executor.
+        """
+        def open_link():
+            link = SerialLink.open(port, handshake_timeout=handshake_timeout, reset_board=reset_board,
+                                   fallback_baudrates=baudrates)
+            try:
+                if baudrates:
+                    link.negotiate_baud(baudrates)
+                if binary:
+                    link.enter_binary_mode()
+                if timing:
+                    # Older sketches don't answer; the operations work without the marks
+                    link.set_timing(True)
+            except Exception:
+                link.close()
+                raise
+            return link
+
+        return cls(await asyncio.get_running_loop().run_in_executor(None, open_link))
+
+    @property
+    def port(self):
+        return self.link.port
+
+    @property
+    def binary_mode(self):
+        return self.link.binary_mode
+
+    def subscribe(self):
+        """AsyncSubscription to the link; subscribe before sending to avoid missing replies"""
+        return self.link.subscribe(AsyncSubscription(self.link))
+
+    async def read_card(self, timeout=CARD_TIMEOUT, blocks=None, timer=None, on_line=None):
+        """Read the next card; returns a CardRead
+
+        data is the decompressed payload (bytes) and text its decoding, both
+        None when the read failed. In text mode the sketch's other status
+        lines go to on_line. A PhaseTimer passed as timer receives the client
+        and firmware phases.
+        """
+        timer = timer or PhaseTimer()
+        if self.binary_mode:
+            return await self._read(timeout, blocks, timer, on_line)
+        return await self._exclusive(self._read, timeout, blocks, timer, on_line)
+
+    async def write_card(self, data, timeout=CARD_TIMEOUT, differential=False, flags=0, timer=None, on_line=None,
+                         resume=0):
+        """Write data (str or bytes) to the next card; returns a CardWrite
+
+        flags are stored in the card header for an already compressed payload
+        (see compression.py) and need the binary protocol. stats holds the
+        DiffStats of a differential write. A write that was cut short is sent
+        again up to resume times within the same timeout, so the card put back
+        on the reader carries on where it stopped; the last attempt's CardWrite
+        is returned. Resuming clears the operations queued behind the write
+        (they fail with JobsCleared), as they would otherwise go to that card.
+        """
+        if isinstance(data, str):
+            data = data.encode()
+        if flags and not self.binary_mode:
+            raise ValueError("Flagged payloads need the binary protocol")
+        timer = timer or PhaseTimer()
+        if self.binary_mode:
+            return await self._write_resuming(data, timeout, differential, flags, timer, on_line, resume)
+        return await self._exclusive(self._write_resuming, data, timeout, differential, flags, timer, on_line, resume)
+
+    async def ping(self, timeout=0.5):
+        """Round trip time of a PING in seconds, or None if the firmware didn't answer"""
+        loop = asyncio.get_running_loop()
+        async with self._lock:
+            start = loop.time()
+            with self.subscribe() as replies:
+                if self.binary_mode:
+                    self.link.send_frame(OP_PING)
+                    reply = await replies.wait_for(lambda f: f.opcode == OP_PONG, timeout)
+                else:
+                    self.link.send_line("PING")
+                    reply = await replies.wait_for(lambda r: r == "PONG", timeout)
+            return loop.time() - start if reply is not None else None
+
+    async def _exclusive(self, operation, *args):
+        """Run operation(*args) once the reader is free; disarm the sketch if it is abandoned"""
+        async with self._lock:
+            try:
+                return await operation(*args)
+            except (asyncio.CancelledError, asyncio.TimeoutError):
+                await self._disarm()
+                raise
+
+    async def _disarm(self):
+        if not self.link.is_open:
+            return
+        with self.subscribe() as replies:
+            if self.binary_mode:
+                self.link.send_frame(OP_SCAN_END)
+                await replies.wait_for(lambda f: f.opcode == OP_SCAN_DONE, DISARM_TIMEOUT)
+            else:
+                self.link.send_line("SCAN_END")
+                await replies.wait_for(lambda r: r == "SCAN_DONE", DISARM_TIMEOUT)
+
+    def _pipeline(self):
+        if self._jobs is None:
+            self._jobs = self.link.subscribe(JobPipeline(self.link))
+        return self._jobs
+
+    async def _text_operation(self, command, message, final_prefixes, timeout, timer, on_line):
+        """Send command (and message, once the sketch is ready for it); returns the card's UID and the final line"""
+        uid = None
+
+        def relay(line):
+            nonlocal uid
+            if line.startswith("UID:"):
+                uid = line[4:]
+            if on_line:
+                on_line(line)
+
+        with self.subscribe() as lines:
+            self.link.send_line(command)
+            timer.mark("sent")
+            if message is not None:
+                ready = await lines.wait_for(
+                    lambda r: r.startswith("Ready to write"), ACK_TIMEOUT, on_line=timer.relay(relay)
+                )
+                if ready is None:
+                    raise asyncio.TimeoutError("Arduino did not acknowledge the write command")
+                timer.mark("ready")
+                self.link.send_line(message)
+                timer.mark("message")
+            response = await lines.wait_for(
+                lambda r: r.startswith(final_prefixes), timeout, on_line=timer.relay(relay)
+            )
+            timer.mark("result")
+        if response is None:
+            raise asyncio.TimeoutError(f"No card within {timeout} s")
+        return uid, response
+
+    async def _read(self, timeout, blocks, timer, on_line):
+        if self.binary_mode:
+            payload = bytes([blocks]) if blocks else b""
+            uid, payload = await self._pipeline().submit(OP_READ_MULTI, payload, timeout, timer)
+            result = parse_read_result(payload)
+            ok = result.status in (STATUS_OK, STATUS_PARTIAL)
+            data = decompress(result.data, result.flags) if ok else None
+            status = STATUS_NAMES.get(result.status, hex(result.status))
+            blocks_read = sum(1 for b in result.blocks if b.status == STATUS_OK)
+        else:
+            result = None
+            command = f"READ_MULTI:{blocks}" if blocks else "READ_MULTI"
+            uid, response = await self._text_operation(command, None, READ_RESULT_PREFIXES, timeout, timer, on_line)
+            ok = not response.startswith("Read failed: ")
+            blocks_read = 0
+            if response.startswith("DATA_HEX:"):
+                # Flagged (compressed) payloads come hex encoded
+                payload, flags = parse_hex_line(response)
+                data = decompress(payload, flags)
+                blocks_read = card_layout.blocks_needed(len(payload))
+            elif ok:
+                data = response[len("DATA:"):].encode()
+                blocks_read = card_layout.blocks_needed(len(data))
+            else:
+                data = None
+            status = STATUS_NAMES[STATUS_OK] if ok else response[len("Read failed: "):]
+        text = data.decode(errors="replace") if data is not None else None
+        return CardRead(ok, status, data, text, result, timer, uid, blocks_read)
+
+    async def _write_resuming(self, data, timeout, differential, flags, timer, on_line, resume):
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        written = await self._write(data, timeout, differential, flags, timer, on_line)
+        # Only a WRITE_MULTI reports progress; it is None when the card can't take the message at all
+        while not written.ok and written.progress is not None and resume > 0 and loop.time() < deadline:
+            resume -= 1
+            if self.binary_mode and self._pipeline().jobs:
+                self._pipeline().clear(JobsCleared("Cleared so that an interrupted write can resume"))
+            try:
+                written = await self._write(data, deadline - loop.time(), differential, flags, timer, on_line)
+            except asyncio.TimeoutError:
+                # The card didn't come back; what the last attempt got onto it is the answer
+                if not self.binary_mode:
+                    await self._disarm()
+                break
+        return written
+
+    async def _write(self, data, timeout, differential, flags, timer, on_line):
+        if self.binary_mode:
+            opcode = OP_WRITE_DIFF if differential else OP_WRITE_MULTI
+            uid, payload = await self._pipeline().submit(opcode, data, timeout, timer, flags)
+            result = parse_result(payload)
+            stats = parse_diff_stats(result) if differential else None
+            progress = None if differential else parse_write_progress(result)
+            if progress is not None:
+                blocks = progress.verified
+            elif result.status == STATUS_OK:
+                blocks = card_layout.blocks_needed(len(data))
+            else:
+                blocks = sum(1 for b in result.blocks if b.status == STATUS_OK)
+            status = STATUS_NAMES.get(result.status, hex(result.status))
+            return CardWrite(result.status == STATUS_OK, status, blocks, stats, result, timer, progress, uid)
+
+        diff_lines = []
+        resumed_at = 0
+
+        def collect(line):
+            nonlocal resumed_at
+            if line.startswith("Differential write: "):
+                diff_lines.append(line)
+            resumed_at = parse_resume_line(line) or resumed_at
+            if on_line:
+                on_line(line)
+
+        command = "WRITE_DIFF" if differential else "WRITE_MULTI"
+        message = data.decode(errors="replace")
+        uid, response = await self._text_operation(
+            f"{command}:{card_layout.blocks_needed(len(data))}", message, WRITE_RESULT_PREFIXES, timeout, timer, collect
+        )
+        ok = response.startswith("Write successful")
+        progress = None if differential else parse_write_line(response, resumed_at)
+        if progress is not None:
+            blocks = progress.verified
+        else:
+            blocks = card_layout.blocks_needed(len(data)) if ok else 0
+        status = STATUS_NAMES[STATUS_OK] if ok else response[len("Write failed: "):]
+        stats = parse_diff_line(diff_lines[-1]) if diff_lines else None
+        return CardWrite(ok, status, blocks, stats, None, timer, progress, uid)
+
+    async def close(self):
+        """Close the port; operations still waiting raise SerialLinkClosed
+
+        A sketch left in binary mode wouldn't answer the text handshake of
+        the next connection that doesn't reset the board, so it is switched
+        back to text first.
+        """
+        def close_link():
+            if self.link.is_open and self.link.binary_mode:
+                try:
+                    self.link.leave_binary_mode(timeout=DISARM_TIMEOUT)
+                except serial.SerialException:
+                    pass
+            self.link.close()
+
+        if self._jobs is not None:
+            self._jobs.close()
+        await asyncio.get_running_loop().run_in_executor(None, close_link)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
@@ -0,0 +1,133 @@
+"""Continuous scan mode for gates and kiosks
+
+The sketch is put into SCAN mode once and then reports every card that
+enters the field: its UID followed by the usual read result. A card
+resting on the antenna, or moved in and out of the field, is reported
+again and again, so ScanSession suppresses repeated reads of the same UID
+within a configurable window.
+"""
+import threading
+import time
+from collections import namedtuple
+
+import serial
+
+import card_layout
+from compression import decompress, parse_hex_line
+from frame_protocol import (
+    parse_read_result, STATUS_NAMES, STATUS_OK, STATUS_PARTIAL,
+    OP_ARMED, OP_READ_RESULT, OP_SCAN, OP_SCAN_CARD, OP_SCAN_DONE, OP_SCAN_END,
+)
+
+# Seconds during which another read of the same card is dropped
+DEFAULT_REPEAT_WINDOW = 2.0
+POLL_INTERVAL = 0.2
+# UIDs remembered before the ones outside the window are forgotten
+MAX_REMEMBERED = 256
+
+# blocks: data blocks read; latency_ms: from the card's UID report to its read result
+ScanEvent = namedtuple("ScanEvent", ["uid", "data", "status", "timestamp", "blocks", "latency_ms"])
+
+
+class RepeatFilter:
+    """Remembers recently seen UIDs; a card counts as new once it has been
+    away for longer than the window, so a resting card stays suppressed"""
+
+    def __init__(self, window=DEFAULT_REPEAT_WINDOW):
+        self.window = window
+        self.last_seen = {}
+
+    def is_repeat(self, uid, now=None, remember=True):
+        """True if uid was remembered less than window seconds ago"""
+        now = time.monotonic() if now is None else now
+        # Forget cards that have been gone for longer than the window
+        if len(self.last_seen) > MAX_REMEMBERED:
+            self.last_seen = {u: t for u, t in self.last_seen.items() if now - t <= self.window}
+        previous = self.last_seen.get(uid)
+        if remember:
+            self.last_seen[uid] = now
+        return previous is not None and now - previous <= self.window
+
+
+class ScanSession:
+    """Keeps the sketch scanning and hands every new card to a callback"""
+
+    def __init__(self, link, window=DEFAULT_REPEAT_WINDOW):
+        self.link = link
+        self.filter = RepeatFilter(window)
+        self.suppressed = 0
+        self._stop = threading.Event()
+
+    def stop(self):
+        self._stop.set()
+
+    def run(self, on_card):
+        """Scan until stop(); on_card(ScanEvent) is called from this thread"""
+        with self.link.subscribe() as replies:
+            self._begin(replies)
+            try:
+                uid = None
+                arrived = None
+                while not self._stop.is_set():
+                    reply = replies.get(POLL_INTERVAL)
+                    if reply is None:
+                        continue
+
+                    if isinstance(reply, str):
+                        if reply.startswith("UID:"):
+                            uid, arrived = reply[4:], time.monotonic()
+                        elif uid and reply.startswith("DATA:"):
+                            # The text protocol doesn't list the blocks; the header and payload are all that was read
+                            blocks = card_layout.blocks_needed(len(reply[5:].encode()))
+                            self._report(on_card, uid, reply[5:], STATUS_NAMES[STATUS_OK], blocks, arrived)
+                            uid = None
+                        elif uid and reply.startswith("DATA_HEX:"):
+                            payload, flags = parse_hex_line(reply)
+                            blocks = card_layout.blocks_needed(len(payload))
+                            self._report(on_card, uid, self._decode(payload, flags), STATUS_NAMES[STATUS_OK], blocks, arrived)
+                            uid = None
+                        elif uid and reply.startswith("Read failed: "):
+                            # Block failures ("Read failed for block ...") come before the final verdict
+                            self._report(on_card, uid, None, reply[len("Read failed: "):], 0, arrived)
+                            uid = None
+                    elif reply.opcode == OP_SCAN_CARD:
+                        uid, arrived = reply.payload.hex().upper(), time.monotonic()
+                    elif uid and reply.opcode == OP_READ_RESULT:
+                        result = parse_read_result(reply.payload)
+                        data = self._decode(result.data, result.flags) if result.status in (STATUS_OK, STATUS_PARTIAL) else None
+                        blocks = sum(1 for b in result.blocks if b.status == STATUS_OK)
+                        self._report(on_card, uid, data, STATUS_NAMES.get(result.status, hex(result.status)), blocks, arrived)
+                        uid = None
+            finally:
+                self._end(replies)
+
+    def _decode(self, payload, flags):
+        return decompress(payload, flags).decode(errors="replace")
+
+    def _report(self, on_card, uid, data, status, blocks, arrived):
+        latency_ms = (time.monotonic() - arrived) * 1000
+        # Failed reads aren't remembered, so a card that was pulled away too early can be read again at once
+        if self.filter.is_repeat(uid, remember=data is not None):
+            self.suppressed += 1
+            return
+        on_card(ScanEvent(uid, data, status, time.time(), blocks, latency_ms))
+
+    def _begin(self, replies):
+        if self.link.binary_mode:
+            self.link.send_frame(OP_SCAN)
+            started = replies.wait_for(lambda f: getattr(f, "opcode", None) == OP_ARMED, 2)
+        else:
+            self.link.send_line("SCAN")
+            started = replies.wait_for(lambda r: r == "SCAN_OK", 2)
+        if started is None:
+            raise serial.SerialTimeoutException("Firmware did not start scanning")
+
+    def _end(self, replies):
+        if not self.link.is_open:
+            return
+        if self.link.binary_mode:
+            self.link.send_frame(OP_SCAN_END)
+            replies.wait_for(lambda f: getattr(f, "opcode", None) == OP_SCAN_DONE, 2)
+        else:
+            self.link.send_line("SCAN_END")
+            replies.wait_for(lambda r: r == "SCAN_DONE", 2)
@@ -0,0 +1,430 @@
+import os
+import queue
+import threading
+import time
+
+import serial
+
+import card_layout
+from frame_protocol import (
+    FrameDecoder, encode_frame, parse_result, parse_read_result, STATUS_NAMES,
+    OP_TEXT_MODE, OP_TEXT_MODE_OK, OP_READ_MULTI, OP_READ_RESULT, OP_WRITE_MULTI, OP_WRITE_DIFF, OP_WRITE_RESULT,
+    OP_ARMED, OP_ERROR, OP_PING, OP_PONG, OP_QUEUED, OP_SCAN_DONE, OP_SCAN_END, OP_SET_FLAGS, OP_TIMING,
+)
+from timing import PhaseTimer
+
+READY_BANNER = "RFID Manager Ready"
+DEFAULT_BAUDRATE = 9600
+HANDSHAKE_TIMEOUT = 5
+PING_INTERVAL = 0.25
+# A board still running at a negotiated rate answers its first PING at once
+FALLBACK_HANDSHAKE_TIMEOUT = PING_INTERVAL * 4
+# Time the bootloader needs after a DTR reset before it hands over to the sketch
+BOOTLOADER_GRACE = 1.0
+# Rates tried in order after connecting; the sketch rejects anything it can't drive
+HIGH_SPEED_BAUDRATES = (115200,)
+# Must stay below BAUD_VERIFY_TIMEOUT in the sketch
+BAUD_VERIFY_TIMEOUT = 0.8
+ECHO_INTERVAL = 0.1
+# Final lines of a text protocol operation; block failures ("Read failed for block ...") come before them
+WRITE_RESULT_PREFIXES = ("Write successful", "Write failed: ")
+READ_RESULT_PREFIXES = ("DATA:", "DATA_HEX:", "Read failed: ")
+
+
+class SerialLinkClosed(serial.SerialException):
+    """Raised when waiting on a link whose port has been closed"""
+
+
+class LineSubscription:
+    """Receives every line (or Frame, in binary mode) read from the port while it is open"""
+
+    def __init__(self, link):
+        self.link = link
+        self.lines = queue.Queue()
+
+    def deliver(self, line):
+        """Queue a line; called from the reader thread"""
+        self.lines.put(line)
+
+    def get(self, timeout=None):
+        """Return the next line, or None once the timeout expires"""
+        try:
+            line = self.lines.get(timeout=timeout)
+        except queue.Empty:
+            return None
+        if line is None:
+            raise SerialLinkClosed("Serial connection closed")
+        return line
+
+    def wait_for(self, predicate, timeout, on_line=None):
+        """Return the first line matching predicate, or None on timeout"""
+        deadline = time.monotonic() + timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+            line = self.get(remaining)
+            if line is None:
+                return None
+            if on_line:
+                on_line(line)
+            if predicate(line):
+                return line
+
+    def close(self):
+        """Stop receiving lines"""
+        self.link._unsubscribe(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class SerialLink:
+    """Single owner of a serial port with one blocking reader thread
+
+    The reader thread is the only consumer of the port. Every line it reads
+    is pushed to the subscriptions that are open at that moment, so waiting
+    operations wake up as soon as the Arduino answers instead of polling
+    in_waiting.
+    """
+
+    def __init__(self, serial_connection):
+        self.serial_connection = serial_connection
+        self._subscriptions = []
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._running = True
+        self.binary_mode = False
+        self.timing = False
+        self._decoder = FrameDecoder()
+        self._reader = threading.Thread(target=self._reader_loop, daemon=True)
+        self._reader.start()
+
+    @classmethod
+    def open(cls, port, baudrate=DEFAULT_BAUDRATE, timeout=2, handshake_timeout=HANDSHAKE_TIMEOUT,
+             reset_board=True, fallback_baudrates=()):
+        """Open a port and return once the firmware has answered the handshake
+
+        With reset_board=False the port is opened with DTR and RTS held low,
+        so boards that would auto-reset keep running and answer PING at once.
+        Such a board may still be running at a previously negotiated rate, so
+        fallback_baudrates are pinged as well before giving up.
+        """
+        connection = serial.Serial()
+        connection.port = port
+        connection.baudrate = baudrate
+        connection.timeout = timeout
+        if not reset_board:
+            connection.dtr = False
+            connection.rts = False
+        connection.open()
+
+        link = cls(connection)
+        try:
+            try:
+                link.handshake(handshake_timeout, ping_delay=BOOTLOADER_GRACE if reset_board else 0)
+            except serial.SerialTimeoutException as e:
+                link._handshake_fallback(fallback_baudrates, e)
+        except Exception:
+            link.close()
+            raise
+        return link
+
+    def _handshake_fallback(self, baudrates, error):
+        """Retry the handshake briefly at other rates; error is the timeout at the first rate"""
+        for rate in baudrates:
+            self.serial_connection.baudrate = rate
+            try:
+                return self.handshake(FALLBACK_HANDSHAKE_TIMEOUT)
+            except serial.SerialTimeoutException:
+                pass
+        self.serial_connection.baudrate = DEFAULT_BAUDRATE
+        if not baudrates:
+            raise error
+        rates = ", ".join(str(rate) for rate in baudrates)
+        raise serial.SerialTimeoutException(f"{error}, nor within {FALLBACK_HANDSHAKE_TIMEOUT} s at {rates} baud")
+
+    def handshake(self, timeout=HANDSHAKE_TIMEOUT, ping_delay=0):
+        """Wait for the ready banner or a PONG reply, pinging until one arrives"""
+        with self.subscribe() as lines:
+            start = time.monotonic()
+            deadline = start + timeout
+            next_ping = start + ping_delay
+            while True:
+                now = time.monotonic()
+                if now >= deadline:
+                    raise serial.SerialTimeoutException(
+                        f"No response from KhabiByte firmware on {self.port} within {timeout} s"
+                    )
+                if now >= next_ping:
+                    self.send_line("PING")
+                    next_ping = now + PING_INTERVAL
+                line = lines.get(min(next_ping, deadline) - now)
+                if line is not None and (line.startswith(READY_BANNER) or line == "PONG"):
+                    return line
+
+    def negotiate_baud(self, baudrates=HIGH_SPEED_BAUDRATES):
+        """Step the link up to the first rate the firmware accepts and echoes back
+
+        The sketch switches after acknowledging BAUD:<rate> and waits for an
+        ECHO line at the new rate. If none arrives both sides drop back to
+        9600, so a failed check never leaves the link unusable. Returns the
+        rate in use afterwards.
+        """
+        for rate in baudrates:
+            with self.subscribe() as lines:
+                self.send_line(f"BAUD:{rate}")
+                reply = lines.wait_for(lambda r: r.startswith("BAUD"), 2)
+                if reply != f"BAUD_OK:{rate}":
+                    continue
+
+                self.serial_connection.baudrate = rate
+                nonce = f"ECHO:{os.urandom(4).hex()}"
+                deadline = time.monotonic() + BAUD_VERIFY_TIMEOUT
+                while time.monotonic() < deadline:
+                    self.send_line(nonce)
+                    if lines.wait_for(lambda r: r == nonce, min(ECHO_INTERVAL, deadline - time.monotonic())):
+                        return rate
+
+                # The sketch gives up on its own and reports BAUD_FALLBACK at 9600
+                self.serial_connection.baudrate = DEFAULT_BAUDRATE
+                lines.wait_for(lambda r: r.startswith("BAUD_FALLBACK"), 2)
+            self.handshake(PING_INTERVAL * 4)
+        return self.serial_connection.baudrate
+
+    @property
+    def baudrate(self):
+        return self.serial_connection.baudrate
+
+    @property
+    def port(self):
+        return self.serial_connection.port
+
+    def subscribe(self, subscription=None):
+        """Open a subscription; subscribe before sending to avoid missing replies
+
+        Any object with deliver(line) and close() can be passed in instead of
+        the default LineSubscription (see rfid_client.py).
+        """
+        subscription = subscription or LineSubscription(self)
+        with self._lock:
+            self._subscriptions.append(subscription)
+        return subscription
+
+    def _unsubscribe(self, subscription):
+        with self._lock:
+            if subscription in self._subscriptions:
+                self._subscriptions.remove(subscription)
+
+    def _dispatch(self, line):
+        with self._lock:
+            subscriptions = list(self._subscriptions)
+        for subscription in subscriptions:
+            subscription.deliver(line)
+
+    def _reader_loop(self):
+        """Block on readline (or frame bytes) and hand the results to the subscribers"""
+        while self._running:
+            try:
+                if self.binary_mode:
+                    raw = self.serial_connection.read(self.serial_connection.in_waiting or 1)
+                else:
+                    raw = self.serial_connection.readline()
+            except (serial.SerialException, OSError, TypeError, AttributeError):
+                break
+            if not raw:
+                continue
+
+            if self.binary_mode:
+                for frame in self._decoder.feed(raw):
+                    # The mode switches are acted on here so no byte is read in the wrong mode
+                    if frame.opcode == OP_TEXT_MODE_OK:
+                        self.binary_mode = False
+                    self._dispatch(frame)
+            else:
+                line = raw.decode(errors="replace").strip()
+                if line == "BINARY_OK":
+                    self._decoder = FrameDecoder()
+                    self.binary_mode = True
+                self._dispatch(line)
+        self._running = False
+        self._dispatch(None)
+
+    @property
+    def is_open(self):
+        return self._running
+
+    def send_line(self, text):
+        """Write one newline-terminated command"""
+        with self._write_lock:
+            self.serial_connection.write(f"{text}\n".encode())
+
+    def send_frame(self, opcode, payload=b""):
+        """Write one binary frame"""
+        with self._write_lock:
+            self.serial_connection.write(encode_frame(opcode, payload))
+
+    def ping(self, timeout=PING_INTERVAL):
+        """Round trip time of a PING in seconds, or None if the firmware didn't answer"""
+        start = time.monotonic()
+        with self.subscribe() as replies:
+            if self.binary_mode:
+                self.send_frame(OP_PING)
+                reply = replies.wait_for(lambda f: getattr(f, "opcode", None) == OP_PONG, timeout)
+            else:
+                self.send_line("PING")
+                reply = replies.wait_for(lambda r: r == "PONG", timeout)
+        return time.monotonic() - start if reply is not None else None
+
+    def enter_binary_mode(self, timeout=2):
+        """Switch the link to the binary framed protocol"""
+        with self.subscribe() as lines:
+            self.send_line("BINARY")
+            if lines.wait_for(lambda r: r == "BINARY_OK", timeout) is None:
+                raise serial.SerialTimeoutException("Firmware did not accept binary mode")
+
+    def leave_binary_mode(self, timeout=2):
+        """Switch the link back to the newline-terminated text protocol"""
+        with self.subscribe() as frames:
+            self.send_frame(OP_TEXT_MODE)
+            if frames.wait_for(lambda f: getattr(f, "opcode", None) == OP_TEXT_MODE_OK, timeout) is None:
+                raise serial.SerialTimeoutException("Firmware did not return to text mode")
+
+    def disarm(self, timeout=2):
+        """Drop whatever operation the sketch is waiting for a card for (and its queue)
+
+        A late card would otherwise still be written or read for a caller
+        that has given up. Returns False if the firmware didn't confirm.
+        """
+        with self.subscribe() as replies:
+            if self.binary_mode:
+                self.send_frame(OP_SCAN_END)
+                reply = replies.wait_for(lambda f: getattr(f, "opcode", None) == OP_SCAN_DONE, timeout)
+            else:
+                self.send_line("SCAN_END")
+                reply = replies.wait_for(lambda r: r == "SCAN_DONE", timeout)
+        return reply is not None
+
+    def set_timing(self, enabled=True, timeout=1):
+        """Switch the sketch's per-phase timing marks on or off (see timing.py); returns True once accepted"""
+        if self.binary_mode:
+            # Not answered; the marks show up with the next operation
+            self.send_frame(OP_TIMING, bytes([enabled]))
+        else:
+            with self.subscribe() as lines:
+                self.send_line(f"TIMING:{int(enabled)}")
+                if lines.wait_for(lambda r: r == "TIMING_OK", timeout) is None:
+                    return False
+        self.timing = enabled
+        return True
+
+    def _binary_operation(self, opcode, payload, result_opcode, timeout, armed_timeout, parse=parse_result, timer=None):
+        timer = timer or PhaseTimer()
+        with self.subscribe() as frames:
+            self.send_frame(opcode, payload)
+            timer.mark("sent")
+            accepted = frames.wait_for(
+                lambda f: f.opcode in (OP_ARMED, OP_QUEUED, OP_ERROR), armed_timeout, on_line=timer.collect
+            )
+            if accepted is None:
+                return None
+            if accepted.opcode == OP_ERROR:
+                raise serial.SerialException(
+                    f"Firmware rejected the command: {STATUS_NAMES.get(accepted.payload[0], hex(accepted.payload[0]))}"
+                )
+            # Queued behind jobs that were armed before: the armed one and the others queued ahead
+            # report their results first
+            ahead = accepted.payload[0] if accepted.opcode == OP_QUEUED else 0
+            timer.mark("armed" if accepted.opcode == OP_ARMED else "queued")
+
+            def is_result(frame):
+                nonlocal ahead
+                if frame.opcode not in (OP_READ_RESULT, OP_WRITE_RESULT):
+                    return False
+                if ahead:
+                    ahead -= 1
+                    return False
+                return frame.opcode == result_opcode
+
+            result = frames.wait_for(is_result, timeout, on_line=timer.collect)
+            timer.mark("result")
+        return parse(result.payload) if result else None
+
+    def binary_write(self, data, timeout=45, armed_timeout=2, differential=False, flags=0, timer=None):
+        """Write data to the next card in binary mode; returns an OperationResult or None on timeout
+
+        flags are stored in the card header (see compression.py). A PhaseTimer
+        passed as timer receives the client and firmware phases.
+        """
+        if flags:
+            self.send_frame(OP_SET_FLAGS, bytes([flags]))
+        opcode = OP_WRITE_DIFF if differential else OP_WRITE_MULTI
+        return self._binary_operation(opcode, data, OP_WRITE_RESULT, timeout, armed_timeout, timer=timer)
+
+    def binary_read(self, timeout=45, armed_timeout=2, blocks=None, timer=None):
+        """Read the next card in binary mode; returns an OperationResult or None on timeout
+
+        When blocks is given the firmware stops after that many data blocks.
+        The result carries the header flags of the card.
+        """
+        payload = bytes([blocks]) if blocks else b""
+        return self._binary_operation(
+            OP_READ_MULTI, payload, OP_READ_RESULT, timeout, armed_timeout, parse=parse_read_result, timer=timer
+        )
+
+    def text_write(self, message, timeout=45, ready_timeout=5, differential=False, timer=None, on_line=None):
+        """Write message (str) to the next card over the text protocol
+
+        Returns the final "Write successful!" / "Write failed: ..." line, or
+        None on timeout. Every other line goes to on_line, except the timing
+        marks, which go to timer.
+        """
+        timer = timer or PhaseTimer()
+        blocks = card_layout.blocks_needed(len(message.encode()))
+        command = "WRITE_DIFF" if differential else "WRITE_MULTI"
+        with self.subscribe() as lines:
+            self.send_line(f"{command}:{blocks}")
+            timer.mark("sent")
+            ready = lines.wait_for(lambda r: r.startswith("Ready to write"), ready_timeout, on_line=timer.relay(on_line))
+            if ready is None:
+                raise serial.SerialTimeoutException("Arduino did not acknowledge the write command")
+            timer.mark("ready")
+
+            self.send_line(message)
+            timer.mark("message")
+            response = lines.wait_for(
+                lambda r: r.startswith(WRITE_RESULT_PREFIXES), timeout, on_line=timer.relay(on_line)
+            )
+            timer.mark("result")
+        return response
+
+    def text_read(self, timeout=45, timer=None, on_line=None):
+        """Read the next card over the text protocol
+
+        Returns the final DATA:, DATA_HEX: or "Read failed: ..." line, or None
+        on timeout; other lines are handled as in text_write.
+        """
+        timer = timer or PhaseTimer()
+        with self.subscribe() as lines:
+            self.send_line("READ_MULTI")
+            timer.mark("sent")
+            response = lines.wait_for(
+                lambda r: r.startswith(READ_RESULT_PREFIXES), timeout, on_line=timer.relay(on_line)
+            )
+            timer.mark("result")
+        return response
+
+    def close(self):
+        """Stop the reader thread and close the port"""
+        self._running = False
+        cancel_read = getattr(self.serial_connection, "cancel_read", None)
+        if cancel_read:
+            try:
+                cancel_read()
+            except (serial.SerialException, OSError):
+                pass
+        self._reader.join(timeout=1)
+        self.serial_connection.close()
@@ -0,0 +1,106 @@
+"""Bounded, coalesced status logs for the GUI's status panes
+
+Worker threads and the event loop append to a StatusLog from anywhere;
+nothing touches Tk until StatusPane.flush(), which the GUI calls on the Tk
+thread at a fixed frame rate and which shows every line that arrived since
+the previous flush in a single insert. A log holds at most max_lines lines
+that haven't been shown yet and its textbox keeps only the last max_lines,
+so a long batch run neither floods the Tk event queue nor grows the widget
+without limit. When more lines arrive between two flushes, the pane is
+emptied and shows the last max_lines of them. With a spill file every line
+is also appended there, so the full log survives the trimming.
+"""
+import threading
+import time
+
+DEFAULT_MAX_LINES = 500
+# Flushes per second
+FRAME_RATE = 20
+FRAME_INTERVAL_MS = 1000 // FRAME_RATE
+
+
+class StatusLog:
+    """The lines not yet shown (at most the last max_lines) and whether the pane must be emptied first"""
+
+    def __init__(self, name, max_lines=DEFAULT_MAX_LINES):
+        self.name = name
+        self.max_lines = max_lines
+        self.spill = None
+        self._pending = []
+        self._reset = False
+        self._lock = threading.Lock()
+
+    def write(self, text):
+        """Append text (one or more lines, a trailing newline is optional); safe from any thread"""
+        lines = text.rstrip("\n").split("\n")
+        with self._lock:
+            self._pending.extend(lines)
+            if len(self._pending) > self.max_lines:
+                # Everything shown so far has scrolled out of the last max_lines
+                del self._pending[:-self.max_lines]
+                self._reset = True
+            if self.spill:
+                self.spill.write(self.name, lines)
+
+    def set_spill(self, spill):
+        """Also append every line to spill (a SpillFile), or stop with None"""
+        with self._lock:
+            self.spill = spill
+
+    def clear(self, text=None):
+        """Start over, e.g. for a new operation, optionally with a first line"""
+        with self._lock:
+            self._pending.clear()
+            self._reset = True
+        if text is not None:
+            self.write(text)
+
+    def take(self):
+        """(reset, lines) since the last call: whether the pane must be emptied first, and the new lines"""
+        with self._lock:
+            reset, lines = self._reset, self._pending
+            self._reset, self._pending = False, []
+        return reset, lines
+
+
+class SpillFile:
+    """Appends the lines of any number of logs to one file, with time and log name"""
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, "a", encoding="utf-8")
+        self._lock = threading.Lock()
+
+    def write(self, name, lines):
+        stamp = time.strftime("%Y-%m-%d %H:%M:%S")
+        with self._lock:
+            self._file.write("".join(f"{stamp} [{name}] {line}\n" for line in lines))
+
+    def flush(self):
+        with self._lock:
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+class StatusPane:
+    """Shows a StatusLog in a text widget; flush() must run on the Tk thread"""
+
+    def __init__(self, log, widget):
+        self.log = log
+        self.widget = widget
+
+    def flush(self):
+        reset, lines = self.log.take()
+        if reset:
+            self.widget.delete("1.0", "end")
+        if not lines:
+            return
+        self.widget.insert("end", "".join(f"{line}\n" for line in lines))
+        # The widget ends with an empty line after the last newline
+        excess = int(self.widget.index("end-1c").split(".")[0]) - 1 - self.log.max_lines
+        if excess > 0:
+            self.widget.delete("1.0", f"{excess + 1}.0")
+        self.widget.see("end")
@@ -0,0 +1,80 @@
+"""Per-phase timing of one card operation
+
+The client marks its own phases with time.perf_counter(); with timing
+switched on (SerialLink.set_timing) the sketch reports the end of each of its
+phases with its millis() clock:
+
+    armed   command or message accepted, waiting for a card
+    card    a card entered the field
+    header  the header block was read
+    data    the message blocks were read or written
+    clear   the blocks of the previous message were cleared (writes only)
+
+Each phase is reported as the time since the previous mark, so the
+firmware's "card" phase is the wait for a card and "data" the RF time
+spent on the message itself.
+"""
+import time
+
+from frame_protocol import parse_phase_frame, parse_phase_line, OP_PHASE
+
+
+class PhaseTimer:
+    """Client marks (ms since the timer started) and firmware marks (device millis)"""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.client = []
+        self.firmware = []
+
+    def mark(self, phase):
+        self.client.append((phase, (time.perf_counter() - self.start) * 1000))
+
+    def collect(self, reply):
+        """Record reply if it is a firmware phase mark (a T: line or an OP_PHASE frame); returns True if it was"""
+        if isinstance(reply, str):
+            if not reply.startswith("T:"):
+                return False
+            phase = parse_phase_line(reply)
+        elif getattr(reply, "opcode", None) == OP_PHASE:
+            phase = parse_phase_frame(reply.payload)
+        else:
+            return False
+        self.firmware.append(phase)
+        return True
+
+    def relay(self, on_line=None):
+        """Line callback that records the timing marks and passes everything else to on_line"""
+        def relay(line):
+            if not self.collect(line) and on_line:
+                on_line(line)
+        return relay
+
+    @property
+    def total_ms(self):
+        """Client time from the start to the last mark"""
+        return self.client[-1][1] if self.client else 0.0
+
+    def client_phases(self):
+        """[(phase, ms)] with the time each client phase took"""
+        previous = 0.0
+        phases = []
+        for name, at in self.client:
+            phases.append((name, at - previous))
+            previous = at
+        return phases
+
+    def firmware_phases(self):
+        """[(phase, ms)] from the sketch; the first mark ("armed") is the reference"""
+        return [
+            (phase.name, (phase.millis - previous.millis) & 0xFFFFFFFF)
+            for previous, phase in zip(self.firmware, self.firmware[1:])
+        ]
+
+    def summary(self):
+        """One line for the status panes"""
+        text = "Timing: " + ", ".join(f"{name} {ms:.1f} ms" for name, ms in self.client_phases())
+        firmware = self.firmware_phases()
+        if firmware:
+            text += "; firmware: " + ", ".join(f"{name} {ms} ms" for name, ms in firmware)
+        return text